@@ -2,26 +2,29 @@ import os
 import sys
 import sqlite3
 import json
-import requests
 import datetime
 import asyncio
-import aiohttp
 import zipfile
 import shutil
 import threading
 import time
 import inspect
 import webbrowser
-import uuid
+import weakref
+import atexit
+import concurrent.futures
 from telegram_utils import TelegramBot
 from feishu_utils import FeishuBot
 from qq_utils import QQBot
 from werkzeug.utils import secure_filename
 from flask import Flask, render_template, request, jsonify, Response, stream_with_context
-from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-from mcp.types import CallToolResult, TextContent
 from skill_manager import SkillManager
+from mcp_manager import MCPManager, SUPPORTED_TYPES, benchmark_server, benchmark_timeout, is_resource_or_prompt_tool
+from event_loop import BackgroundLoop
+from turn_scheduler import TurnScheduler, QueueFull
+from run_registry import RunRegistry, current_run
+from shared_state import SharedState
+from llm_client import LLMClient, ProviderError
 from feishu_utils import FeishuBot
 import core_skills
 from protocol1052.client import Protocol1052
@@ -166,6 +169,133 @@ CORE_TOOLS_SCHEMA = [
     }
 ]
 
+# Skill executor, 1052 Protocol memory and diary tools, offered next to the
+# core tools in every channel
+SKILL_TOOLS_SCHEMA = [
+    {
+        "type": "function",
+        "function": {
+            "name": "execute_skill_function",
+            "description": "Execute a Python function from a local skill. Refer to the 'Available Local Skills' in the system prompt for details on available skills, files, and functions.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "skill_name": {
+                        "type": "string",
+                        "description": "The name of the skill (folder name)."
+                    },
+                    "file_name": {
+                        "type": "string",
+                        "description": "The python file name (e.g. 'utils.py')."
+                    },
+                    "function_name": {
+                        "type": "string",
+                        "description": "The function name to call."
+                    },
+                    "kwargs": {
+                        "type": "object",
+                        "description": "Key-value arguments for the function."
+                    }
+                },
+                "required": ["skill_name", "file_name", "function_name"]
+            }
+        }
+    },
+    # 1052 Protocol Tools
+    {
+        "type": "function",
+        "function": {
+            "name": "protocol_remember",
+            "description": "Store a user preference or fact into long-term memory. Use this when the user explicitly asks to remember something or when you detect a stable user preference (e.g., 'I like python', 'Call me Master').",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "key": {
+                        "type": "string",
+                        "description": "The key for the preference (e.g., 'language_preference', 'nickname')."
+                    },
+                    "value": {
+                        "type": "string",
+                        "description": "The value to store."
+                    }
+                },
+                "required": ["key", "value"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "protocol_learn_experience",
+            "description": "Save a solution to a problem as an 'Experience'. Use this when you have successfully solved a complex problem or when the user provides a specific solution they want you to remember.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "problem": {
+                        "type": "string",
+                        "description": "A short description of the problem."
+                    },
+                    "solution": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "A list of steps or a description of the solution."
+                    },
+                    "tags": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "Tags for easier retrieval (e.g., ['python', 'error', 'network'])."
+                    }
+                },
+                "required": ["problem", "solution"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "protocol_recall_experience",
+            "description": "Search for past experiences/solutions related to a query. Use this when you encounter a problem and want to check if you've solved it before.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "Keywords to search for."
+                    }
+                },
+                "required": ["query"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "record_improvement_plan",
+            "description": "Record a self-improvement plan or internal monologue into your diary. Use this during Self-Reflection when you identify a gap and want to fix it later automatically.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "content": {
+                        "type": "string",
+                        "description": "The detailed plan or monologue. Describe what skill you want to learn or what code you want to write."
+                    },
+                    "type": {
+                        "type": "string",
+                        "enum": ["plan", "monologue"],
+                        "description": "Type of the entry. Use 'plan' for actionable items that need execution."
+                    }
+                },
+                "required": ["content", "type"]
+            }
+        }
+    }
+]
+
+def build_tools(mcp_tools, exclude=()):
+    """MCP tools first (sorted, see get_all_mcp_tools), then the local ones."""
+    return mcp_tools + [tool for tool in CORE_TOOLS_SCHEMA + SKILL_TOOLS_SCHEMA
+                        if tool['function']['name'] not in exclude]
+
 def execute_core_tool(func_name, func_args):
     """Executes a core tool function."""
     if func_name == 'execute_command':
@@ -258,28 +388,64 @@ extract_default_resources()
 # Initialize SkillManager with correct path
 skill_manager = SkillManager(skills_dir=SKILLS_DIR)
 
+# One long-lived event loop owns every async resource (MCP sessions, aiohttp
+# pools, background tasks); sync handlers and threads submit coroutines to it
+async_loop = BackgroundLoop(name="app-async", max_workers=64)
+atexit.register(async_loop.stop)
+
+# Shared keep-alive HTTP pool for LLM calls (one session per provider base URL)
+llm_client = LLMClient()
+atexit.register(llm_client.close)
+
+def close_async_clients():
+    if async_loop.started:
+        async_loop.run_sync(llm_client.aclose(), timeout=5)
+atexit.register(close_async_clients)
+
+# Initialize MCP session pool (long-lived servers shared by every channel)
+mcp_manager = MCPManager(db_file=DB_FILE, runtime=async_loop)
+atexit.register(mcp_manager.shutdown)
+
+# Admission control for agent turns: a capped number run at once, by
+# priority (web > direct IM > group IM > background)
+turn_scheduler = TurnScheduler()
+
 # Initialize Protocol1052
 # For simplicity, we use a single user_id for now, but this could be dynamic per conversation
 # In a multi-user environment, we would instantiate this per request/session
 DEFAULT_USER_ID = "owner"
 protocol_brain = Protocol1052(user_id=DEFAULT_USER_ID, storage_root=PROTOCOL_DIR)
 
-# --- Interruption Signals ---
-# Map conversation_id -> current_request_id (UUID)
-# When a new request comes in for a conversation, we update this value.
-# The running task checks if its request_id matches the current one. If not, it aborts.
-CONVERSATION_SIGNALS = {}
+# --- Shared State ---
+# Several worker processes may serve the same database (see wsgi.py). They
+# share run/cancel state and tell each other to drop cached settings, MCP
+# sessions, skills and memory through it.
+shared_state = SharedState(DB_FILE)
+
+# --- Run Registry ---
+# Every in-flight agent turn (of every worker), listed by /api/runs and
+# cancellable through /api/runs/<id>/cancel. A new request for a
+# conversation cancels the turn still running for it.
+RUNS = RunRegistry(DB_FILE, worker=shared_state.worker)
+shared_state.add_poller(RUNS.poll)
 
 class TaskInterrupted(Exception):
     pass
 
+# Protocol memory is one JSON document per user; serialize writes from
+# tool calls that run concurrently (and, with shared_state.lock(), from
+# other workers)
+PROTOCOL_LOCK = threading.Lock()
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, timeout=30)
     conn.row_factory = sqlite3.Row
     return conn
 
 def init_db():
     conn = get_db_connection()
+    # WAL lets workers read while another one writes
+    conn.execute('PRAGMA journal_mode=WAL')
     c = conn.cursor()
     # Settings table
     c.execute('''CREATE TABLE IF NOT EXISTS settings (
@@ -308,11 +474,23 @@ def init_db():
                     type TEXT NOT NULL, -- 'stdio' or 'sse'
                     command TEXT, -- for stdio
                     args TEXT, -- for stdio (json list)
-                    env TEXT, -- for stdio (json dict)
+                    env TEXT, -- for stdio (json dict); HTTP headers for sse
                     url TEXT, -- for sse
                     enabled BOOLEAN DEFAULT 1,
+                    max_concurrency INTEGER, -- concurrent tool calls; NULL uses the mcp_max_concurrency setting
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )''')
+    # Databases created before max_concurrency existed
+    columns = [row[1] for row in c.execute('PRAGMA table_info(mcp_servers)').fetchall()]
+    if 'max_concurrency' not in columns:
+        c.execute('ALTER TABLE mcp_servers ADD COLUMN max_concurrency INTEGER')
+    # MCP tool catalog cache (one row per server, invalidated by config hash)
+    c.execute('''CREATE TABLE IF NOT EXISTS mcp_tool_cache (
+                    server_id INTEGER PRIMARY KEY,
+                    config_hash TEXT NOT NULL,
+                    tools TEXT NOT NULL, -- json list of OpenAI tool schemas
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
     # Scheduled Tasks table
     c.execute('''CREATE TABLE IF NOT EXISTS scheduled_tasks (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -322,6 +500,39 @@ def init_db():
                     conversation_id INTEGER NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )''')
+    # Rolling conversation summaries (watermark = id of the last summarized message)
+    c.execute('''CREATE TABLE IF NOT EXISTS conversation_summaries (
+                    conversation_id INTEGER PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    watermark INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+    # One row per chat-completions call (seconds; tokens from the API's usage object)
+    c.execute('''CREATE TABLE IF NOT EXISTS llm_calls (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    conversation_id INTEGER,
+                    channel TEXT NOT NULL, -- 'web', 'telegram', 'qq', 'feishu', 'system'
+                    purpose TEXT NOT NULL, -- 'chat', 'reflection', 'summary', 'evolution'
+                    provider TEXT,
+                    model TEXT,
+                    ttfb REAL,
+                    ttft REAL,
+                    duration REAL,
+                    tokens_per_sec REAL,
+                    prompt_tokens INTEGER,
+                    completion_tokens INTEGER,
+                    cached_tokens INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_llm_calls_created ON llm_calls (created_at)')
+    # Background self-reflections on finished turns
+    c.execute('''CREATE TABLE IF NOT EXISTS reflections (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    conversation_id INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    plans INTEGER DEFAULT 0, -- improvement plans recorded to the diary
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
     # AI Diary & Evolution Log
     c.execute('''CREATE TABLE IF NOT EXISTS ai_evolution_log (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -332,6 +543,29 @@ def init_db():
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )''')
+    # In-flight agent turns of every worker (see run_registry.py)
+    c.execute('''CREATE TABLE IF NOT EXISTS runs (
+                    id TEXT PRIMARY KEY,
+                    worker TEXT,
+                    conversation_id INTEGER,
+                    channel TEXT,
+                    purpose TEXT,
+                    started_at REAL,
+                    step TEXT,
+                    step_started REAL,
+                    cancelled TEXT,
+                    heartbeat REAL
+                )''')
+    # Cross-worker cache invalidation and leases (see shared_state.py)
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_versions (
+                    name TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT,
+                    expires_at REAL
+                )''')
     conn.commit()
     conn.close()
 
@@ -342,6 +576,69 @@ else:
     # Ensure tables exist even if file exists
     init_db()
 
+def apply_runtime_settings(settings):
+    try:
+        llm_client.configure(
+            pool_size=max(1, int(settings['llm_pool_size'])) if settings.get('llm_pool_size') else None,
+            connect_timeout=float(settings['llm_connect_timeout']) if settings.get('llm_connect_timeout') else None,
+            read_timeout=float(settings['llm_read_timeout']) if settings.get('llm_read_timeout') else None,
+            # Some OpenAI-compatible servers reject stream_options; '0' turns it off
+            stream_usage=settings['llm_stream_usage'] != '0' if 'llm_stream_usage' in settings else None,
+            # Seconds without a first token before a duplicate request is sent (0/empty = off)
+            hedge_delay=float(settings.get('llm_hedge_delay') or 0),
+            hedge_budget=float(settings['llm_hedge_budget']) if settings.get('llm_hedge_budget') else None,
+        )
+    except ValueError:
+        print("Invalid LLM connection settings, ignoring.")
+
+    # Resource caps for stdio servers (POSIX only, apart from the Node heap
+    # limit); mcp_cpu_nice is a priority, not a cap. Running servers are
+    # recycled when these change
+    try:
+        mcp_manager.set_resource_limits({
+            'memory_mb': int(settings.get('mcp_max_memory_mb') or 0),
+            'cpu_seconds': int(settings.get('mcp_max_cpu_seconds') or 0),
+            'nice': int(settings.get('mcp_cpu_nice') or 0),
+        })
+        if settings.get('mcp_max_concurrency'):
+            mcp_manager.max_concurrency = max(1, int(settings['mcp_max_concurrency']))
+    except ValueError:
+        print("Invalid MCP resource limits in settings, ignoring.")
+
+    # turn_class_workers / turn_queue_limits: JSON objects keyed by priority
+    # class, e.g. {"group": 2}
+    try:
+        turn_scheduler.configure(
+            workers=int(settings['turn_workers']) if settings.get('turn_workers') else None,
+            class_workers=json.loads(settings.get('turn_class_workers') or '{}'),
+            queue_limits=json.loads(settings.get('turn_queue_limits') or '{}'),
+        )
+    except (ValueError, TypeError, AttributeError):
+        print("Invalid turn scheduler settings, ignoring.")
+
+def load_enabled_mcp_servers():
+    conn = get_db_connection()
+    servers = conn.execute('SELECT * FROM mcp_servers WHERE enabled = 1').fetchall()
+    conn.close()
+    return [dict(row) for row in servers if row['type'] in SUPPORTED_TYPES]
+
+def reload_runtime_settings():
+    conn = get_db_connection()
+    apply_runtime_settings({row['key']: row['value'] for row in conn.execute('SELECT * FROM settings').fetchall()})
+    conn.close()
+
+def reload_mcp_servers():
+    conn = get_db_connection()
+    rows = [dict(row) for row in conn.execute('SELECT * FROM mcp_servers').fetchall()]
+    conn.close()
+    mcp_manager.reconcile(rows)
+
+reload_runtime_settings()
+
+# Changes made by other worker processes
+shared_state.on_change('settings', reload_runtime_settings)
+shared_state.on_change('mcp_servers', reload_mcp_servers)
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -366,6 +663,10 @@ def update_settings():
         conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
     conn.commit()
     conn.close()
+    # The settings page saves one section at a time, so re-apply everything
+    # stored rather than just the posted keys
+    reload_runtime_settings()
+    shared_state.bump('settings')
     return jsonify({'status': 'success'})
 
 # --- Conversations API ---
@@ -391,6 +692,8 @@ def create_conversation():
 def delete_conversation(conversation_id):
     conn = get_db_connection()
     conn.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,))
+    conn.execute('DELETE FROM conversation_summaries WHERE conversation_id = ?', (conversation_id,))
+    conn.execute('DELETE FROM reflections WHERE conversation_id = ?', (conversation_id,))
     conn.commit()
     conn.close()
     return jsonify({'status': 'success'})
@@ -403,13 +706,133 @@ def get_messages(conversation_id):
     conn.close()
     return jsonify([dict(row) for row in messages])
 
+# --- LLM / Runs API ---
+@app.route('/api/llm/providers', methods=['GET'])
+def get_llm_providers():
+    conn = get_db_connection()
+    settings = {row['key']: row['value'] for row in conn.execute('SELECT * FROM settings')}
+    conn.close()
+    return jsonify(llm_client.provider_status(settings, request.args.get('task', 'interactive')))
+
+@app.route('/api/llm/hedging', methods=['GET'])
+def get_llm_hedging():
+    return jsonify(llm_client.hedging_status())
+
+@app.route('/api/turns/queue', methods=['GET'])
+def get_turn_queue():
+    """Running/queued turns, limits and admission wait times per priority class."""
+    return jsonify(turn_scheduler.stats())
+
+@app.route('/api/runs', methods=['GET'])
+def get_runs():
+    """In-flight agent turns: id, conversation, channel, start time and current step."""
+    return jsonify(RUNS.list())
+
+@app.route('/api/runs/<run_id>/cancel', methods=['POST'])
+def cancel_run(run_id):
+    """Stop a run now: its model stream, tool calls and child processes."""
+    if not RUNS.cancel(run_id):
+        return jsonify({'error': 'Run not found'}), 404
+    return jsonify({'status': 'cancelled', 'id': run_id})
+
+@app.route('/api/llm/cache_stats', methods=['GET'])
+def get_llm_cache_stats():
+    return jsonify(llm_client.cache_stats())
+
+TELEMETRY_GROUPS = {
+    'model': 'model',
+    'provider': 'provider',
+    'channel': 'channel',
+    'purpose': 'purpose',
+    'conversation': 'conversation_id',
+}
+
+@app.route('/api/llm/calls', methods=['GET'])
+def get_llm_calls():
+    """
+    LLM call telemetry for the last `hours` (default 24). With `group_by`
+    (comma-separated: model, provider, channel, purpose, conversation) returns
+    aggregates per group, otherwise the most recent `limit` calls.
+    """
+    try:
+        hours = float(request.args.get('hours', 24))
+        limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+    except ValueError:
+        return jsonify({'error': 'hours and limit must be numbers'}), 400
+    since = (datetime.datetime.utcnow() - datetime.timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+
+    conn = get_db_connection()
+    group_by = [g.strip() for g in request.args.get('group_by', '').split(',') if g.strip()]
+    if not group_by:
+        rows = conn.execute('SELECT * FROM llm_calls WHERE created_at >= ? ORDER BY id DESC LIMIT ?',
+                            (since, limit)).fetchall()
+        conn.close()
+        return jsonify([dict(row) for row in rows])
+
+    unknown = [g for g in group_by if g not in TELEMETRY_GROUPS]
+    if unknown:
+        conn.close()
+        return jsonify({'error': f"Unknown group_by: {', '.join(unknown)}"}), 400
+    columns = ', '.join(TELEMETRY_GROUPS[g] for g in group_by)
+    rows = conn.execute(f'''
+        SELECT {columns},
+               COUNT(*) AS calls,
+               AVG(ttfb) AS avg_ttfb,
+               AVG(ttft) AS avg_ttft,
+               MAX(ttft) AS max_ttft,
+               AVG(duration) AS avg_duration,
+               AVG(tokens_per_sec) AS avg_tokens_per_sec,
+               SUM(prompt_tokens) AS prompt_tokens,
+               SUM(completion_tokens) AS completion_tokens,
+               SUM(cached_tokens) AS cached_tokens
+        FROM llm_calls
+        WHERE created_at >= ?
+        GROUP BY {columns}
+        ORDER BY calls DESC
+        LIMIT ?
+    ''', (since, limit)).fetchall()
+    conn.close()
+    return jsonify([dict(row) for row in rows])
+
 # --- MCP Servers API ---
 @app.route('/api/mcp_servers', methods=['GET'])
 def get_mcp_servers():
     conn = get_db_connection()
     servers = conn.execute('SELECT * FROM mcp_servers ORDER BY created_at DESC').fetchall()
     conn.close()
-    return jsonify([dict(row) for row in servers])
+    result = []
+    for row in servers:
+        server = dict(row)
+        server['status'] = mcp_manager.get_status(server['id'])
+        result.append(server)
+    return jsonify(result)
+
+@app.route('/api/mcp_servers/status', methods=['GET'])
+def get_mcp_servers_status():
+    conn = get_db_connection()
+    servers = conn.execute('SELECT id, name, enabled FROM mcp_servers').fetchall()
+    conn.close()
+    result = {}
+    for row in servers:
+        status = mcp_manager.get_status(row['id'])
+        status['name'] = row['name']
+        status['enabled'] = bool(row['enabled'])
+        result[row['id']] = status
+    return jsonify(result)
+
+def parse_max_concurrency(value):
+    """Per-server concurrency limit from a request: None (use the default) or an int >= 1."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError("max_concurrency must be an integer >= 1")
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("max_concurrency must be an integer >= 1")
+    if limit != float(value) or limit < 1:
+        raise ValueError("max_concurrency must be an integer >= 1")
+    return limit
 
 @app.route('/api/mcp_servers', methods=['POST'])
 def add_mcp_server():
@@ -419,11 +842,15 @@ def add_mcp_server():
     
     if not name or not server_type:
         return jsonify({'error': 'Name and type are required'}), 400
+    try:
+        max_concurrency = parse_max_concurrency(data.get('max_concurrency'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     conn = get_db_connection()
-    conn.execute('''
-        INSERT INTO mcp_servers (name, type, command, args, env, url, enabled)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
+    cursor = conn.execute('''
+        INSERT INTO mcp_servers (name, type, command, args, env, url, enabled, max_concurrency)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
     ''', (
         name,
         server_type,
@@ -431,10 +858,17 @@ def add_mcp_server():
         json.dumps(data.get('args', [])),
         json.dumps(data.get('env', {})),
         data.get('url'),
-        1 # enabled by default
+        1, # enabled by default
+        max_concurrency
     ))
     conn.commit()
+    new_server = dict(conn.execute('SELECT * FROM mcp_servers WHERE id = ?', (cursor.lastrowid,)).fetchone())
     conn.close()
+
+    # Build the tool catalog now so the first chat turn doesn't have to
+    if new_server['type'] in SUPPORTED_TYPES:
+        mcp_manager.refresh_in_background(new_server)
+    shared_state.bump('mcp_servers')
     return jsonify({'status': 'success'})
 
 @app.route('/api/mcp_servers/<int:server_id>', methods=['PUT'])
@@ -469,10 +903,18 @@ def update_mcp_server(server_id):
         
     url = data.get('url', existing_dict['url'])
     enabled = data.get('enabled', existing_dict['enabled'])
+    if 'max_concurrency' in data:
+        try:
+            max_concurrency = parse_max_concurrency(data['max_concurrency'])
+        except ValueError as e:
+            conn.close()
+            return jsonify({'error': str(e)}), 400
+    else:
+        max_concurrency = existing_dict['max_concurrency']
 
     conn.execute('''
         UPDATE mcp_servers 
-        SET name = ?, type = ?, command = ?, args = ?, env = ?, url = ?, enabled = ?
+        SET name = ?, type = ?, command = ?, args = ?, env = ?, url = ?, enabled = ?, max_concurrency = ?
         WHERE id = ?
     ''', (
         name,
@@ -482,10 +924,21 @@ def update_mcp_server(server_id):
         env,
         url,
         enabled,
+        max_concurrency,
         server_id
     ))
     conn.commit()
     conn.close()
+
+    # Recycle the pooled session so the next call picks up the new config,
+    # then rebuild its tool catalog in the background
+    mcp_manager.invalidate(server_id)
+    if enabled and server_type in SUPPORTED_TYPES:
+        conn = get_db_connection()
+        updated = dict(conn.execute('SELECT * FROM mcp_servers WHERE id = ?', (server_id,)).fetchone())
+        conn.close()
+        mcp_manager.refresh_in_background(updated)
+    shared_state.bump('mcp_servers')
     return jsonify({'status': 'success'})
 
 @app.route('/api/mcp_servers/<int:server_id>', methods=['DELETE'])
@@ -494,8 +947,48 @@ def delete_mcp_server(server_id):
     conn.execute('DELETE FROM mcp_servers WHERE id = ?', (server_id,))
     conn.commit()
     conn.close()
+    mcp_manager.invalidate(server_id)
+    mcp_manager.forget_tools(server_id)
+    shared_state.bump('mcp_servers')
     return jsonify({'status': 'success'})
 
+def get_enabled_mcp_server(server_id):
+    conn = get_db_connection()
+    row = conn.execute('SELECT * FROM mcp_servers WHERE id = ?', (server_id,)).fetchone()
+    conn.close()
+    if not row or not row['enabled'] or row['type'] not in SUPPORTED_TYPES:
+        return None
+    return dict(row)
+
+@app.route('/api/mcp_servers/<int:server_id>/resources', methods=['GET'])
+def list_mcp_resources(server_id):
+    server = get_enabled_mcp_server(server_id)
+    if not server:
+        return jsonify({'error': 'Server not found or disabled'}), 404
+    uri = request.args.get('uri')
+    try:
+        if uri:
+            content = mcp_manager.run_sync(mcp_manager.read_resource(server, uri), timeout=60)
+            return jsonify({'uri': uri, 'content': content})
+        resources = mcp_manager.run_sync(mcp_manager.list_resources(server), timeout=60)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify([{'uri': str(r.uri), 'name': r.name, 'description': r.description, 'mimeType': r.mimeType}
+                    for r in resources])
+
+@app.route('/api/mcp_servers/<int:server_id>/prompts', methods=['GET'])
+def list_mcp_prompts(server_id):
+    server = get_enabled_mcp_server(server_id)
+    if not server:
+        return jsonify({'error': 'Server not found or disabled'}), 404
+    try:
+        prompts = mcp_manager.run_sync(mcp_manager.list_prompts(server), timeout=60)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify([{'name': p.name, 'description': p.description,
+                     'arguments': [{'name': a.name, 'description': a.description, 'required': bool(a.required)} for a in p.arguments or []]}
+                    for p in prompts])
+
 @app.route('/api/mcp_servers/test', methods=['POST'])
 def test_mcp_server():
     data = request.json
@@ -511,48 +1004,72 @@ def test_mcp_server():
         'url': data.get('url')
     }
 
-    if server_type != 'stdio':
-        return jsonify({'status': 'error', 'message': 'Only stdio type is supported for testing currently.'})
+    if server_type not in SUPPORTED_TYPES:
+        return jsonify({'status': 'error', 'message': f'Unsupported server type: {server_type}'})
 
+    # Optional call_tool benchmark: {"tool": ..., "arguments": {...}, "iterations": N}
+    benchmark = data.get('benchmark') or {}
     try:
-        # Run a simple tool list command to verify connection
-        # We need to run this in an async loop
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        async def run_test():
-            command = server_config['command']
-            args = json.loads(server_config['args'])
-            if not isinstance(args, list):
-                raise ValueError("Args must be a list of strings (JSON Array).")
-                
-            env = json.loads(server_config['env'])
-            full_env = os.environ.copy()
-            full_env.update(env)
-
-            server_params = StdioServerParameters(
-                command=command,
-                args=args,
-                env=full_env
-            )
-            
-            async with stdio_client(server_params) as (read, write):
-                async with ClientSession(read, write) as session:
-                    await session.initialize()
-                    tools = await session.list_tools()
-                    return [t.name for t in tools.tools]
-
-        tool_names = loop.run_until_complete(run_test())
-        loop.close()
-        
+        iterations = min(max(int(benchmark.get('iterations') or 0), 0), 1000)
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'iterations must be a number'})
+
+    try:
+        # A throwaway, unpooled session (the config may not be saved yet)
+        # that also times each connection step
+        timeout = benchmark_timeout(iterations, mcp_manager.start_timeout)
+        report = async_loop.run_sync(benchmark_server(
+            server_config, benchmark.get('tool'), benchmark.get('arguments') or {}, iterations,
+            limits=mcp_manager.resource_limits), timeout=timeout)
+
+        tool_names = report['tools']
+        timings = report['timings']
         return jsonify({
             'status': 'success', 
             'message': f'Successfully connected! Found {len(tool_names)} tools: {", ".join(tool_names[:5])}{"..." if len(tool_names)>5 else ""}'
+                       f' (启动 {timings["spawn"]}ms, 初始化 {timings["initialize"]}ms, list_tools {timings["list_tools"]}ms)',
+            'timings': timings,
+            'call_tool': report.get('call_tool')
         })
         
+    except concurrent.futures.TimeoutError:
+        return jsonify({'status': 'error', 'message': f'Server did not answer within {timeout}s'}), 504
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.route('/api/mcp_servers/benchmark', methods=['POST'])
+def benchmark_mcp_servers():
+    """
+    Run the connection benchmark against every enabled server, one at a time
+    so they don't skew each other. Body (optional): {"tool", "arguments",
+    "iterations"}; the tool is only called on servers that have it. Each
+    result has a status: 'ok', 'error', or 'timeout' for a server that hung.
+    """
+    data = request.json or {}
+    try:
+        iterations = min(max(int(data.get('iterations') or 0), 0), 1000)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'iterations must be a number'}), 400
+
+    results = []
+    timeout = benchmark_timeout(iterations, mcp_manager.start_timeout)
+    for server in load_enabled_mcp_servers():
+        try:
+            report = async_loop.run_sync(benchmark_server(
+                server, data.get('tool'), data.get('arguments') or {}, iterations,
+                limits=mcp_manager.resource_limits), timeout=timeout)
+            if 'error' in (report.get('call_tool') or {}):
+                report.pop('call_tool')
+            report.pop('tools')
+            report['status'] = 'ok'
+        except concurrent.futures.TimeoutError:
+            # A hung server is reported and skipped, the others still run
+            report = {'status': 'timeout', 'error': f'Server did not answer within {timeout}s'}
+        except Exception as e:
+            report = {'status': 'error', 'error': str(e)}
+        results.append(dict(report, id=server['id'], name=server['name']))
+    return jsonify(results)
+
 # --- Skills API ---
 @app.route('/api/skills', methods=['GET'])
 def get_skills():
@@ -666,61 +1183,41 @@ def delete_skill(filename):
 
 # --- MCP Client Logic ---
 async def run_mcp_tool(server_config, tool_name, tool_args):
-    # This is a simplified implementation that only supports stdio for now
-    # and creates a new connection for each tool call (not efficient but safe)
-    if server_config['type'] != 'stdio':
-        return f"Error: Only stdio MCP servers are supported in this demo. (Server: {server_config['name']})"
-
-    command = server_config['command']
-    args = json.loads(server_config['args'])
-    env = json.loads(server_config['env'])
-    
-    # Merge current env with provided env
-    full_env = os.environ.copy()
-    full_env.update(env)
-
-    server_params = StdioServerParameters(
-        command=command,
-        args=args,
-        env=full_env
-    )
+    # Sessions (stdio processes or sse connections) are pooled per
+    # mcp_servers row by mcp_manager and reused across turns and channels.
+    if server_config['type'] not in SUPPORTED_TYPES:
+        return f"Error: Unsupported MCP server type '{server_config['type']}'. (Server: {server_config['name']})"
 
     try:
-        async with stdio_client(server_params) as (read, write):
-            async with ClientSession(read, write) as session:
-                await session.initialize()
-                
-                # Call the tool
-                result: CallToolResult = await session.call_tool(tool_name, tool_args)
-                
-                # Format result
-                output = []
-                for content in result.content:
-                    if isinstance(content, TextContent):
-                        output.append(content.text)
-                    else:
-                        output.append(str(content)) # Fallback for image/embedded
-                
-                return "\n".join(output)
-                
+        return await mcp_manager.run(mcp_manager.call_tool(server_config, tool_name, tool_args))
     except Exception as e:
         return f"Error calling MCP tool: {str(e)}"
 
 # Helper to get tool schema from all servers
-async def get_all_mcp_tools():
+def load_mcp_catalog():
+    """
+    Enabled servers with their cached tool lists (None where the catalog has
+    no usable entry), the servers that need discovery and the discovery
+    timeout. Reads the database, so async callers run it in a thread.
+    """
     conn = get_db_connection()
     servers = conn.execute('SELECT * FROM mcp_servers WHERE enabled = 1').fetchall()
+    row = conn.execute("SELECT value FROM settings WHERE key='mcp_discovery_timeout'").fetchone()
     conn.close()
+
+    try:
+        discovery_timeout = float(row['value']) if row and row['value'] else 10.0
+    except ValueError:
+        discovery_timeout = 10.0
     
-    all_tools = []
-    server_map = {} # Map tool name to server config for execution later
+    server_tools = [] # (server_dict, tools) in server order
+    missing = [] # servers without a usable catalog entry
     
     for server in servers:
         server_dict = dict(server)
-        if server_dict['type'] != 'stdio': continue # Skip non-stdio for now
+        if server_dict['type'] not in SUPPORTED_TYPES: continue
 
-        try:
-            command = server_dict['command']
+        if server_dict['type'] == 'stdio':
             try:
                 args = json.loads(server_dict['args'])
                 if not isinstance(args, list):
@@ -729,84 +1226,1127 @@ async def get_all_mcp_tools():
             except:
                 print(f"Skipping server {server_dict['name']}: Invalid JSON args.")
                 continue
-                
-            env = json.loads(server_dict['env'])
-            full_env = os.environ.copy()
-            full_env.update(env)
-
-            server_params = StdioServerParameters(
-                command=command,
-                args=args,
-                env=full_env
-            )
 
-            async with stdio_client(server_params) as (read, write):
-                async with ClientSession(read, write) as session:
-                    await session.initialize()
-                    tools_result = await session.list_tools()
-                    
-                    for tool in tools_result.tools:
-                        # Convert MCP tool schema to OpenAI tool schema
-                        openai_tool = {
-                            "type": "function",
-                            "function": {
-                                "name": tool.name,
-                                "description": tool.description,
-                                "parameters": tool.inputSchema
-                            }
-                        }
-                        all_tools.append(openai_tool)
-                        server_map[tool.name] = server_dict
-                        
-        except Exception as e:
-            print(f"Error listing tools for server {server_dict['name']}: {e}")
-            
-    return all_tools, server_map
-
-@app.route('/api/qq/event', methods=['POST'])
-def qq_event():
-    data = request.json
-    # print(f"QQ Event: {json.dumps(data)}") # Debug
+        # Catalog lookup; only a server that was never listed (or whose
+        # config changed) is asked for its tools, which also warms its session
+        tools = mcp_manager.get_cached_tools(server_dict)
+        if tools is None:
+            missing.append(server_dict)
+        server_tools.append((server_dict, tools))
+    return server_tools, missing, discovery_timeout
 
-    # OneBot V11 Event Handling
-    post_type = data.get('post_type')
+async def get_all_mcp_tools():
+    server_tools, missing, discovery_timeout = await asyncio.to_thread(load_mcp_catalog)
+    if missing:
+        # Ask all uncached servers at once; a slow one is skipped for this turn
+        # (marked degraded) and merged into the catalog when it answers
+        discovered = await mcp_manager.run(mcp_manager.discover_tools(missing, discovery_timeout))
+        server_tools = [(server_dict, tools if tools is not None else discovered.get(server_dict['id']))
+                        for server_dict, tools in server_tools]
     
-    # 1. Message Event
-    if post_type == 'message':
-        message_type = data.get('message_type') # private / group
-        user_id = data.get('user_id')
-        group_id = data.get('group_id')
-        raw_message = data.get('raw_message', '')
-        
-        # Filter self messages? OneBot usually doesn't send self messages unless configured.
-        
-        # Async processing
-        threading.Thread(target=process_qq_message_thread, 
-                        args=(message_type, user_id, group_id, raw_message)).start()
-                        
-    # 2. Meta Event (Heartbeat) - Ignore
+    all_tools = []
+    server_map = {} # Map tool name to server config for execution later
     
-    return jsonify({"status": "ok"})
+    for server_dict, tools in server_tools:
+        for openai_tool in tools or []:
+            all_tools.append(openai_tool)
+            server_map[openai_tool['function']['name']] = server_dict
 
-def process_qq_message_thread(message_type, user_id, group_id, raw_message):
-    with app.app_context():
+    # Sorted so the tools block is byte-identical across turns (prompt caching)
+    all_tools.sort(key=lambda t: t['function']['name'])
+    return all_tools, server_map
+
+# --- Prompt Assembly ---
+# Providers cache prompts by prefix (DeepSeek, OpenAI-compatible prefix caches).
+# The system message therefore only holds text that stays byte-identical
+# across turns (system_prompt.md + skills); time and memory go in a context
+# message next to the newest user message.
+def load_system_prompt():
+    system_prompt_path = os.path.join(DATA_DIR, 'system_prompt.md')
+    if os.path.exists(system_prompt_path):
         try:
-            # Load settings
+            with open(system_prompt_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except Exception as e:
+            print(f"Error reading system prompt: {e}")
+    return ""
+
+def build_volatile_context():
+    """Current time and 1052 Protocol memory, rebuilt every turn."""
+    now = datetime.datetime.now()
+    try:
+        # Use local system time with offset
+        if time.localtime().tm_isdst and time.daylight:
+            offset_sec = -time.altzone
+        else:
+            offset_sec = -time.timezone
+        offset_hours = offset_sec / 3600
+        sign = '+' if offset_hours >= 0 else ''
+        tz_str = f"UTC{sign}{int(offset_hours)}"
+    except:
+        tz_str = "Local System Time"
+
+    context = f"Current System Time: {now.strftime('%Y-%m-%d %H:%M:%S')} ({now.strftime('%A')})\n"
+    context += f"System Timezone: {tz_str}\n"
+
+    try:
+        mem_data = protocol_brain.get_memory_json()
+        preferences = mem_data.get('preferences', {})
+        basic = mem_data.get('basic', {})
+
+        context += f"\n## 1052 Protocol Memory Context\n"
+        context += f"- **User Nickname**: {basic.get('nickname')}\n"
+        context += f"- **Talk Style**: {preferences.get('talk_style')}\n"
+
+        custom_prefs = preferences.get('custom', {})
+        if custom_prefs:
+            context += "- **Custom Preferences**:\n"
+            for k, v in custom_prefs.items():
+                context += f"  - {k}: {v}\n"
+    except Exception as e:
+        print(f"Failed to inject memory context: {e}")
+    return context
+
+# --- LLM Telemetry ---
+def record_llm_call(response, usage, channel, conversation_id=None, purpose='chat'):
+    """
+    Count prompt-cache usage and log one chat-completions call to llm_calls.
+    Call it once the response has been read to the end.
+    """
+    llm_client.record_usage(usage)
+    usage = usage or {}
+    timings = response.timings()
+    completion_tokens = usage.get('completion_tokens')
+    tokens_per_sec = None
+    if completion_tokens:
+        # Generation speed after the first token (whole call when not streamed)
+        generating = timings['duration'] - timings['ttft']
+        tokens_per_sec = completion_tokens / (generating if generating > 0 else timings['duration'])
+    try:
+        conn = get_db_connection()
+        conn.execute('''INSERT INTO llm_calls (conversation_id, channel, purpose, provider, model, ttfb, ttft,
+                        duration, tokens_per_sec, prompt_tokens, completion_tokens, cached_tokens)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                     (conversation_id, channel, purpose, response.provider['name'], response.provider['model'],
+                      timings['ttfb'], timings['ttft'], timings['duration'], tokens_per_sec,
+                      usage.get('prompt_tokens'), completion_tokens,
+                      llm_client.cached_tokens(usage) if usage else None))
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as e:
+        print(f"Failed to record LLM call: {e}")
+
+# --- Conversation Summaries ---
+# Older parts of long conversations are folded into one summary per
+# conversation. `watermark` is the id of the last message it covers; turns send
+# summary + the messages after it. Updates run as background jobs on
+# turn_scheduler, behind interactive turns.
+SUMMARY_JOBS = set() # conversation ids with an update in flight
+SUMMARY_JOBS_LOCK = threading.Lock()
+
+def load_summary(conn, conversation_id):
+    row = conn.execute('SELECT summary, watermark FROM conversation_summaries WHERE conversation_id = ?',
+                       (conversation_id,)).fetchone()
+    return (row['summary'], row['watermark']) if row else (None, 0)
+
+def maybe_update_summary(conversation_id, settings, pending):
+    """
+    Start a background summary update when more than summary_trigger_messages
+    (default 40) messages sit after the watermark. AgentTurn calls it once the
+    answer is stored; never blocks the caller.
+    """
+    if settings.get('enable_summaries', 'true') != 'true':
+        return
+    try:
+        trigger = int(settings.get('summary_trigger_messages') or 40)
+    except ValueError:
+        trigger = 40
+    if pending <= trigger:
+        return
+    with SUMMARY_JOBS_LOCK:
+        if conversation_id in SUMMARY_JOBS:
+            return
+        SUMMARY_JOBS.add(conversation_id)
+    try:
+        turn_scheduler.submit('background', update_summary, conversation_id, dict(settings))
+    except QueueFull as e:
+        print(f"Postponing summary update for conversation {conversation_id}: {e}")
+        with SUMMARY_JOBS_LOCK:
+            SUMMARY_JOBS.discard(conversation_id)
+
+def update_summary(conversation_id, settings):
+    """
+    Fold the messages after the watermark, except the newest
+    summary_keep_recent (default 20), into the conversation's summary.
+    A long backlog is folded in batches of at most summary_batch_messages
+    (default 100) / summary_batch_tokens (default 6000), moving the watermark
+    after each one, so the prompt stays within the model's context.
+    """
+    try:
+        try:
+            keep_recent = int(settings.get('summary_keep_recent') or 20)
+            batch_messages = max(1, int(settings.get('summary_batch_messages') or 100))
+            batch_tokens = max(1, int(settings.get('summary_batch_tokens') or 6000))
+        except ValueError:
+            keep_recent, batch_messages, batch_tokens = 20, 100, 6000
+
+        if not llm_client.providers(settings, 'summarization'):
+            return
+
+        conn = get_db_connection()
+        # Messages from the first of the newest keep_recent on stay verbatim
+        first_kept = None
+        if keep_recent:
+            row = conn.execute('SELECT id FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+                               (conversation_id, keep_recent - 1)).fetchone()
+            if row is None:
+                conn.close()
+                return
+            first_kept = row['id']
+        conn.close()
+
+        while True:
             conn = get_db_connection()
-            settings = {row['key']: row['value'] for row in conn.execute('SELECT * FROM settings')}
+            summary, watermark = load_summary(conn, conversation_id)
+            rows = conn.execute('SELECT id, role, content FROM messages WHERE conversation_id = ? AND id > ? '
+                                'AND (? IS NULL OR id < ?) ORDER BY id ASC LIMIT ?',
+                                (conversation_id, watermark, first_kept, first_kept, batch_messages)).fetchall()
             conn.close()
-            
-            http_api = settings.get('qq_http_api')
-            access_token = settings.get('qq_access_token')
-            secret = settings.get('qq_secret')
-            
-            if not http_api:
-                print("QQ HTTP API URL not configured.")
+            if not rows:
                 return
 
-            bot = QQBot(http_api, access_token, secret)
-            
-            # Identify Conversation
+            lines, tokens = [], estimate_tokens(summary or '')
+            for row in rows:
+                line = f"[{row['role']}] {elide_text(row['content'] or '', 500)}"
+                tokens += estimate_tokens(line)
+                if lines and tokens > batch_tokens:
+                    break
+                lines.append(line)
+            rows = rows[:len(lines)]
+
+            transcript = "\n".join(lines)
+            prompt = ("Update the running summary of a conversation between a user and an AI assistant. "
+                      "Keep facts, decisions, user preferences, open tasks and anything later turns may refer to; "
+                      "drop small talk. Write in the conversation's language, at most about 400 words. "
+                      "Reply with the summary only.\n\n"
+                      f"## Current summary\n{summary or '(none)'}\n\n## New messages\n{transcript}")
+            payload = {'messages': [{'role': 'user', 'content': prompt}], 'stream': False}
+
+            response = llm_client.chat(settings, payload, task='summarization')
+            response.raise_for_status()
+            res_json = response.json()
+            record_llm_call(response, res_json.get('usage'), 'system', conversation_id, purpose='summary')
+            new_summary = (res_json['choices'][0]['message'].get('content') or '').strip()
+            if not new_summary:
+                return
+
+            conn = get_db_connection()
+            # Only move forward, in case another writer got there first
+            cursor = conn.execute('''INSERT INTO conversation_summaries (conversation_id, summary, watermark, updated_at)
+                            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                            ON CONFLICT(conversation_id) DO UPDATE SET
+                                summary = excluded.summary, watermark = excluded.watermark, updated_at = excluded.updated_at
+                            WHERE excluded.watermark > conversation_summaries.watermark''',
+                         (conversation_id, new_summary, rows[-1]['id']))
+            conn.commit()
+            conn.close()
+            if not cursor.rowcount:
+                return
+            print(f"Conversation {conversation_id}: summarized {len(rows)} messages (up to message {rows[-1]['id']}).")
+    except Exception as e:
+        print(f"Failed to update summary for conversation {conversation_id}: {e}")
+    finally:
+        with SUMMARY_JOBS_LOCK:
+            SUMMARY_JOBS.discard(conversation_id)
+
+# --- Background Reflection ---
+# Self-reflection runs after the answer is saved, on a small worker pool, so it
+# never holds the user's response open. Results go to the reflections table and
+# reach the web UI through a long-poll endpoint. When too many reflections are
+# already waiting, new ones are skipped (load shedding).
+REFLECTION_PROMPT = (
+    "You have just completed a task for the user. Now, engage in **Self-Reflection**.\n"
+    "1. Analyze your performance: Did you satisfy the user's intent? Was there anything missing?\n"
+    "2. Identify gaps: Do you lack any skills or knowledge to do this better?\n"
+    "3. **Self-Improvement**: If you identify a missing skill, use `record_improvement_plan` to write it down into your diary. It will be automatically implemented tonight.\n"
+    "4. Output your thoughts concisely."
+)
+REFLECTION_PENDING = 0 # queued + running reflection jobs, changed under REFLECTION_CONDITION
+REFLECTION_CONDITION = threading.Condition() # notified when a reflection is saved
+
+def latest_reflection_id(conversation_id):
+    conn = get_db_connection()
+    row = conn.execute('SELECT MAX(id) AS id FROM reflections WHERE conversation_id = ?', (conversation_id,)).fetchone()
+    conn.close()
+    return row['id'] or 0
+
+def submit_reflection(conversation_id, messages, answer, tools, settings, channel='web'):
+    """
+    Queue a reflection on the finished turn. Returns False when it was shed
+    because reflection_max_pending (default 2) jobs are already waiting.
+    """
+    global REFLECTION_PENDING
+    try:
+        max_pending = int(settings.get('reflection_max_pending') or 2)
+    except ValueError:
+        max_pending = 2
+    with REFLECTION_CONDITION:
+        if REFLECTION_PENDING >= max_pending:
+            print(f"Reflection queue busy ({REFLECTION_PENDING} pending), skipping reflection "
+                  f"for conversation {conversation_id}.")
+            return False
+        REFLECTION_PENDING += 1
+    # Web turns stream the answer without appending it to their messages
+    if answer is not None:
+        messages = messages + [{'role': 'assistant', 'content': answer}]
+    messages = messages + [{'role': 'system', 'content': REFLECTION_PROMPT}]
+    plan_tools = [t for t in tools or [] if t['function']['name'] == 'record_improvement_plan']
+    try:
+        turn_scheduler.submit('background', run_reflection, conversation_id, messages, plan_tools,
+                              dict(settings), channel)
+    except QueueFull as e:
+        print(f"Skipping reflection for conversation {conversation_id}: {e}")
+        with REFLECTION_CONDITION:
+            REFLECTION_PENDING -= 1
+        return False
+    return True
+
+def run_reflection(conversation_id, messages, tools, settings, channel):
+    global REFLECTION_PENDING
+    try:
+        payload = {'messages': messages, 'stream': False}
+        if tools:
+            payload['tools'] = tools
+            payload['tool_choice'] = 'auto'
+        response = llm_client.chat(settings, payload, task='reflection')
+        response.raise_for_status()
+        res_json = response.json()
+        record_llm_call(response, res_json.get('usage'), channel, conversation_id, purpose='reflection')
+        message = res_json['choices'][0]['message']
+
+        plans = 0
+        for tool_call in message.get('tool_calls') or []:
+            if tool_call['function']['name'] != 'record_improvement_plan':
+                continue
+            try:
+                args = json.loads(tool_call['function'].get('arguments') or '{}')
+            except json.JSONDecodeError:
+                continue
+            print(execute_tool_call('record_improvement_plan', args, {}, conversation_id))
+            plans += 1
+
+        content = (message.get('content') or '').strip()
+        if not content and not plans:
+            return
+        conn = get_db_connection()
+        conn.execute('INSERT INTO reflections (conversation_id, content, plans) VALUES (?, ?, ?)',
+                     (conversation_id, content, plans))
+        conn.commit()
+        conn.close()
+        # Wakes long-polls waiting in other workers
+        shared_state.bump('reflections')
+    except Exception as e:
+        print(f"Reflection failed for conversation {conversation_id}: {e}")
+    finally:
+        with REFLECTION_CONDITION:
+            REFLECTION_PENDING -= 1
+            REFLECTION_CONDITION.notify_all()
+
+def reload_protocol_memory():
+    with PROTOCOL_LOCK:
+        protocol_brain.reload_memory()
+
+def notify_reflection_waiters():
+    with REFLECTION_CONDITION:
+        REFLECTION_CONDITION.notify_all()
+
+shared_state.on_change('reflections', notify_reflection_waiters)
+shared_state.on_change('protocol_memory', reload_protocol_memory)
+
+@app.route('/api/conversations/<int:conversation_id>/reflections', methods=['GET'])
+def get_reflections(conversation_id):
+    """
+    Reflections with id > `after`. With `wait` (seconds, at most 60) the call
+    blocks until one arrives or the wait ends, so the UI can long-poll.
+    """
+    try:
+        after = int(request.args.get('after', 0))
+        wait = min(float(request.args.get('wait', 0)), 60)
+    except ValueError:
+        return jsonify({'error': 'after and wait must be numbers'}), 400
+
+    def fetch():
+        conn = get_db_connection()
+        rows = conn.execute('SELECT * FROM reflections WHERE conversation_id = ? AND id > ? ORDER BY id ASC',
+                            (conversation_id, after)).fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
+
+    reflections = fetch()
+    deadline = time.time() + wait
+    while not reflections and time.time() < deadline:
+        with REFLECTION_CONDITION:
+            REFLECTION_CONDITION.wait(timeout=deadline - time.time())
+        reflections = fetch()
+    return jsonify(reflections)
+
+# --- Context Window ---
+def estimate_tokens(text):
+    """Rough token count without a tokenizer: ~1 token per CJK character, ~4 characters per token otherwise."""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af' or '\uff00' <= ch <= '\uffef')
+    return cjk + (len(text) - cjk + 3) // 4 + 4 # + per-message overhead
+
+def get_context_budget(settings, model):
+    """Token budget for one request: per-model override from context_budgets (JSON), else context_token_budget."""
+    try:
+        budgets = json.loads(settings.get('context_budgets') or '{}')
+        if model in budgets:
+            return int(budgets[model])
+        return int(settings.get('context_token_budget') or 32000)
+    except (ValueError, TypeError):
+        return 32000
+
+# History is cut in steps of this many messages (load_history, fit_history)
+HISTORY_CUT_STEP = 10
+
+def load_history(conn, conversation_id, settings):
+    """
+    Load the conversation's summary and its newest unsummarized messages in one
+    bounded query (context_max_messages rows, default 200). The window starts
+    on a multiple of HISTORY_CUT_STEP, like fit_history's cut, so it doesn't
+    slide (and change the prompt prefix) on every turn; it may hold up to
+    HISTORY_CUT_STEP - 1 extra rows. Returns (messages oldest-first, count of
+    messages after the summary, summary or None).
+    """
+    try:
+        limit = max(1, int(settings.get('context_max_messages') or 200))
+    except ValueError:
+        limit = 200
+    rows = conn.execute('''
+        SELECT role, content, total, summary FROM (
+            SELECT m.id, m.role, m.content, s.summary, COUNT(*) OVER () AS total,
+                   ROW_NUMBER() OVER (ORDER BY m.id) AS position
+            FROM messages m
+            LEFT JOIN conversation_summaries s ON s.conversation_id = m.conversation_id
+            WHERE m.conversation_id = ? AND m.id > COALESCE(s.watermark, 0)
+        )
+        WHERE position > MAX(total - ?, 0) / ? * ?
+        ORDER BY id
+    ''', (conversation_id, limit, HISTORY_CUT_STEP, HISTORY_CUT_STEP)).fetchall()
+    total = rows[0]['total'] if rows else 0
+    summary = rows[0]['summary'] if rows else None
+    return [{'role': row['role'], 'content': row['content']} for row in rows], total, summary
+
+def elide_text(text, max_tokens):
+    """Keep the head and tail of an oversized message."""
+    chars_per_token = len(text) / max(estimate_tokens(text), 1)
+    keep = max(int(max_tokens * chars_per_token * 0.9), 200) # characters
+    if len(text) <= keep:
+        return text
+    head, tail = text[:keep * 2 // 3], text[-(keep // 3):]
+    return f"{head}\n\n[... 已省略 {len(text) - len(head) - len(tail)} 字 ...]\n\n{tail}"
+
+def fit_history(history, total, budget, reserved=0, step=HISTORY_CUT_STEP):
+    """
+    Drop the oldest messages until history fits `budget - reserved` tokens.
+    The latest turn (newest user message and everything after it) is always
+    kept; oversized messages in it are elided instead. The cut point only moves
+    in steps of `step` messages, so the prompt prefix stays cacheable for
+    several turns, and never leaves tool results without their call. Returns
+    (kept messages, report or None if nothing was cut).
+    """
+    available = max(budget - reserved, 0)
+    offset = total - len(history) # older messages the query didn't load
+    last_user = max((i for i, msg in enumerate(history) if msg['role'] == 'user'), default=max(len(history) - 1, 0))
+
+    elided = 0
+    latest_turn = history[last_user:]
+    per_message = max(available // max(len(latest_turn), 1), 200)
+    for msg in latest_turn:
+        if estimate_tokens(msg['content']) > per_message:
+            msg['content'] = elide_text(msg['content'], per_message)
+            elided += 1
+
+    used = sum(estimate_tokens(msg['content']) for msg in history)
+    start = 0
+    while start < last_user and used > available:
+        used -= estimate_tokens(history[start]['content'])
+        start += 1
+    if start and step > 1:
+        # Round the cut up to an absolute multiple of `step`
+        aligned = -(-(offset + start) // step) * step - offset
+        while start < min(aligned, last_user):
+            used -= estimate_tokens(history[start]['content'])
+            start += 1
+    # Tool results go with the call that asked for them
+    while start < last_user and history[start]['role'] == 'tool':
+        used -= estimate_tokens(history[start]['content'])
+        start += 1
+
+    if not start and not offset and not elided:
+        return history, None
+    return history[start:], {
+        'dropped': offset + start,
+        'elided': elided,
+        'kept': len(history) - start,
+        'tokens': used + reserved,
+        'budget': budget,
+    }
+
+def build_messages(history, skills_description, with_context=True, budget=None, total=None, tools=None, summary=None):
+    """
+    Assemble the chat payload: stable system message, then history, with the
+    volatile context inserted just before the newest user message so the
+    prefix up to there is identical to the previous turn's.
+
+    With a token `budget`, older history is cut to fit (see fit_history).
+    `summary` (the rolling conversation summary) follows the system message.
+    Returns (messages, trim report or None).
+    """
+    system_prompt = load_system_prompt() or "You are 1052 AI."
+    messages = [{'role': 'system', 'content': system_prompt + "\n\n" + skills_description}]
+    if summary:
+        # Changes only when the background summarizer moves the watermark
+        messages.append({'role': 'system', 'content': "## Summary of the earlier conversation\n" + summary})
+    context_msg = {'role': 'system', 'content': build_volatile_context()} if with_context else None
+
+    trimmed = None
+    if budget:
+        reserved = sum(estimate_tokens(msg['content']) for msg in messages)
+        reserved += estimate_tokens(context_msg['content']) if context_msg else 0
+        reserved += estimate_tokens(json.dumps(tools, ensure_ascii=False)) if tools else 0
+        history, trimmed = fit_history(history, total if total is not None else len(history), budget, reserved)
+    messages.extend({'role': msg['role'], 'content': msg['content']} for msg in history)
+
+    if context_msg:
+        last_user = max((i for i, msg in enumerate(messages) if msg['role'] == 'user'), default=len(messages))
+        messages.insert(last_user, context_msg)
+    return messages, trimmed
+
+# --- Tool Execution ---
+def get_tool_concurrency(settings):
+    """Max number of tool calls from one assistant message that run at once."""
+    try:
+        return max(1, int(settings.get('tool_concurrency') or 4))
+    except ValueError:
+        return 4
+
+def execute_tool_call(func_name, func_args, server_map, conversation_id=None, enable_system_control=True,
+                      on_progress=None, cancel_event=None):
+    """
+    Execute one tool call requested by the model and return its result.
+    Shared by every channel; safe to call from worker threads.
+    MCP calls report progress through `on_progress` and are abandoned as soon
+    as `cancel_event` (a threading.Event) is set.
+    """
+    # Core tools that need it (like the scheduler) read the conversation from here
+    func_args.setdefault('_conversation_id', conversation_id)
+
+    core_result = execute_core_tool(func_name, func_args)
+    if core_result is not None:
+        return core_result
+
+    if func_name in server_map:
+        # _conversation_id is an internal hint for local tools, not part of the MCP schema
+        mcp_args = {k: v for k, v in func_args.items() if k != '_conversation_id'}
+        future = mcp_manager.submit(mcp_manager.call_tool(server_map[func_name], func_name, mcp_args,
+                                                         on_progress=on_progress, caller=conversation_id))
+        try:
+            while True:
+                try:
+                    return future.result(timeout=0.2)
+                except concurrent.futures.TimeoutError:
+                    if cancel_event is not None and cancel_event.is_set():
+                        future.cancel()
+                        return "Error: Tool call cancelled."
+        except Exception as e:
+            return f"Error calling MCP tool: {str(e)}"
+
+    if func_name == 'execute_skill_function':
+        try:
+            skill_name = func_args.get('skill_name')
+            file_name = func_args.get('file_name')
+            function_name = func_args.get('function_name')
+            kwargs = func_args.get('kwargs', {})
+
+            # Inject context
+            kwargs['_conversation_id'] = conversation_id
+
+            # Security Check
+            if skill_name == 'cmd_control' and not enable_system_control:
+                return "Error: System Control is disabled in settings. You cannot execute commands."
+            return skill_manager.execute_skill_function(skill_name, file_name, function_name, kwargs)
+        except Exception as e:
+            return f"Error executing skill: {str(e)}"
+
+    if func_name == 'protocol_remember':
+        try:
+            with PROTOCOL_LOCK, shared_state.lock():
+                # Start from what other workers saved
+                protocol_brain.reload_memory()
+                saved_path = protocol_brain.remember(func_args.get('key'), func_args.get('value'))
+            shared_state.bump('protocol_memory')
+            return f"Successfully remembered: {func_args.get('key')} = {func_args.get('value')}. Saved to {saved_path}"
+        except Exception as e:
+            return f"Error remembering: {str(e)}"
+
+    if func_name == 'protocol_learn_experience':
+        try:
+            with PROTOCOL_LOCK, shared_state.lock():
+                # Start from what other workers saved
+                protocol_brain.reload_memory()
+                saved_path = protocol_brain.learn_experience(func_args.get('problem'), func_args.get('solution'), func_args.get('tags'))
+            shared_state.bump('protocol_memory')
+            return f"Experience learned and saved to {saved_path}."
+        except Exception as e:
+            return f"Error learning experience: {str(e)}"
+
+    if func_name == 'protocol_recall_experience':
+        try:
+            results = protocol_brain.search_experience(func_args.get('query'))
+            if not results:
+                return "No relevant experiences found."
+            # Limit to top 3 to save tokens
+            return json.dumps(results[:3], ensure_ascii=False)
+        except Exception as e:
+            return f"Error recalling experience: {str(e)}"
+
+    if func_name == 'record_improvement_plan':
+        try:
+            content = func_args.get('content')
+            entry_type = func_args.get('type', 'plan')
+            conn = get_db_connection()
+            conn.execute('INSERT INTO ai_evolution_log (content, type, status) VALUES (?, ?, ?)', 
+                        (content, entry_type, 'pending' if entry_type == 'plan' else 'completed'))
+            conn.commit()
+            conn.close()
+            return f"Successfully recorded {entry_type} into diary."
+        except Exception as e:
+            return f"Error recording plan: {str(e)}"
+
+    return f"Error: Tool {func_name} not found."
+
+# Read-only, idempotent tools (the resource and prompt tools generated for MCP
+# servers are too). They may start while the model is still streaming the rest
+# of its message and run concurrently with each other; every other tool is a
+# barrier that runs alone, in message order
+EARLY_START_TOOLS = {'read_file', 'list_directory', 'get_file_info', 'protocol_recall_experience'}
+
+def is_early_start_tool(func_name, settings, server_map=None):
+    """
+    Resource/prompt tools count only when server_map routes them to the server
+    they were generated for; extra MCP tools can be allowed with the
+    early_start_tools setting (comma-separated names).
+    """
+    if func_name in EARLY_START_TOOLS:
+        return True
+    server = (server_map or {}).get(func_name)
+    if server is not None and is_resource_or_prompt_tool(server, func_name):
+        return True
+    extra = settings.get('early_start_tools') or ''
+    return func_name in {name.strip() for name in extra.split(',') if name.strip()}
+
+class ToolCallAssembler:
+    """
+    Rebuilds tool calls from streamed `tool_calls` deltas and tells when each
+    one is complete: a later index has started, or its arguments already
+    parse as a closed JSON object.
+    """
+    def __init__(self):
+        self.calls = {} # delta index -> {"id", "type", "function": {"name", "arguments"}}
+        self.complete = set()
+
+    def feed(self, deltas):
+        """Merge one chunk's deltas; returns the indices that just became complete."""
+        done = []
+        for delta in deltas:
+            index = delta['index']
+            function = delta.get('function') or {}
+            call = self.calls.get(index)
+            if call is None:
+                # The model writes calls in order, so a new one closes the earlier ones
+                done += [i for i in self.calls if i < index and i not in self.complete and i not in done]
+                self.calls[index] = {
+                    "id": delta.get("id"),
+                    "type": "function",
+                    "function": {
+                        "name": function.get("name", ""),
+                        "arguments": function.get("arguments", "")
+                    }
+                }
+            else:
+                call["function"]["name"] += function.get("name") or ""
+                call["function"]["arguments"] += function.get("arguments") or ""
+                if delta.get("id"):
+                    call["id"] = delta["id"]
+                if index in self.complete and function.get("arguments"):
+                    print(f"Tool call {index} got more arguments after it looked complete.")
+        for index in {delta['index'] for delta in deltas}:
+            if index not in self.complete and index not in done and self._closed(self.calls[index]):
+                done.append(index)
+        self.complete.update(done)
+        return done
+
+    def finish(self):
+        """The stream ended: every call is complete. Returns the ones that were not yet."""
+        done = [i for i in self.calls if i not in self.complete]
+        self.complete.update(done)
+        return done
+
+    def tool_calls(self):
+        return [self.calls[i] for i in sorted(self.calls)]
+
+    @staticmethod
+    def _closed(call):
+        arguments = call["function"]["arguments"].strip()
+        if not call["id"] or not call["function"]["name"] or not arguments.endswith('}'):
+            return False
+        try:
+            return isinstance(json.loads(arguments), dict)
+        except json.JSONDecodeError:
+            return False
+
+class ToolCallRunner:
+    """
+    Runs tool calls of one assistant message as they are submitted, each on a
+    worker thread (at most `max_workers` at once), and reports events:
+    ('start', key) when a call begins, ('progress', key, data) for progress it
+    reports and ('end', key, result) when it finishes. Callers keep results by
+    key so tool messages can still be appended in tool_call_id order.
+
+    Calls must be submitted in message order. An exclusive call (one that may
+    change state) waits for every call submitted before it, and calls
+    submitted after it wait for it to finish; the others run concurrently.
+
+    `run_call(call, report, cancel_event)` gets a `report(data)` callback and a
+    threading.Event that is set when the batch is abandoned.
+    Must be created inside a running event loop.
+    """
+    def __init__(self, run_call, max_workers):
+        self.run_call = run_call
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        self.cancel_event = threading.Event()
+        self.semaphore = asyncio.Semaphore(max(1, max_workers))
+        self.tasks = []
+        self.barrier = None # task of the last exclusive call
+        self.running = 0 # submitted calls whose 'end' event was not handed out yet
+
+    def _report(self, key, data):
+        # Called from the tool's worker thread
+        try:
+            self.loop.call_soon_threadsafe(self.events.put_nowait, ('progress', key, data))
+        except RuntimeError:
+            pass # the loop is gone; the turn was abandoned
+
+    async def _run(self, key, call, after):
+        if after:
+            await asyncio.wait(after)
+        async with self.semaphore:
+            self.events.put_nowait(('start', key))
+            try:
+                result = await asyncio.to_thread(self.run_call, call, lambda data: self._report(key, data),
+                                                 self.cancel_event)
+            except Exception as e:
+                result = f"Error executing tool: {str(e)}"
+            self.events.put_nowait(('end', key, result))
+
+    def submit(self, key, call, exclusive=False):
+        if exclusive:
+            after = list(self.tasks)
+        else:
+            after = [self.barrier] if self.barrier else []
+        self.running += 1
+        task = asyncio.ensure_future(self._run(key, call, after))
+        self.tasks.append(task)
+        if exclusive:
+            self.barrier = task
+
+    def _handed_out(self, event):
+        if event[0] == 'end':
+            self.running -= 1
+        return event
+
+    def poll(self):
+        """Events that are ready now, without waiting."""
+        while not self.events.empty():
+            yield self._handed_out(self.events.get_nowait())
+
+    async def drain(self, check_interrupt=None):
+        """
+        Yield events until every submitted call has finished.
+        `check_interrupt` is polled while waiting and may raise TaskInterrupted.
+        """
+        while self.running:
+            if check_interrupt:
+                check_interrupt()
+            try:
+                event = await asyncio.wait_for(self.events.get(), timeout=0.2)
+            except asyncio.TimeoutError:
+                continue
+            yield self._handed_out(event)
+
+    def close(self):
+        # Don't block an interrupted turn on calls that are still running;
+        # in-flight MCP calls see cancel_event and are abandoned
+        self.cancel_event.set()
+        for task in self.tasks:
+            task.cancel()
+
+# --- Agent Turn Engine ---
+class LLMResponseError(Exception):
+    """The model endpoint answered with an error status."""
+
+class AgentTurn:
+    """
+    One agent turn, shared by every channel: assemble the context, stream the
+    model, dispatch tool calls (read-only ones while the model is still
+    streaming), persist the answer and stop when a newer request arrives for
+    the same conversation. Channels are thin adapters over run(), an async
+    generator of events:
+
+        {'type': 'context_trimmed', ...budget report}
+        {'type': 'content', 'data': text}              streamed answer text
+        {'type': 'assistant_message', 'content', 'tool_calls'}  one model step done
+        {'type': 'tool_start' | 'tool_progress' | 'tool_end', 'id', 'tool', ...}
+        {'type': 'reflection_queued', 'after': id}     background reflection queued
+        {'type': 'error', 'content': text}             the turn stopped early
+        {'type': 'done', 'content': answer, 'finished': bool}
+
+    `messages` replaces the conversation history (e.g. auto-evolution);
+    without a conversation_id nothing is persisted and the turn can't be
+    interrupted.
+    """
+    def __init__(self, conversation_id, settings, channel, purpose='chat', task='interactive',
+                 messages=None, with_context=True, max_steps=None, exclude_tools=()):
+        self.conversation_id = conversation_id
+        self.settings = settings
+        self.channel = channel
+        self.purpose = purpose
+        self.task = task
+        self.messages = messages
+        self.with_context = with_context
+        self.max_steps = max_steps
+        self.exclude_tools = exclude_tools
+        # The model the task tier routes to (e.g. background_model for
+        # evolution); the history budget is sized for its context window
+        providers = llm_client.rank(llm_client.providers(settings, task))
+        self.model = providers[0]['model'] if providers else settings.get('model', 'deepseek-ai/DeepSeek-V3.2')
+        self.enable_system_control = settings.get('enable_system_control', 'true') == 'true'
+        self.tool_concurrency = get_tool_concurrency(settings)
+        self.tools = []
+        self.server_map = {}
+        self.history_total = None # messages after the summary watermark, when history was loaded
+        self.last_message = ("", [])
+        # Registered now so a newer request for the same conversation cancels
+        # this one even while it waits for a worker; evicted when it ends
+        self.run_entry = RUNS.start(conversation_id, channel, purpose)
+        weakref.finalize(self, RUNS.finish, self.run_entry)
+        # Hedge budget: per conversation, or per run for turns without one
+        # (evolution) so they don't spend each other's allowance
+        self.hedge_key = conversation_id if conversation_id is not None else f"{task}:{self.run_entry.id}"
+
+    def check_interrupt(self):
+        if self.run_entry.cancelled:
+            raise TaskInterrupted(self.run_entry.cancelled)
+
+    def close(self):
+        RUNS.finish(self.run_entry)
+
+    async def _prepare(self):
+        """Tools, skills and (unless messages were given) the budgeted history."""
+        try:
+            mcp_tools, self.server_map = await get_all_mcp_tools()
+        except Exception as e:
+            print(f"MCP tool discovery failed: {e}")
+            mcp_tools, self.server_map = [], {}
+        self.tools = build_tools(mcp_tools, self.exclude_tools)
+        if self.messages is not None:
+            return None
+        return await asyncio.to_thread(self._load_context)
+
+    def _load_context(self):
+        skill_manager.load_skills()
+        skills_description = skill_manager.get_all_skills_description()
+        conn = get_db_connection()
+        history, self.history_total, summary = load_history(conn, self.conversation_id, self.settings)
+        conn.close()
+        # Stable system prefix first, time/memory context next to the newest
+        # user message; older history is cut to the model's token budget
+        self.messages, trimmed = build_messages(history, skills_description, with_context=self.with_context,
+                                                budget=get_context_budget(self.settings, self.model),
+                                                total=self.history_total, tools=self.tools, summary=summary)
+        return trimmed
+
+    def _parse_tool_call(self, tool_call):
+        try:
+            func_args = json.loads(tool_call['function']['arguments'])
+        except:
+            func_args = {}
+        # Inject conversation_id for core tools that need it (like scheduler)
+        func_args['_conversation_id'] = self.conversation_id
+        return tool_call['function']['name'], func_args
+
+    def _run_call(self, call, report, cancel_event):
+        return execute_tool_call(call[0], call[1], self.server_map, self.conversation_id,
+                                 self.enable_system_control, on_progress=report, cancel_event=cancel_event)
+
+    def _save_answer(self, content):
+        if self.conversation_id is None:
+            return
+        conn = get_db_connection()
+        conn.execute('INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)',
+                     (self.conversation_id, 'assistant', content))
+        conn.commit()
+        conn.close()
+
+    async def run(self):
+        # The turn runs as its own task so cancelling the run stops whatever
+        # it is awaiting (the model stream, tool calls) without touching the
+        # caller's task
+        events = asyncio.Queue()
+        task = asyncio.ensure_future(self._pump(events))
+        loop = asyncio.get_running_loop()
+        remove = self.run_entry.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            remove()
+            task.cancel()
+            self.close()
+
+    async def _pump(self, events):
+        current_run.set(self.run_entry) # inherited by tool threads (child processes)
+        try:
+            async for event in self._events():
+                events.put_nowait(event)
+        finally:
+            events.put_nowait(None)
+
+    async def _events(self):
+        full_content = ""
+        finished = False
+        try:
+            self.check_interrupt()
+            self.run_entry.set_step('context')
+            trimmed = await self._prepare()
+            if trimmed:
+                yield {"type": "context_trimmed", **trimmed}
+
+            step = 0
+            while self.max_steps is None or step < self.max_steps:
+                step += 1
+                self.check_interrupt()
+                self.run_entry.set_step(f'model (step {step})')
+                async for event in self._step():
+                    yield event
+                full_content, tool_calls = self.last_message
+                if not tool_calls:
+                    # No tool calls, we are done. Save the answer
+                    await asyncio.to_thread(self._save_answer, full_content)
+                    finished = True
+                    break
+
+            # Fold a long backlog into the summary once the answer is stored
+            if finished and self.conversation_id is not None and self.history_total is not None:
+                maybe_update_summary(self.conversation_id, self.settings, self.history_total + 1)
+
+            # Self-reflection runs as a background job once the answer is saved
+            if finished and self.purpose == 'chat' and self.settings.get('enable_self_reflection') == 'true':
+                after = await asyncio.to_thread(latest_reflection_id, self.conversation_id)
+                if submit_reflection(self.conversation_id, self.messages, full_content, self.tools,
+                                     self.settings, self.channel):
+                    yield {"type": "reflection_queued", "after": after}
+        except (TaskInterrupted, asyncio.CancelledError):
+            if not self.run_entry.cancelled:
+                raise # the caller went away
+            if self.run_entry.cancelled == 'superseded':
+                yield {"type": "error", "content": "\n[Task Interrupted by new message]", "interrupted": True}
+            else:
+                yield {"type": "error", "content": "\n[Task Cancelled]", "interrupted": True}
+        except LLMResponseError as e:
+            yield {"type": "error", "content": str(e)}
+        except ProviderError as e:
+            yield {"type": "error", "content": f"LLM API Error: {str(e)}"}
+        except Exception as e:
+            yield {"type": "error", "content": f"Error: {str(e)}"}
+        yield {"type": "done", "content": full_content, "finished": finished}
+
+    async def _step(self):
+        """
+        One model call plus its tool calls. Sets self.last_message to
+        (content, tool_calls) and extends self.messages with the assistant and
+        tool messages.
+        """
+        payload = {'messages': self.messages, 'stream': True}
+        if self.tools:
+            payload['tools'] = self.tools
+            payload['tool_choice'] = 'auto'
+
+        # Tool calls are assembled as they stream in; read-only ones start as
+        # soon as their arguments are complete, overlapping tool I/O with the
+        # rest of the generation
+        assembler = ToolCallAssembler()
+        parsed_calls = {} # delta index -> (name, args)
+        early_start = True # no call that changes state has streamed in yet
+        results = {}
+
+        def tool_event(event):
+            func_name, func_args = parsed_calls[event[1]]
+            call_id = assembler.calls[event[1]]['id']
+            if event[0] == 'progress':
+                # MCP progress notification or server log line
+                return dict({"type": "tool_progress", "id": call_id, "tool": func_name}, **event[2])
+            if event[0] == 'start':
+                # id pairs start/end when calls overlap
+                return {"type": "tool_start", "id": call_id, "tool": func_name, "args": func_args}
+            results[event[1]] = event[2]
+            return {"type": "tool_end", "id": call_id, "tool": func_name, "result": event[2]}
+
+        runner = ToolCallRunner(self._run_call, self.tool_concurrency)
+        try:
+            full_content = ""
+            usage = None # last usage chunk (some servers repeat it on every chunk)
+            async with await llm_client.achat(self.settings, payload, conversation=self.hedge_key,
+                                              task=self.task) as response:
+                if response.status >= 400:
+                    raise LLMResponseError(f"LLM API Error: HTTP {response.status}\nDetails: {await response.text()}")
+                async for line in response.content:
+                    self.check_interrupt()
+                    line = line.decode('utf-8').strip()
+                    if not line.startswith('data: '): continue
+                    data_str = line[6:]
+                    if data_str == '[DONE]': continue # read to EOF so the connection returns to the pool
+
+                    try:
+                        chunk = json.loads(data_str)
+                        usage = chunk.get('usage') or usage
+                        if not chunk['choices']: continue
+                        delta = chunk['choices'][0].get('delta', {})
+
+                        if delta.get('content'):
+                            full_content += delta['content']
+                            yield {"type": "content", "data": delta['content']}
+
+                        if delta.get('tool_calls') and assembler.feed(delta['tool_calls']) and early_start:
+                            # A read-only call starts early only if every call
+                            # before it is read-only too; once a call that
+                            # changes state shows up, the rest wait for it
+                            for index in sorted(assembler.calls):
+                                if index in parsed_calls:
+                                    continue
+                                tool_call = assembler.calls[index]
+                                if index not in assembler.complete:
+                                    break
+                                if not is_early_start_tool(tool_call['function']['name'], self.settings, self.server_map):
+                                    early_start = False
+                                    break
+                                parsed_calls[index] = self._parse_tool_call(tool_call)
+                                runner.submit(index, parsed_calls[index])
+                    except json.JSONDecodeError:
+                        continue
+
+                    for event in runner.poll():
+                        yield tool_event(event)
+            await asyncio.to_thread(record_llm_call, response, usage, self.channel, self.conversation_id,
+                                    purpose=self.purpose)
+            assembler.finish()
+
+            tool_calls = assembler.tool_calls()
+            yield {"type": "assistant_message", "content": full_content, "tool_calls": tool_calls}
+            self.last_message = (full_content, tool_calls)
+            if not tool_calls:
+                return
+
+            self.messages.append({
+                "role": "assistant",
+                "content": full_content if full_content else None,
+                "tool_calls": tool_calls
+            })
+
+            # Run the remaining calls in message order: read-only calls run
+            # concurrently, any other call waits for the calls before it and
+            # holds back the ones after it
+            self.check_interrupt()
+            self.run_entry.set_step('tools: ' + ', '.join(call['function']['name'] for call in tool_calls))
+            for index in sorted(assembler.calls):
+                if index not in parsed_calls:
+                    parsed_calls[index] = self._parse_tool_call(assembler.calls[index])
+                    runner.submit(index, parsed_calls[index],
+                                  exclusive=not is_early_start_tool(parsed_calls[index][0], self.settings, self.server_map))
+            async for event in runner.drain(self.check_interrupt):
+                yield tool_event(event)
+        finally:
+            runner.close()
+
+        # Add results to history in the order the model issued the calls
+        for index in sorted(assembler.calls):
+            self.messages.append({
+                "role": "tool",
+                "tool_call_id": assembler.calls[index]['id'],
+                "content": str(results[index]) # Ensure string
+            })
+
+def iter_turn_events(turn):
+    """
+    Drive an AgentTurn on the shared loop from synchronous code (Flask
+    streams, worker threads); closing the iterator cancels the turn.
+    """
+    return async_loop.iterate(turn.run())
+
+@app.route('/api/qq/event', methods=['POST'])
+def qq_event():
+    data = request.json
+    # print(f"QQ Event: {json.dumps(data)}") # Debug
+
+    # OneBot V11 Event Handling
+    post_type = data.get('post_type')
+    
+    # 1. Message Event
+    if post_type == 'message':
+        message_type = data.get('message_type') # private / group
+        user_id = data.get('user_id')
+        group_id = data.get('group_id')
+        raw_message = data.get('raw_message', '')
+        
+        # Filter self messages? OneBot usually doesn't send self messages unless configured.
+        
+        # Async processing, queued behind the web UI (and direct chats ahead of groups)
+        try:
+            turn_scheduler.submit('group' if message_type == 'group' else 'direct', process_qq_message_thread,
+                                  message_type, user_id, group_id, raw_message)
+        except QueueFull as e:
+            print(f"Dropping QQ message from {user_id}: {e}")
+                        
+    # 2. Meta Event (Heartbeat) - Ignore
+    
+    return jsonify({"status": "ok"})
+
+def process_qq_message_thread(message_type, user_id, group_id, raw_message):
+    with app.app_context():
+        try:
+            # Load settings
+            conn = get_db_connection()
+            settings = {row['key']: row['value'] for row in conn.execute('SELECT * FROM settings')}
+            conn.close()
+            
+            http_api = settings.get('qq_http_api')
+            access_token = settings.get('qq_access_token')
+            secret = settings.get('qq_secret')
+            
+            if not http_api:
+                print("QQ HTTP API URL not configured.")
+                return
+
+            bot = QQBot(http_api, access_token, secret)
+            
+            # Identify Conversation
             # For Group: QQ_Group_{group_id}
             # For Private: QQ_User_{user_id}
             if message_type == 'group':
@@ -847,22 +2387,20 @@ def process_qq_message_thread(message_type, user_id, group_id, raw_message):
             conn.commit()
             conn.close() # Close to avoid locking during long LLM call
             
-            # Define Reply Function
+            # Define Reply Function (the bot's HTTP calls block, keep them off the loop)
             async def reply_func(text):
                 if message_type == 'group':
-                    bot.send_group_msg(group_id, text)
+                    await asyncio.to_thread(bot.send_group_msg, group_id, text)
                 else:
-                    bot.send_private_msg(user_id, text)
+                    await asyncio.to_thread(bot.send_private_msg, user_id, text)
 
-            # Call LLM
-            # Run async headless_chat_turn in a new loop for this thread
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            try:
-                loop.run_until_complete(headless_chat_turn(str(conversation_id), raw_message, reply_func))
-            finally:
-                loop.close()
+            if not llm_client.providers(settings):
+                async_loop.run_sync(reply_func("Error: API Key not configured in settings."))
+                return
+
+            # Call LLM on the shared loop
+            turn = AgentTurn(conversation_id, settings, 'qq')
+            async_loop.run_sync(relay_turn(turn, reply_func))
 
         except Exception as e:
             print(f"Error processing QQ message: {e}")
@@ -905,8 +2443,11 @@ def feishu_event():
                 content_dict = json.loads(content_json)
                 user_text = content_dict.get('text', '')
                 
-                # Async processing
-                threading.Thread(target=process_feishu_message_thread, args=(sender_id, user_text)).start()
+                # Async processing, queued behind the web UI (and direct chats ahead of groups)
+                priority = 'group' if message.get('chat_type') == 'group' else 'direct'
+                turn_scheduler.submit(priority, process_feishu_message_thread, sender_id, user_text)
+            except QueueFull as e:
+                print(f"Dropping Feishu message from {sender_id}: {e}")
             except Exception as e:
                 print(f"Error parsing Feishu message: {e}")
 
@@ -954,249 +2495,21 @@ def process_feishu_message_thread(sender_id, user_text):
                          (conversation_id, 'user', user_text))
             conn.commit()
             
-            # Prepare LLM Call
-            api_key = settings.get('api_key')
-            base_url = settings.get('base_url', 'https://api.siliconflow.cn/v1')
-            model = settings.get('model', 'deepseek-ai/DeepSeek-V3.2')
-            
-            if not api_key:
+            conn.close()
+            if not llm_client.providers(settings):
                 bot.send_message("open_id", sender_id, "text", "Error: API Key not configured.")
                 return
 
-            history = conn.execute('SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY created_at ASC', (conversation_id,)).fetchall()
-            conn.close()
-
-            # System Prompt
-            system_prompt = ""
-            system_prompt_path = os.path.join(DATA_DIR, 'system_prompt.md')
-            if os.path.exists(system_prompt_path):
-                try:
-                    with open(system_prompt_path, 'r', encoding='utf-8') as f:
-                        system_prompt = f.read()
-                except: pass
-            
-            messages_payload = []
-            if system_prompt:
-                messages_payload.append({'role': 'system', 'content': system_prompt})
-            
-            messages_payload.extend([{'role': row['role'], 'content': row['content']} for row in history])
-            
-            headers = {
-                'Authorization': f'Bearer {api_key}',
-                'Content-Type': 'application/json'
-            }
-
-            # Run Loop for Tools
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            try:
-                # Discover Tools
-                mcp_tools, server_map = loop.run_until_complete(get_all_mcp_tools())
-                skill_manager.load_skills()
-                skills_desc = skill_manager.get_all_skills_description()
-                
-                local_tools = [{
-                    "type": "function",
-                    "function": {
-                        "name": "execute_skill_function",
-                        "description": "Execute a Python function from a local skill. Refer to the 'Available Local Skills' in the system prompt for details on available skills, files, and functions.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "skill_name": {
-                                    "type": "string",
-                                    "description": "The name of the skill (folder name)."
-                                },
-                                "file_name": {
-                                    "type": "string",
-                                    "description": "The python file name (e.g. 'utils.py')."
-                                },
-                                "function_name": {
-                                    "type": "string",
-                                    "description": "The function name to call."
-                                },
-                                "kwargs": {
-                                    "type": "object",
-                                    "description": "Key-value arguments for the function."
-                                }
-                            },
-                            "required": ["skill_name", "file_name", "function_name"]
-                        }
-                    }
-                }]
-                
-                tools = mcp_tools + local_tools
-                
-                # Inject Skills Desc
-                found_sys = False
-                for msg in messages_payload:
-                    if msg['role'] == 'system':
-                        msg['content'] += "\n\n" + skills_desc
-                        found_sys = True
-                        break
-                if not found_sys:
-                    messages_payload.insert(0, {'role': 'system', 'content': "You are 1052 AI.\n\n" + skills_desc})
-                
-                current_messages = messages_payload.copy()
-                
-                # --- Interruption Setup ---
-                current_request_id = str(uuid.uuid4())
-                CONVERSATION_SIGNALS[conversation_id] = current_request_id
-                
-                final_content = ""
-                
-                while True:
-                    if CONVERSATION_SIGNALS.get(conversation_id) != current_request_id:
-                        bot.send_message("open_id", sender_id, "text", "[Task Interrupted]")
-                        break
-
-                    payload = {
-                        'model': model,
-                        'messages': current_messages,
-                        'stream': False # Feishu doesn't need stream for backend processing
-                    }
-                    if tools:
-                        payload['tools'] = tools
-                        payload['tool_choice'] = 'auto'
-                        
-                    response = requests.post(f"{base_url}/chat/completions", headers=headers, json=payload, timeout=300)
-                    response.raise_for_status()
-                    res_json = response.json()
-                    
-                    choice = res_json['choices'][0]
-                    message = choice['message']
-                    finish_reason = choice['finish_reason']
-                    
-                    if message.get('content'):
-                        final_content = message['content'] # Overwrite or append? Usually last message has content.
-                    
-                    tool_calls = message.get('tool_calls')
-                    
-                    if not tool_calls:
-                        # Done
-                        break
-                    
-                    # Add assistant message to history
-                    current_messages.append(message)
-                    
-                    # Execute Tools
-                    for tool_call in tool_calls:
-                        if CONVERSATION_SIGNALS.get(conversation_id) != current_request_id:
-                            break
-
-                        func_name = tool_call['function']['name']
-                        args_str = tool_call['function']['arguments']
-                        call_id = tool_call['id']
-                        
-                        try:
-                            func_args = json.loads(args_str)
-                        except:
-                            func_args = {}
-                            
-                        result = ""
-                        
-                        # Try Core Tools First
-                        core_result = execute_core_tool(func_name, func_args)
-                        if core_result is not None:
-                            result = core_result
-                        elif func_name in server_map:
-                            try:
-                                result = loop.run_until_complete(run_mcp_tool(server_map[func_name], func_name, func_args))
-                            except Exception as e:
-                                result = str(e)
-                        
-                        elif func_name == 'protocol_remember':
-                            try:
-                                key = func_args.get('key')
-                                value = func_args.get('value')
-                                protocol_brain.set_preference(key, value)
-                                result = f"Successfully remembered preference: {key} = {value}"
-                            except Exception as e:
-                                result = f"Error remembering: {str(e)}"
-
-                        elif func_name == 'protocol_learn_experience':
-                            try:
-                                problem = func_args.get('problem')
-                                solution = func_args.get('solution')
-                                tags = func_args.get('tags', [])
-                                exp_id = protocol_brain.add_experience(problem, solution, tags)
-                                result = f"Successfully learned experience. Experience ID: {exp_id}"
-                            except Exception as e:
-                                result = f"Error learning experience: {str(e)}"
-                        
-                        elif func_name == 'protocol_recall_experience':
-                            try:
-                                query = func_args.get('query')
-                                results = protocol_brain.search_experience(query)
-                                if not results:
-                                    result = "No relevant experiences found."
-                                else:
-                                    # Limit to top 3 to save tokens
-                                    top_results = results[:3]
-                                    result = json.dumps(top_results, ensure_ascii=False)
-                            except Exception as e:
-                                result = f"Error recalling experience: {str(e)}"
-
-                        elif func_name == 'execute_skill_function':
-                            try:
-                                # Parse args
-                                skill_name = func_args.get('skill_name')
-                                file_name = func_args.get('file_name')
-                                function_name = func_args.get('function_name')
-                                kwargs = func_args.get('kwargs', {})
-                                
-                                # Security Check
-                                if skill_name == 'cmd_control' and not enable_system_control:
-                                    result = "Error: System Control is disabled in settings. You cannot execute commands."
-                                else:
-                                    result = skill_manager.execute_skill_function(skill_name, file_name, function_name, kwargs)
-                            except Exception as e:
-                                result = f"Error executing skill: {str(e)}"
-                                
-                        elif func_name == 'record_improvement_plan':
-                            try:
-                                content = func_args.get('content')
-                                entry_type = func_args.get('type', 'plan')
-                                
-                                conn = get_db_connection()
-                                conn.execute('INSERT INTO ai_evolution_log (content, type, status) VALUES (?, ?, ?)', 
-                                            (content, entry_type, 'pending' if entry_type == 'plan' else 'completed'))
-                                conn.commit()
-                                conn.close()
-                                result = f"Successfully recorded {entry_type} into diary."
-                            except Exception as e:
-                                result = f"Error recording plan: {str(e)}"
-
-                        else:
-                            result = f"Error: Tool {func_name} not found."
-                            
-                        current_messages.append({
-                            "role": "tool",
-                            "tool_call_id": call_id,
-                            "content": str(result)
-                        })
-                        
-                # Loop ends when no tool calls
-                
-                # Save to DB
-                conn = get_db_connection()
-                conn.execute('INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)',
-                             (conversation_id, 'assistant', final_content))
-                conn.commit()
-                conn.close()
-                
-                # Send to Feishu
-                if final_content:
-                    bot.send_message("open_id", sender_id, "text", final_content)
-                else:
-                    bot.send_message("open_id", sender_id, "text", "(No response generated)")
-
-            except Exception as e:
-                print(f"Error in Feishu processing loop: {e}")
-                bot.send_message("open_id", sender_id, "text", f"Error processing request: {str(e)}")
-            finally:
-                loop.close()
+            # Feishu gets the final answer as one message; this channel
+            # carries no time/memory context
+            turn = AgentTurn(conversation_id, settings, 'feishu', with_context=False)
+            for event in iter_turn_events(turn):
+                if event['type'] == 'error':
+                    bot.send_message("open_id", sender_id, "text", event['content'].strip())
+                elif event['type'] == 'context_trimmed':
+                    print(f"Feishu conversation {conversation_id}: context trimmed {event}")
+                elif event['type'] == 'done' and event['finished']:
+                    bot.send_message("open_id", sender_id, "text", event['content'] or "(No response generated)")
 
         except Exception as e:
             print(f"Critical Error in Feishu thread: {e}")
@@ -1220,589 +2533,35 @@ def chat():
     # Get settings
     settings_rows = conn.execute('SELECT * FROM settings').fetchall()
     settings = {row['key']: row['value'] for row in settings_rows}
-    
-    api_key = settings.get('api_key')
-    base_url = settings.get('base_url', 'https://api.siliconflow.cn/v1')
-    model = settings.get('model', 'deepseek-ai/DeepSeek-V3.2')
-    # Default to True if not set (first run)
-    enable_system_control = settings.get('enable_system_control', 'true') == 'true'
-    enable_self_reflection = settings.get('enable_self_reflection') == 'true'
-    model_provider = settings.get('model_provider', 'openai')
-    
-    # Handle Local Model Provider
-    if model_provider == 'local':
-        if not api_key:
-            api_key = 'ollama' # Dummy key often required by clients even for local models
-    
-    # Get conversation history
-    history = conn.execute('SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY created_at ASC', (conversation_id,)).fetchall()
     conn.close()
-    
-    # --- Interruption Setup ---
-    current_request_id = str(uuid.uuid4())
-    CONVERSATION_SIGNALS[conversation_id] = current_request_id
-    
-    def check_interrupt():
-        if CONVERSATION_SIGNALS.get(conversation_id) != current_request_id:
-            raise TaskInterrupted("Interrupted by new request")
 
-    # Load system prompt
-    system_prompt = ""
-    system_prompt_path = os.path.join(DATA_DIR, 'system_prompt.md')
-    if os.path.exists(system_prompt_path):
+    # Endpoints (base_url/api_key/model or the llm_providers list) are
+    # resolved per request by llm_client, which also handles local models
+    if not llm_client.providers(settings):
+        return jsonify({'error': '请先配置 API Key'}), 400
+
+    # Created here so an earlier turn of this conversation stops right away
+    turn = AgentTurn(conversation_id, settings, 'web')
+
+    def generate():
         try:
-            with open(system_prompt_path, 'r', encoding='utf-8') as f:
-                system_prompt = f.read()
-        except Exception as e:
-            print(f"Error reading system prompt: {e}")
-            
-    # Initial messages list
-    messages_payload = []
-    if system_prompt:
-        messages_payload.append({'role': 'system', 'content': system_prompt})
-        
-    messages_payload.extend([{'role': row['role'], 'content': row['content']} for row in history])
-    
-    # Append current user message (already saved to DB, but need it in payload for this turn)
-    # Wait, history includes it? Yes, we saved it above.
-    # history query fetches ALL messages for conversation_id.
-    # So messages_payload HAS the latest user message.
-
-    if not api_key:
-        return jsonify({'error': '请先配置 API Key'}), 400
-
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json'
-    }
-    
-    # --- Interruption Setup ---
-    current_request_id = str(uuid.uuid4())
-    CONVERSATION_SIGNALS[conversation_id] = current_request_id
-    
-    def check_interrupt():
-        if CONVERSATION_SIGNALS.get(conversation_id) != current_request_id:
-            raise TaskInterrupted("Interrupted by new request")
-
-    def generate():
-        # Async wrapper to run async code in sync generator
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        try:
-            # 1. Discover MCP tools
-            check_interrupt()
-            mcp_tools, server_map = loop.run_until_complete(get_all_mcp_tools())
-            
-            # Load local skills (Descriptions only)
-            skill_manager.load_skills()
-            skills_description = skill_manager.get_all_skills_description()
-            
-            # Add Core Tools & Generic Skill Executor Tool
-            local_tools = CORE_TOOLS_SCHEMA + [{
-                "type": "function",
-                "function": {
-                    "name": "execute_skill_function",
-                    "description": "Execute a Python function from a local skill. Refer to the 'Available Local Skills' in the system prompt for details on available skills, files, and functions.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "skill_name": {
-                                "type": "string",
-                                "description": "The name of the skill (folder name)."
-                            },
-                            "file_name": {
-                                "type": "string",
-                                "description": "The python file name (e.g. 'utils.py')."
-                            },
-                            "function_name": {
-                                "type": "string",
-                                "description": "The function name to call."
-                            },
-                            "kwargs": {
-                                "type": "object",
-                                "description": "Key-value arguments for the function."
-                            }
-                        },
-                        "required": ["skill_name", "file_name", "function_name"]
-                    }
-                }
-            },
-            # 1052 Protocol Tools
-            {
-                "type": "function",
-                "function": {
-                    "name": "protocol_remember",
-                    "description": "Store a user preference or fact into long-term memory. Use this when the user explicitly asks to remember something or when you detect a stable user preference (e.g., 'I like python', 'Call me Master').",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "key": {
-                                "type": "string",
-                                "description": "The key for the preference (e.g., 'language_preference', 'nickname')."
-                            },
-                            "value": {
-                                "type": "string",
-                                "description": "The value to store."
-                            }
-                        },
-                        "required": ["key", "value"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "protocol_learn_experience",
-                    "description": "Save a solution to a problem as an 'Experience'. Use this when you have successfully solved a complex problem or when the user provides a specific solution they want you to remember.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "problem": {
-                                "type": "string",
-                                "description": "A short description of the problem."
-                            },
-                            "solution": {
-                                "type": "array",
-                                "items": {"type": "string"},
-                                "description": "A list of steps or a description of the solution."
-                            },
-                            "tags": {
-                                "type": "array",
-                                "items": {"type": "string"},
-                                "description": "Tags for easier retrieval (e.g., ['python', 'error', 'network'])."
-                            }
-                        },
-                        "required": ["problem", "solution"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "protocol_recall_experience",
-                    "description": "Search for past experiences/solutions related to a query. Use this when you encounter a problem and want to check if you've solved it before.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "Keywords to search for."
-                            }
-                        },
-                        "required": ["query"]
-                    }
-                }
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "record_improvement_plan",
-                    "description": "Record a self-improvement plan or internal monologue into your diary. Use this during Self-Reflection when you identify a gap and want to fix it later automatically.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "content": {
-                                "type": "string",
-                                "description": "The detailed plan or monologue. Describe what skill you want to learn or what code you want to write."
-                            },
-                            "type": {
-                                "type": "string",
-                                "enum": ["plan", "monologue"],
-                                "description": "Type of the entry. Use 'plan' for actionable items that need execution."
-                            }
-                        },
-                        "required": ["content", "type"]
-                    }
-                }
-            }]
-
-            # Merge tools
-            tools = mcp_tools + local_tools
-            
-            # We need a mutable list of messages for the multi-turn tool conversation
-            current_messages = messages_payload.copy()
-            
-            # Inject Skills Description into System Prompt (or first message)
-            # Find the system prompt and append, or add new system prompt
-            
-            # --- Time Context Injection ---
-            now = datetime.datetime.now()
-            # Force refresh of time context with explicit timezone
-            try:
-                # Use local system time with offset
-                import time
-                # Calculate offset in hours
-                if time.localtime().tm_isdst and time.daylight:
-                    offset_sec = -time.altzone
-                else:
-                    offset_sec = -time.timezone
-                    
-                offset_hours = offset_sec / 3600
-                sign = '+' if offset_hours >= 0 else ''
-                tz_str = f"UTC{sign}{int(offset_hours)}"
-            except:
-                tz_str = "Local System Time"
-            
-            time_str = now.strftime('%Y-%m-%d %H:%M:%S')
-            weekday = now.strftime('%A')
-            time_context = f"Current System Time: {time_str} ({weekday})\n"
-            time_context += f"System Timezone: {tz_str}\n\n"
-            
-            # --- 1052 Protocol Context Injection ---
-            # Inject Basic Info & Preferences into System Prompt
-            memory_context = ""
-            try:
-                mem_data = protocol_brain.get_memory_json()
-                preferences = mem_data.get('preferences', {})
-                basic = mem_data.get('basic', {})
-                
-                memory_context = f"\n\n## 1052 Protocol Memory Context\n"
-                memory_context += f"- **User Nickname**: {basic.get('nickname')}\n"
-                memory_context += f"- **Talk Style**: {preferences.get('talk_style')}\n"
-                
-                custom_prefs = preferences.get('custom', {})
-                if custom_prefs:
-                    memory_context += "- **Custom Preferences**:\n"
-                    for k, v in custom_prefs.items():
-                        memory_context += f"  - {k}: {v}\n"
-            except Exception as e:
-                print(f"Failed to inject memory context: {e}")
-            
-            found_system = False
-            for msg in current_messages:
-                if msg['role'] == 'system':
-                    # Append skills description to existing system prompt
-                    # We assume system_prompt.md is the source of truth for base identity
-                    # PREPEND time_context to ensure it's seen first
-                    msg['content'] = time_context + msg['content'] + memory_context + "\n\n" + skills_description
-                    found_system = True
-                    break
-            
-            if not found_system:
-                # If no system prompt found (e.g. file missing), use a default one + skills
-                default_system = "You are 1052 AI."
-                current_messages.insert(0, {'role': 'system', 'content': time_context + default_system + memory_context + "\n\n" + skills_description})
-
-            
-            while True:
-                payload = {
-                    'model': model,
-                    'messages': current_messages,
-                    'stream': True
-                }
-                if tools:
-                    payload['tools'] = tools
-                    payload['tool_choice'] = 'auto'
-
-                # Call OpenAI
-                # print(f"Sending payload to LLM: {json.dumps(payload, indent=2)}")
-                try:
-                    check_interrupt()
-                    response = requests.post(f"{base_url}/chat/completions", headers=headers, json=payload, stream=True, timeout=300)
-                    response.raise_for_status()
-                except TaskInterrupted:
-                    yield json.dumps({"type": "error", "content": "\n[Task Interrupted by new message]"}) + "\n"
-                    return
-                except requests.exceptions.HTTPError as e:
-                    error_content = response.text
-                    yield json.dumps({"type": "error", "content": f"LLM API Error: {str(e)}\nDetails: {error_content}"}) + "\n"
-                    return
-
-                tool_calls_buffer = {} # index -> tool_call_data
-                full_content = ""
-                finish_reason = None
-                
-                for line in response.iter_lines():
-                    check_interrupt()
-                    if not line: continue
-                    line = line.decode('utf-8')
-                    if not line.startswith('data: '): continue
-                    data_str = line[6:]
-                    if data_str == '[DONE]': break
-                    
-                    try:
-                        chunk = json.loads(data_str)
-                        if not chunk['choices']: continue
-                        delta = chunk['choices'][0].get('delta', {})
-                        finish_reason = chunk['choices'][0].get('finish_reason')
-
-                        # Handle content
-                        if 'content' in delta and delta['content']:
-                            content = delta['content']
-                            full_content += content
-                            yield json.dumps({"type": "content", "data": content}) + "\n"
-
-                        # Handle tool calls
-                        if 'tool_calls' in delta and delta['tool_calls']:
-                            for tool_call in delta['tool_calls']:
-                                index = tool_call['index']
-                                if index not in tool_calls_buffer:
-                                    tool_calls_buffer[index] = {
-                                        "id": tool_call.get("id"),
-                                        "type": "function",
-                                        "function": {
-                                            "name": tool_call["function"].get("name", ""),
-                                            "arguments": tool_call["function"].get("arguments", "")
-                                        }
-                                    }
-                                else:
-                                    if "function" in tool_call:
-                                        if "name" in tool_call["function"]:
-                                            tool_calls_buffer[index]["function"]["name"] += tool_call["function"]["name"]
-                                        if "arguments" in tool_call["function"]:
-                                            tool_calls_buffer[index]["function"]["arguments"] += tool_call["function"]["arguments"]
-                                            
-                                    if "id" in tool_call and tool_call["id"]:
-                                        tool_calls_buffer[index]["id"] = tool_call["id"]
-                    
-                    except json.JSONDecodeError:
+            with turn_scheduler.slot('interactive'):
+                for event in iter_turn_events(turn):
+                    # The page renders streamed content; step/turn summaries are for other channels
+                    if event['type'] in ('assistant_message', 'done'):
                         continue
-                
-                # Check if we have tool calls
-                if not tool_calls_buffer:
-                    # No tool calls, we are done. Save assistant message and exit loop.
-                    conn = get_db_connection()
-                    conn.execute('INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)',
-                                (conversation_id, 'assistant', full_content))
-                    conn.commit()
-                    conn.close()
-                    break
-                
-                # Convert buffer to list
-                tool_calls = list(tool_calls_buffer.values())
-                
-                # Append assistant message with tool_calls to history
-                assistant_msg = {
-                    "role": "assistant",
-                    "content": full_content if full_content else None,
-                    "tool_calls": tool_calls
-                }
-                current_messages.append(assistant_msg)
-                
-                # Execute tools
-                for tool_call in tool_calls:
-                    check_interrupt()
-                    func_name = tool_call['function']['name']
-                    func_args_str = tool_call['function']['arguments']
-                    call_id = tool_call['id']
-                    
-                    try:
-                        func_args = json.loads(func_args_str)
-                    except:
-                        func_args = {}
-
-                    # Inject conversation_id for core tools that need it (like scheduler)
-                    func_args['_conversation_id'] = conversation_id # Or handle error
-
-                    # Notify frontend
-                    yield json.dumps({
-                        "type": "tool_start",
-                        "tool": func_name,
-                        "args": func_args
-                    }) + "\n"
-                    
-                    result = ""
-                    if func_name in server_map:
-                        try:
-                            result = loop.run_until_complete(run_mcp_tool(server_map[func_name], func_name, func_args))
-                        except Exception as e:
-                            result = f"Error executing tool: {str(e)}"
-                    elif func_name == 'execute_skill_function':
-                        try:
-                            # Parse args
-                            skill_name = func_args.get('skill_name')
-                            file_name = func_args.get('file_name')
-                            function_name = func_args.get('function_name')
-                            kwargs = func_args.get('kwargs', {})
-                            
-                            # Inject context
-                            kwargs['_conversation_id'] = conversation_id
-                            
-                            # Security Check
-                            if skill_name == 'cmd_control' and not enable_system_control:
-                                result = "Error: System Control is disabled in settings. You cannot execute commands."
-                            else:
-                                result = skill_manager.execute_skill_function(skill_name, file_name, function_name, kwargs)
-                        except Exception as e:
-                            result = f"Error executing skill: {str(e)}"
-                    else:
-                        result = f"Error: Tool {func_name} not found."
-
-                    # Notify frontend
-                    yield json.dumps({
-                        "type": "tool_end",
-                        "tool": func_name,
-                        "result": result
-                    }) + "\n"
-
-                    # Add result to history
-                    current_messages.append({
-                        "role": "tool",
-                        "tool_call_id": call_id,
-                        "content": str(result) # Ensure string
-                    })
-                    
-                    # For protocol_remember, we also want to inject this into the NEXT turn's system prompt immediately?
-                    # Or just wait for next turn.
-                    # Wait, if we updated memory, we should probably reload memory_context for subsequent turns in the same session?
-                    # But session is stateless in HTTP unless we persist context.
-                    # Actually, since `protocol_brain` is a global object in this app context (or re-instantiated), 
-                    # and we modify `protocol_brain.memory` in place in `remember` method,
-                    # the next turn (next while loop iteration if we had one, but we break after tool calls usually)
-                    # Wait, the `generate` function loops over tool calls and then yields.
-                    # It does NOT loop back to LLM for a second thought in the SAME request unless we implement multi-turn tool use.
-                    # Oh, the `while True` loop in `generate` IS for multi-turn tool use!
-                    # So if tool returns, we append result and loop back to LLM.
-                    # The LLM sees the tool output.
-                    
-                    # BUT, the `system_prompt` (with memory_context) was constructed at the BEGINNING of `generate`.
-                    # So the LLM still sees the OLD memory context in the system prompt.
-                    # However, it sees the "Successfully remembered..." tool output, so it KNOWS it remembered it.
-                    # That's sufficient for the current session.
-                    # Next time `generate` is called (next user message), memory_context will be re-read from disk.
-                    
-                # Loop continues to next iteration to send tool outputs back to OpenAI
-                pass
-                
-            # If we are here, it means we finished processing a turn (with or without tool calls)
-            # If enable_self_reflection is ON, we should trigger a reflection step
-            # But we must be careful not to infinite loop.
-            # Reflection should be a separate "system" prompt call that analyzes the LAST turn.
-            # However, simpler implementation:
-            # If finish_reason is 'stop', and enable_self_reflection is True, we can append a system prompt
-            # asking for reflection and continue generation?
-            # Or better: Just append a hidden "Thought" block if the model supports it?
-            # DeepSeek R1 supports <think>.
-            # But user wants "Self-Evolution": "Think what is missing and improve".
-            
-            # Implementation:
-            # After the main response is done (no more tool calls), if enable_self_reflection is True:
-            # We trigger a SECOND, invisible LLM call to analyze the situation.
-            
-        except TaskInterrupted:
-            yield json.dumps({"type": "error", "content": "\n[Task Interrupted by new message]"}) + "\n"
-        except Exception as e:
-            error_msg = f"Error: {str(e)}"
-            yield json.dumps({"type": "error", "content": error_msg}) + "\n"
+                    yield json.dumps(event) + "\n"
+        except QueueFull as e:
+            yield json.dumps({"type": "error", "content": f"Error: {e}"}) + "\n"
         finally:
-            loop.close()
-            
-            # --- Self-Reflection & Evolution Step ---
-            # Only run if enabled and no error occurred in main loop
-            if enable_self_reflection and finish_reason == 'stop':
-                try:
-                    check_interrupt()
-                    # We run this in a new loop or just sync since we are already in a generator?
-                    # We need to yield output to frontend so user sees the "Evolution".
-                    
-                    yield json.dumps({"type": "content", "data": "\n\n--- 🧠 **Self-Reflection** ---\n"}) + "\n"
-                    
-                    reflection_prompt = (
-                        "You have just completed a task for the user. Now, engage in **Self-Reflection**.\n"
-                        "1. Analyze your performance: Did you satisfy the user's intent? Was there anything missing?\n"
-                        "2. Identify gaps: Do you lack any skills or knowledge to do this better?\n"
-                        "3. **Self-Improvement**: If you identify a missing skill, use `record_improvement_plan` to write it down into your diary. It will be automatically implemented tonight.\n"
-                        "4. Output your thoughts concisely."
-                    )
-                    
-                    # Add reflection instruction
-                    reflection_messages = current_messages.copy()
-                    reflection_messages.append({'role': 'system', 'content': reflection_prompt})
-                    
-                    # Call LLM again for reflection
-                    # Note: We need a new loop or simple request
-                    refl_payload = {
-                        'model': model,
-                        'messages': reflection_messages,
-                        'stream': True
-                    }
-                    if tools:
-                        refl_payload['tools'] = tools
-                        refl_payload['tool_choice'] = 'auto'
-
-                    # Add record_improvement_plan to available tools list for reflection
-                    # Actually tools already has it because we added it to `local_tools` above
-                    
-                    # print("Starting Reflection...")
-                    # We use a separate synchronous request for Reflection to handle tool calls robustly,
-                    # but we simulate streaming for user experience?
-                    # Or just stream normally and parse tool calls manually.
-                    
-                    check_interrupt()
-                    refl_response = requests.post(f"{base_url}/chat/completions", headers=headers, json=refl_payload, stream=True, timeout=300)
-                    
-                    reflection_tool_buffer = {}
-                    
-                    for line in refl_response.iter_lines():
-                        check_interrupt()
-                        if not line: continue
-                        line = line.decode('utf-8')
-                        if not line.startswith('data: '): continue
-                        data_str = line[6:]
-                        if data_str == '[DONE]': break
-                        try:
-                            chunk = json.loads(data_str)
-                            if not chunk['choices']: continue
-                            delta = chunk['choices'][0].get('delta', {})
-                            
-                            if 'content' in delta and delta['content']:
-                                yield json.dumps({"type": "content", "data": delta['content']}) + "\n"
-                                
-                            if 'tool_calls' in delta and delta['tool_calls']:
-                                for tc in delta['tool_calls']:
-                                    idx = tc['index']
-                                    if idx not in reflection_tool_buffer:
-                                        reflection_tool_buffer[idx] = tc
-                                    else:
-                                        # Merge
-                                        if 'function' in tc:
-                                            if 'name' in tc['function']:
-                                                if 'function' not in reflection_tool_buffer[idx]: reflection_tool_buffer[idx]['function'] = {}
-                                                reflection_tool_buffer[idx]['function']['name'] = reflection_tool_buffer[idx]['function'].get('name', '') + tc['function']['name']
-                                            if 'arguments' in tc['function']:
-                                                if 'function' not in reflection_tool_buffer[idx]: reflection_tool_buffer[idx]['function'] = {}
-                                                reflection_tool_buffer[idx]['function']['arguments'] = reflection_tool_buffer[idx]['function'].get('arguments', '') + tc['function']['arguments']
-                        except: pass
-                    
-                    yield json.dumps({"type": "content", "data": "\n\n--------------------------------\n"}) + "\n"
-
-                    # After stream ends, check for tool calls
-                    if reflection_tool_buffer:
-                        for idx, tool_call in reflection_tool_buffer.items():
-                            func_name = tool_call['function']['name']
-                            args_str = tool_call['function']['arguments']
-                            try:
-                                args = json.loads(args_str)
-                                if func_name == 'record_improvement_plan':
-                                    # Execute it
-                                    content = args.get('content')
-                                    entry_type = args.get('type', 'plan')
-                                    
-                                    conn = get_db_connection()
-                                    conn.execute('INSERT INTO ai_evolution_log (content, type, status) VALUES (?, ?, ?)', 
-                                                (content, entry_type, 'pending' if entry_type == 'plan' else 'completed'))
-                                    conn.commit()
-                                    conn.close()
-                                    
-                                    yield json.dumps({"type": "content", "data": f"\n[Diary] Recorded: {entry_type}\n"}) + "\n"
-                            except Exception as e:
-                                print(f"Failed to execute reflection tool: {e}")
-
-                except Exception as e:
-                    print(f"Reflection failed: {e}")
-
-                except Exception as e:
-                    print(f"Reflection failed: {e}")
+            turn.close()
 
     return Response(stream_with_context(generate()), content_type='text/plain')
 
-
-    return Response(stream_with_context(generate()), content_type='text/plain')
-
-async def headless_chat_turn(user_id, user_message, reply_func):
+def open_headless_conversation(user_id, user_message):
     """
-    Process a chat turn without Flask context, suitable for Telegram/CLI.
+    Map a Telegram user to their latest conversation and save the message.
+    Returns (conversation_id, settings), or None after a /new command.
     """
     conn = get_db_connection()
     
@@ -1811,8 +2570,7 @@ async def headless_chat_turn(user_id, user_message, reply_func):
         conn.execute('INSERT INTO conversations (title) VALUES (?)', (f"Telegram_{user_id}",))
         conn.commit()
         conn.close()
-        await reply_func("✅ 已开启新会话，上下文已重置。")
-        return
+        return None
 
     # Get conversation history
     # We need to find the latest conversation for this user
@@ -1839,410 +2597,77 @@ async def headless_chat_turn(user_id, user_message, reply_func):
     # Get settings
     settings_rows = conn.execute('SELECT * FROM settings').fetchall()
     settings = {row['key']: row['value'] for row in settings_rows}
-    
-    api_key = settings.get('api_key')
-    base_url = settings.get('base_url', 'https://api.siliconflow.cn/v1')
-    model = settings.get('model', 'deepseek-ai/DeepSeek-V3.2')
-    # Default to True
-    enable_system_control = settings.get('enable_system_control', 'true') == 'true'
-    enable_self_reflection = settings.get('enable_self_reflection') == 'true'
-    model_provider = settings.get('model_provider', 'openai')
-    
-    # Handle Local Model Provider
-    if model_provider == 'local':
-        if not api_key:
-            api_key = 'ollama'
-
-    # Get conversation history
-    history = conn.execute('SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY created_at ASC', (conversation_id,)).fetchall()
     conn.close()
+    return conversation_id, settings
+
+async def headless_chat_turn(user_id, user_message, reply_func, channel='telegram'):
+    """
+    Process a chat turn without Flask context, suitable for Telegram/CLI.
+    """
+    opened = await asyncio.to_thread(open_headless_conversation, user_id, user_message)
+    if opened is None:
+        await reply_func("✅ 已开启新会话，上下文已重置。")
+        return
+    conversation_id, settings = opened
     
-    if not api_key:
+    if not llm_client.providers(settings):
         await reply_func("Error: API Key not configured in settings.")
         return
 
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json'
-    }
-    
-    # --- Interruption Setup ---
-    current_request_id = str(uuid.uuid4())
-    CONVERSATION_SIGNALS[conversation_id] = current_request_id
-    
-    def is_interrupted():
-        return CONVERSATION_SIGNALS.get(conversation_id) != current_request_id
+    await relay_turn(AgentTurn(conversation_id, settings, channel), reply_func)
 
-    # Load system prompt
-    system_prompt = ""
-    system_prompt_path = os.path.join(DATA_DIR, 'system_prompt.md')
-    if os.path.exists(system_prompt_path):
-        try:
-            with open(system_prompt_path, 'r', encoding='utf-8') as f:
-                system_prompt = f.read()
-        except Exception as e:
-            print(f"Error reading system prompt: {e}")
-            
-    # Initial messages list
-    messages_payload = []
-    if system_prompt:
-        messages_payload.append({'role': 'system', 'content': system_prompt})
-        
-    messages_payload.extend([{'role': row['role'], 'content': row['content']} for row in history])
-    
-    # --- Context Injection (Time & Memory) ---
-    # (Copied from generate)
-    now = datetime.datetime.now()
-    try:
-        import time
-        offset = -time.timezone if (time.localtime().tm_isdst == 0) else -time.altzone
-        offset_hours = offset / 3600
-        tz_str = f"UTC{'+' if offset_hours >= 0 else ''}{int(offset_hours)}"
-    except:
-        tz_str = "Local System Time"
-        
-    time_str = now.strftime('%Y-%m-%d %H:%M:%S')
-    weekday = now.strftime('%A')
-    time_context = f"Current System Time: {time_str} ({weekday})\n"
-    time_context += f"System Timezone: {tz_str}\n\n"
-    
-    # Inject Skills Description
-    skill_manager.load_skills()
-    skills_description = skill_manager.get_all_skills_description()
-    
-    memory_context = ""
-    try:
-        mem_data = protocol_brain.get_memory_json()
-        preferences = mem_data.get('preferences', {})
-        basic = mem_data.get('basic', {})
-        
-        memory_context = f"\n\n## 1052 Protocol Memory Context\n"
-        memory_context += f"- **User Nickname**: {basic.get('nickname')}\n"
-        memory_context += f"- **Talk Style**: {preferences.get('talk_style')}\n"
-        
-        custom_prefs = preferences.get('custom', {})
-        if custom_prefs:
-            memory_context += "- **Custom Preferences**:\n"
-            for k, v in custom_prefs.items():
-                memory_context += f"  - {k}: {v}\n"
-    except Exception as e:
-        print(f"Failed to inject memory context: {e}")
-    
-    found_system = False
-    for msg in messages_payload:
-        if msg['role'] == 'system':
-            msg['content'] = time_context + msg['content'] + memory_context + "\n\n" + skills_description
-            found_system = True
-            break
-    
-    if not found_system:
-        default_system = "You are 1052 AI."
-        messages_payload.insert(0, {'role': 'system', 'content': time_context + default_system + memory_context + "\n\n" + skills_description})
-
-    # Prepare Tools
-    # (Simplified: assume we can get MCP tools here or reuse a global cache? 
-    # For now, let's just use local tools to avoid async loop issues if mcp discovery is slow)
-    # Ideally we should call get_all_mcp_tools() but it requires an event loop.
-    # We are in an async function, so we can await it? No, get_all_mcp_tools is async but we need to manage loop carefully.
-    # Let's assume we are running in an asyncio loop (TG bot runs in asyncio loop).
-    
-    try:
-        mcp_tools, server_map = await get_all_mcp_tools()
-    except:
-        mcp_tools = []
-        server_map = {}
+async def relay_turn(turn, reply_func):
+    """
+    Run a turn for an IM channel: each model step is sent as its own message,
+    followed by tool progress notes; reflections are saved but not sent.
+    """
+    async for event in turn.run():
+        if event['type'] == 'assistant_message':
+            if event['content']:
+                await reply_func(event['content'])
+            tool_names = [call['function']['name'] for call in event['tool_calls']]
+            if tool_names:
+                await reply_func(f"⏳ 正在执行任务: {', '.join(tool_names)}...")
+        elif event['type'] == 'tool_end':
+            await reply_func(f"✅ 执行完成: {event['tool']}")
+        elif event['type'] == 'error':
+            await reply_func(event['content'])
+        elif event['type'] == 'context_trimmed':
+            print(f"Conversation {turn.conversation_id}: context trimmed {event}")
+
+async def telegram_chat_turn(user_id, user_message, reply_func):
+    """
+    Telegram entry point, called on the bot's own event loop. The turn runs on
+    async_loop (with the pooled MCP and LLM sessions) once it gets a
+    direct-chat slot; replies are sent back on the bot's loop.
+    """
+    bot_loop = asyncio.get_running_loop()
 
-    local_tools = CORE_TOOLS_SCHEMA + [{
-        "type": "function",
-        "function": {
-            "name": "execute_skill_function",
-            "description": "Execute a Python function from a local skill.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "skill_name": {"type": "string"},
-                    "file_name": {"type": "string"},
-                    "function_name": {"type": "string"},
-                    "kwargs": {"type": "object"}
-                },
-                "required": ["skill_name", "file_name", "function_name"]
-            }
-        }
-    },
-    # Add Protocol Tools (Simplified copy)
-    {
-        "type": "function",
-        "function": {
-            "name": "protocol_remember",
-            "description": "Store a user preference or fact into long-term memory.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "key": {"type": "string"},
-                    "value": {"type": "string"}
-                },
-                "required": ["key", "value"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "protocol_learn_experience",
-            "description": "Save a solution to a problem as an 'Experience'.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "problem": {"type": "string"},
-                    "solution": {"type": "array", "items": {"type": "string"}},
-                    "tags": {"type": "array", "items": {"type": "string"}}
-                },
-                "required": ["problem", "solution"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "protocol_recall_experience",
-            "description": "Search for past experiences/solutions related to a query.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {"type": "string"}
-                },
-                "required": ["query"]
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "record_improvement_plan",
-            "description": "Record a self-improvement plan into diary.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "content": {"type": "string"},
-                    "type": {"type": "string", "enum": ["plan", "monologue"]}
-                },
-                "required": ["content", "type"]
-            }
-        }
-    }]
-    
-    tools = mcp_tools + local_tools
-    current_messages = messages_payload
-    
-    # Turn Loop
-    while True:
-        if is_interrupted():
-            await reply_func("\n[Task Interrupted by new message]")
-            break
-
-        payload = {
-            'model': model,
-            'messages': current_messages,
-            'stream': False # Telegram: No streaming for logic simplicity (or implement chunking)
-        }
-        if tools:
-            payload['tools'] = tools
-            payload['tool_choice'] = 'auto'
+    async def reply_on_bot_loop(text):
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(reply_func(text), bot_loop))
 
+    async def turn():
         try:
-            if is_interrupted(): raise TaskInterrupted()
-            
-            # Switch to streaming mode to allow interruption during generation
-            payload['stream'] = True
-            
-            # Use aiohttp for async non-blocking request
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{base_url}/chat/completions", headers=headers, json=payload, timeout=300) as response:
-                    response.raise_for_status()
-                    
-                    # Manually collect the stream content
-                    full_content = ""
-                    tool_calls_buffer = {}
-                    finish_reason = None
-                    
-                    async for line in response.content:
-                        if is_interrupted(): raise TaskInterrupted()
-                        if not line: continue
-                        
-                        decoded_line = line.decode('utf-8').strip()
-                        if not decoded_line.startswith('data: '): continue
-                        
-                        data_str = decoded_line[6:]
-                        if data_str == '[DONE]': break
-                        
-                        try:
-                            chunk = json.loads(data_str)
-                            if not chunk['choices']: continue
-                            
-                            delta = chunk['choices'][0].get('delta', {})
-                            finish_reason = chunk['choices'][0].get('finish_reason')
-                            
-                            # Accumulate content
-                            if 'content' in delta and delta['content']:
-                                content_chunk = delta['content']
-                                full_content += content_chunk
-                                
-                            # Accumulate tool calls
-                            if 'tool_calls' in delta and delta['tool_calls']:
-                                for tc in delta['tool_calls']:
-                                    idx = tc['index']
-                                    if idx not in tool_calls_buffer:
-                                        tool_calls_buffer[idx] = tc
-                                    else:
-                                        # Merge
-                                        if 'function' in tc:
-                                            if 'name' in tc['function']:
-                                                if 'function' not in tool_calls_buffer[idx]: tool_calls_buffer[idx]['function'] = {}
-                                                tool_calls_buffer[idx]['function']['name'] = tool_calls_buffer[idx]['function'].get('name', '') + tc['function']['name']
-                                            if 'arguments' in tc['function']:
-                                                if 'function' not in tool_calls_buffer[idx]: tool_calls_buffer[idx]['function'] = {}
-                                                tool_calls_buffer[idx]['function']['arguments'] = tool_calls_buffer[idx]['function'].get('arguments', '') + tc['function']['arguments']
-                        except:
-                            pass
-            
-            # Notify User (Optional)
-            if tool_calls_buffer:
-                # await reply_func(f"✅ 执行完成: {func_name}") # Moved to inside loop
-                pass
+            async with turn_scheduler.aslot('direct'):
+                await headless_chat_turn(user_id, user_message, reply_on_bot_loop)
+        except QueueFull as e:
+            await reply_on_bot_loop(f"Error: {e}")
 
-            # Reconstruct message object for history
-            
-            # Reconstruct message object for history
-            msg = {'role': 'assistant', 'content': full_content}
-            tool_calls = []
-            if tool_calls_buffer:
-                tool_calls = [v for k, v in sorted(tool_calls_buffer.items())]
-                msg['tool_calls'] = tool_calls
-                
-                # Notify User if tool calls are present (but not yet executed)
-                tool_names = [v['function']['name'] for k, v in tool_calls_buffer.items() if 'function' in v and 'name' in v['function']]
-                if tool_names:
-                    tools_str = ", ".join(tool_names)
-                    await reply_func(f"⏳ 正在执行任务: {tools_str}...")
-            
-            # Save assistant message
-            current_messages.append(msg)
-            
-            if full_content:
-                await reply_func(full_content)
-                # Save to DB
-                conn = get_db_connection()
-                conn.execute('INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)',
-                            (conversation_id, 'assistant', full_content))
-                conn.commit()
-                conn.close()
+    await async_loop.run(turn())
 
-            # Check if this is a tool use turn
-            if not tool_calls:
-                # Normal response, done
-                break
-            
-            # If we have tool calls, we execute them and then CONTINUE the loop
-            # The next iteration will send the tool outputs back to LLM
-            # and LLM will generate the next response (or more tool calls)
-            for tc in tool_calls:
-                if is_interrupted(): raise TaskInterrupted()
-                
-                func_name = tc['function']['name']
-                args_str = tc['function']['arguments']
-                call_id = tc['id']
-                
-                try:
-                    func_args = json.loads(args_str)
-                except:
-                    func_args = {}
-                
-                func_args['_conversation_id'] = conversation_id
-                
-                # Notify User (Optional)
-                await reply_func(f"✅ 执行完成: {func_name}")
-                
-                result = ""
-                core_res = execute_core_tool(func_name, func_args)
-                if core_res is not None:
-                    result = core_res
-                elif func_name in server_map:
-                    try:
-                        result = await run_mcp_tool(server_map[func_name], func_name, func_args)
-                    except Exception as e:
-                        result = f"Error executing tool: {str(e)}"
-                elif func_name == 'execute_skill_function':
-                    try:
-                        skill_name = func_args.get('skill_name')
-                        file_name = func_args.get('file_name')
-                        function_name = func_args.get('function_name')
-                        kwargs = func_args.get('kwargs', {})
-                        kwargs['_conversation_id'] = conversation_id
-                        
-                        if skill_name == 'cmd_control' and not enable_system_control:
-                            result = "Error: System Control is disabled."
-                        else:
-                            result = skill_manager.execute_skill_function(skill_name, file_name, function_name, kwargs)
-                    except Exception as e:
-                        result = f"Error executing skill: {str(e)}"
-                # ... Handle Protocol Tools (Copy logic from generate) ...
-                elif func_name == 'protocol_remember':
-                    try:
-                        saved_path = protocol_brain.remember(func_args.get('key'), func_args.get('value'))
-                        result = f"Successfully remembered: {func_args.get('key')} = {func_args.get('value')}. Saved to {saved_path}"
-                    except Exception as e: result = str(e)
-                elif func_name == 'protocol_learn_experience':
-                    try:
-                        saved_path = protocol_brain.learn_experience(func_args.get('problem'), func_args.get('solution'), func_args.get('tags'))
-                        result = f"Experience learned and saved to {saved_path}."
-                    except Exception as e: result = str(e)
-                elif func_name == 'protocol_recall_experience':
-                    try:
-                        res = protocol_brain.search_experience(func_args.get('query'))
-                        result = json.dumps(res, ensure_ascii=False)
-                    except Exception as e: result = str(e)
-                elif func_name == 'record_improvement_plan':
-                    try:
-                        content = func_args.get('content')
-                        entry_type = func_args.get('type', 'plan')
-                        conn = get_db_connection()
-                        conn.execute('INSERT INTO ai_evolution_log (content, type, status) VALUES (?, ?, ?)', 
-                                    (content, entry_type, 'pending' if entry_type == 'plan' else 'completed'))
-                        conn.commit()
-                        conn.close()
-                        result = f"Recorded {entry_type}."
-                    except Exception as e: result = str(e)
-                else:
-                    result = f"Error: Tool {func_name} not found."
-                
-                current_messages.append({
-                    "role": "tool",
-                    "tool_call_id": call_id,
-                    "content": str(result)
-                })
-
-        except TaskInterrupted:
-            await reply_func("\n[Task Interrupted by new message]")
-            break
-        except Exception as e:
-            await reply_func(f"Error: {str(e)}")
-            break
-
-    # --- Self-Reflection (Simplified for Headless) ---
-    if enable_self_reflection:
-        # Just trigger it silently or post to DB?
-        # For TG, maybe post it as a separate message?
-        pass
+# Tool calls that count as an evolution plan making progress
+EVOLUTION_TOOLS = {'execute_skill_function', 'protocol_remember', 'protocol_learn_experience'}
 
 # Scheduler Thread Function
-def scheduler_loop():
+def scheduler_loop(stop):
+    """Run due tasks and evolution checks every 5 seconds until `stop` is set."""
     print("Scheduler thread started.")
     last_evolution_check = datetime.datetime.now()
     
-    while True:
+    while not stop.is_set():
         try:
             # Use absolute path to DB file
-            conn = sqlite3.connect(DB_FILE)
+            conn = sqlite3.connect(DB_FILE, timeout=30)
             conn.row_factory = sqlite3.Row
             
             now = datetime.datetime.now()
@@ -2265,11 +2690,14 @@ def scheduler_loop():
                 content = task['content']
                 conversation_id = task['conversation_id']
                 
+                # Mark as completed; skip tasks another worker already claimed
+                claimed = conn.execute("UPDATE scheduled_tasks SET status = 'completed' WHERE id = ? AND status = 'pending'",
+                                       (task_id,)).rowcount
+                if not claimed:
+                    continue
+
                 print(f"Executing scheduled task {task_id}: {content}")
                 
-                # Mark as completed
-                conn.execute("UPDATE scheduled_tasks SET status = 'completed' WHERE id = ?", (task_id,))
-                
                 # Add reminder message to chat
                 reminder_msg = f"⏰ **定时提醒**: {content}"
                 conn.execute(
@@ -2312,205 +2740,78 @@ def scheduler_loop():
                     # We need to load settings to get API key
                     settings_rows = conn.execute('SELECT * FROM settings').fetchall()
                     settings = {row['key']: row['value'] for row in settings_rows}
-                    api_key = settings.get('api_key')
-                    base_url = settings.get('base_url', 'https://api.siliconflow.cn/v1')
-                    model = settings.get('model', 'deepseek-ai/DeepSeek-V3.2')
                     # Default to True
                     enable_system_control = settings.get('enable_system_control', 'true') == 'true'
                     
-                    if api_key and enable_system_control:
-                        headers = {
-                            'Authorization': f'Bearer {api_key}',
-                            'Content-Type': 'application/json'
-                        }
+                    if llm_client.providers(settings) and enable_system_control:
+                        skill_manager.load_skills()
+                        skills_desc = skill_manager.get_all_skills_description()
                         
-                        # Load tools for evolution (it needs to write code!)
-                        # We re-discover tools here
-                        # Note: run_until_complete in a thread that might not have loop?
-                        # It's better to instantiate a new loop for this thread.
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        
-                        try:
-                            mcp_tools, server_map = loop.run_until_complete(get_all_mcp_tools())
-                            skill_manager.load_skills()
-                            skills_desc = skill_manager.get_all_skills_description()
-                            
-                            # Construct tools list (Reuse definition from main route is hard, let's simplify)
-                            # We only need `execute_skill_function` and `protocol_learn_experience` really.
-                            # But full power is better.
-                            # For simplicity, let's assume `execute_skill_function` is enough for "Evolution".
+                        for plan in pending_plans:
+                            plan_id = plan['id']
+                            plan_content = plan['content']
                             
-                            evolve_tools = CORE_TOOLS_SCHEMA + [{
-                                "type": "function",
-                                "function": {
-                                    "name": "execute_skill_function",
-                                    "description": "Execute a Python function from a local skill.",
-                                    "parameters": {
-                                        "type": "object",
-                                        "properties": {
-                                            "skill_name": {"type": "string"},
-                                            "file_name": {"type": "string"},
-                                            "function_name": {"type": "string"},
-                                            "kwargs": {"type": "object"}
-                                        },
-                                        "required": ["skill_name", "file_name", "function_name"]
-                                    }
-                                }
-                            },
-                            {
-                                "type": "function",
-                                "function": {
-                                    "name": "protocol_remember",
-                                    "description": "Store a user preference or fact into long-term memory.",
-                                    "parameters": {
-                                        "type": "object",
-                                        "properties": {
-                                            "key": {"type": "string"},
-                                            "value": {"type": "string"}
-                                        },
-                                        "required": ["key", "value"]
-                                    }
-                                }
-                            },
-                            {
-                                "type": "function",
-                                "function": {
-                                    "name": "protocol_learn_experience",
-                                    "description": "Save a solution to a problem as an 'Experience'.",
-                                    "parameters": {
-                                        "type": "object",
-                                        "properties": {
-                                            "problem": {"type": "string"},
-                                            "solution": {"type": "array", "items": {"type": "string"}},
-                                            "tags": {"type": "array", "items": {"type": "string"}}
-                                        },
-                                        "required": ["problem", "solution"]
-                                    }
-                                }
-                            }]
+                            print(f"Evolving plan {plan_id}: {plan_content}")
                             
-                            for plan in pending_plans:
-                                plan_id = plan['id']
-                                plan_content = plan['content']
-                                
-                                print(f"Evolving plan {plan_id}: {plan_content}")
-                                
-                                # 1. Mark as in_progress
-                                conn.execute("UPDATE ai_evolution_log SET status='in_progress' WHERE id=?", (plan_id,))
-                                conn.commit()
-                                
-                                # 2. Construct Prompt
-                                sys_prompt = (
-                                    f"You are 1052 AI in Auto-Evolution Mode.\n"
-                                    f"Current Time: {now_str}\n"
-                                    f"Objective: Execute the following improvement plan recorded in your diary: '{plan_content}'\n"
-                                    f"Available Skills:\n{skills_desc}\n"
-                                    f"Instructions:\n"
-                                    f"1. Write code or learn experience to fulfill the plan.\n"
-                                    f"2. Use `execute_skill_function` to create files or run scripts.\n"
-                                    f"3. When done, output a summary of what you achieved."
-                                )
-                                
-                                messages = [{'role': 'system', 'content': sys_prompt}]
-                                
-                                # 3. Call LLM (Simple non-streaming loop for tool use)
-                                # We limit to 3 turns to avoid infinite loops
-                                summary = "Evolution attempted."
-                                success = False
-                                
-                                for turn in range(3):
-                                    payload = {
-                                        'model': model,
-                                        'messages': messages,
-                                        'tools': evolve_tools,
-                                        'tool_choice': 'auto'
-                                    }
-                                    
-                                    try:
-                                        resp = requests.post(f"{base_url}/chat/completions", headers=headers, json=payload, timeout=300)
-                                        resp_json = resp.json()
-                                        
-                                        if 'choices' in resp_json and resp_json['choices']:
-                                            choice = resp_json['choices'][0]
-                                            msg = choice['message']
-                                            messages.append(msg)
-                                            
-                                            if msg.get('tool_calls'):
-                                                # Execute tools
-                                                for tc in msg['tool_calls']:
-                                                    func_name = tc['function']['name']
-                                                    args_str = tc['function']['arguments']
-                                                    call_id = tc['id']
-                                                    
-                                                    res_str = ""
-                                                    try:
-                                                        func_args = json.loads(args_str)
-                                                    except: func_args = {}
-                                                    
-                                                    core_res = execute_core_tool(func_name, func_args)
-                                                    if core_res is not None:
-                                                        res_str = core_res
-                                                    elif func_name == 'execute_skill_function':
-                                                        try:
-                                                            args = func_args
-                                                            res_str = skill_manager.execute_skill_function(
-                                                                args.get('skill_name'), args.get('file_name'), 
-                                                                args.get('function_name'), args.get('kwargs', {})
-                                                            )
-                                                            success = True # If we executed code, assume some success
-                                                        except Exception as e:
-                                                            res_str = f"Error: {e}"
-                                                    elif func_name == 'protocol_remember':
-                                                        try:
-                                                            args = json.loads(args_str)
-                                                            saved_path = protocol_brain.remember(args.get('key'), args.get('value'))
-                                                            res_str = f"Successfully remembered: {args.get('key')} = {args.get('value')}. Saved to {saved_path}"
-                                                            success = True
-                                                        except Exception as e: res_str = str(e)
-                                                    elif func_name == 'protocol_learn_experience':
-                                                        try:
-                                                            args = json.loads(args_str)
-                                                            saved_path = protocol_brain.learn_experience(args.get('problem'), args.get('solution'), args.get('tags'))
-                                                            res_str = f"Experience learned and saved to {saved_path}."
-                                                            success = True
-                                                        except Exception as e: res_str = str(e)
-                                                
-                                                messages.append({
-                                                    "role": "tool",
-                                                    "tool_call_id": call_id,
-                                                    "content": str(res_str)
-                                                })
-                                            else:
-                                                # Final response
-                                                summary = msg.get('content', 'No content')
-                                                break
-                                        else:
-                                            print(f"Evolution LLM Empty Response: {resp.text}")
-                                            break
-                                    except Exception as e:
-                                        print(f"Evolution LLM Error: {e}")
-                                        break
-                                
-                                # 4. Update Log
-                                status = 'completed' if success else 'failed'
-                                conn.execute("UPDATE ai_evolution_log SET status=?, result_summary=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", 
-                                            (status, summary, plan_id))
-                                
-                                # 5. Notify User
-                                # Find a recent conversation to post to? Or the last one?
-                                # Use the conversation_id from the last user message if possible
-                                # But we don't have it here easily unless we query messages again.
-                                # Let's just pick the latest active conversation.
-                                last_conv = conn.execute("SELECT conversation_id FROM messages ORDER BY created_at DESC LIMIT 1").fetchone()
-                                if last_conv:
-                                    notify_msg = f"🌙 **夜间进化报告**\n\n针对计划：_{plan_content}_\n\n执行结果：\n{summary}"
-                                    conn.execute('INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)',
-                                                (last_conv['conversation_id'], 'assistant', notify_msg))
+                            # Waits behind interactive turns and other background
+                            # jobs; the plan stays pending if no slot frees up
+                            try:
+                                with turn_scheduler.slot('background', timeout=60):
+                                    # 1. Mark as in_progress (unless another worker took it)
+                                    claimed = conn.execute("UPDATE ai_evolution_log SET status='in_progress' WHERE id=? AND status='pending'",
+                                                           (plan_id,)).rowcount
                                     conn.commit()
-                                
-                        finally:
-                            loop.close()
+                                    if not claimed:
+                                        continue
+                            
+                                    # 2. Construct Prompt
+                                    sys_prompt = (
+                                        f"You are 1052 AI in Auto-Evolution Mode.\n"
+                                        f"Current Time: {now_str}\n"
+                                        f"Objective: Execute the following improvement plan recorded in your diary: '{plan_content}'\n"
+                                        f"Available Skills:\n{skills_desc}\n"
+                                        f"Instructions:\n"
+                                        f"1. Write code or learn experience to fulfill the plan.\n"
+                                        f"2. Use `execute_skill_function` to create files or run scripts.\n"
+                                        f"3. When done, output a summary of what you achieved."
+                                    )
+                            
+                                    # 3. Run the shared agent turn, limited to 3 model
+                                    # steps to avoid infinite loops
+                                    turn = AgentTurn(None, settings, 'system', purpose='evolution', task='evolution',
+                                                     messages=[{'role': 'system', 'content': sys_prompt}],
+                                                     max_steps=3, exclude_tools={'record_improvement_plan'})
+                                    summary = "Evolution attempted."
+                                    success = False
+                                    for event in iter_turn_events(turn):
+                                        if event['type'] == 'tool_end' and event['tool'] in EVOLUTION_TOOLS:
+                                            # If we executed code or saved knowledge, assume some success
+                                            if not str(event['result']).startswith('Error'):
+                                                success = True
+                                        elif event['type'] == 'error':
+                                            print(f"Evolution LLM Error: {event['content'].strip()}")
+                                        elif event['type'] == 'done' and event['finished']:
+                                            summary = event['content'] or 'No content'
+                            
+                                    # 4. Update Log
+                                    status = 'completed' if success else 'failed'
+                                    conn.execute("UPDATE ai_evolution_log SET status=?, result_summary=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", 
+                                                (status, summary, plan_id))
+                            
+                                    # 5. Notify User
+                                    # Find a recent conversation to post to? Or the last one?
+                                    # Use the conversation_id from the last user message if possible
+                                    # But we don't have it here easily unless we query messages again.
+                                    # Let's just pick the latest active conversation.
+                                    last_conv = conn.execute("SELECT conversation_id FROM messages ORDER BY created_at DESC LIMIT 1").fetchone()
+                                    if last_conv:
+                                        notify_msg = f"🌙 **夜间进化报告**\n\n针对计划：_{plan_content}_\n\n执行结果：\n{summary}"
+                                        conn.execute('INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)',
+                                                    (last_conv['conversation_id'], 'assistant', notify_msg))
+                                        conn.commit()
+                            except QueueFull as e:
+                                print(f"Postponing evolution of plan {plan_id}: {e}")
+                                break
                     
             conn.commit()
             conn.close()
@@ -2519,7 +2820,58 @@ def scheduler_loop():
             print(f"Scheduler error: {e}")
             # traceback.print_exc()
             
-        time.sleep(5) # Check every 5 seconds
+        stop.wait(5) # Check every 5 seconds
+    print("Scheduler thread stopped.")
+
+
+def start_background_services(stop):
+    """
+    Scheduler and Telegram polling: run by one worker only (see start_worker),
+    until `stop` is set because another worker took the lease over.
+    """
+    threading.Thread(target=scheduler_loop, args=(stop,), daemon=True).start()
+
+    # Start Telegram Bot if Token is configured
+    tg_bot = None
+    try:
+        conn = get_db_connection()
+        settings_rows = conn.execute('SELECT * FROM settings').fetchall()
+        settings = {row['key']: row['value'] for row in settings_rows}
+        tg_token = settings.get('telegram_token')
+        conn.close()
+
+        if tg_token:
+            tg_bot = TelegramBot(tg_token, telegram_chat_turn)
+            tg_bot.start_in_thread()
+        else:
+            print("Telegram Token not found in settings.")
+    except Exception as e:
+        print(f"Failed to start Telegram Bot: {e}")
+
+    stop.wait()
+    if tg_bot is not None:
+        tg_bot.stop()
+
+def start_worker():
+    """
+    Start this process's share of the background work. Every worker watches
+    the shared state and keeps its own MCP sessions warm; whichever worker
+    holds the 'background-services' lease also runs the scheduler and bots.
+    """
+    shared_state.start()
+    atexit.register(shared_state.release_leases)
+
+    # Keep MCP servers warm and restart them if they crash or hang
+    try:
+        conn = get_db_connection()
+        row = conn.execute("SELECT value FROM settings WHERE key='mcp_health_interval'").fetchone()
+        conn.close()
+        health_interval = float(row['value']) if row and row['value'] else 30.0
+    except ValueError:
+        health_interval = 30.0
+    mcp_manager.start_supervisor(load_enabled_mcp_servers, interval=health_interval)
+
+    shared_state.run_with_lease('background-services', start_background_services)
 
 
 if __name__ == '__main__':
@@ -2532,23 +2884,7 @@ if __name__ == '__main__':
         webbrowser.open_new(url)
     
     if os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
-        threading.Thread(target=scheduler_loop, daemon=True).start()
+        start_worker()
         threading.Timer(1.5, open_browser).start()
-
-        # Start Telegram Bot if Token is configured
-        try:
-            conn = get_db_connection()
-            settings_rows = conn.execute('SELECT * FROM settings').fetchall()
-            settings = {row['key']: row['value'] for row in settings_rows}
-            tg_token = settings.get('telegram_token')
-            conn.close()
-
-            if tg_token:
-                tg_bot = TelegramBot(tg_token, headless_chat_turn)
-                tg_bot.start_in_thread()
-            else:
-                print("Telegram Token not found in settings.")
-        except Exception as e:
-            print(f"Failed to start Telegram Bot: {e}")
         
-    app.run(debug=False, port=port)
\ No newline at end of file
+    app.run(debug=False, port=port)
@@ -7,6 +7,8 @@ import zipfile
 import hashlib
 import datetime
 
+from run_registry import child_process
+
 def resolve_path(path):
     """
     Resolves a path with enhanced logic for user convenience.
@@ -70,20 +72,23 @@ def execute_command(command, cwd=None):
         
     try:
         # Use shell=True to allow shell commands like 'dir'
-        # Capture output as text
-        result = subprocess.run(
+        # Capture output as text; the command and everything it started are
+        # killed if the agent run is cancelled
+        with child_process(
             command, 
             cwd=cwd, 
             shell=True, 
-            capture_output=True, 
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
             encoding='gbk',  # Windows CMD default encoding is often GBK/CP936
             errors='replace'   # Handle decoding errors gracefully
-        )
+        ) as proc:
+            stdout, stderr = proc.communicate()
         
-        output = result.stdout
-        if result.stderr:
-            output += "\nError Output:\n" + result.stderr
+        output = stdout
+        if stderr:
+            output += "\nError Output:\n" + stderr
             
         return output.strip()
     except Exception as e:
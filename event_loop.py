@@ -0,0 +1,109 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BackgroundLoop:
+    """
+    One long-lived asyncio event loop on a daemon thread.
+
+    Async resources (pooled MCP sessions, aiohttp connection pools, background
+    tasks) are bound to the loop they were created on, so they can only be
+    shared between requests if every request runs on the same loop. Sync code
+    (Flask handlers, channel threads, the scheduler) hands coroutines to this
+    loop with `run_sync()` / `submit()` and streams async generators back
+    through a thread-safe queue with `iterate()`.
+
+    The loop is started on first use. Blocking work must not run on it;
+    `asyncio.to_thread` uses the loop's own executor of `max_workers` threads.
+    """
+    def __init__(self, name='async-loop', max_workers=32):
+        self.name = name
+        self.max_workers = max_workers
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def started(self):
+        return self._loop is not None
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop.set_default_executor(
+                    ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"{self.name}-worker"))
+                self._thread = threading.Thread(target=self._loop.run_forever, name=self.name, daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def in_loop(self):
+        """True when called from the loop's own thread."""
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop; returns a concurrent Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, coro):
+        """Await a coroutine on the loop from any event loop."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def run_sync(self, coro, timeout=None):
+        """Run a coroutine from synchronous code and wait for the result."""
+        if self.in_loop():
+            coro.close()
+            raise RuntimeError("run_sync() called from the event loop thread")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            # Timed out or the caller was interrupted: stop the coroutine too
+            future.cancel()
+            raise
+
+    def iterate(self, agen):
+        """
+        Drive an async generator on the loop and yield its items to
+        synchronous code as they are produced. Closing the returned generator
+        early (e.g. the HTTP client went away) cancels the async one.
+        """
+        items = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put(('item', item))
+            except Exception as e:
+                items.put(('error', e))
+            finally:
+                await agen.aclose()
+                items.put(('done', None))
+
+        future = self.submit(pump())
+        try:
+            while True:
+                kind, value = items.get()
+                if kind == 'done':
+                    return
+                if kind == 'error':
+                    raise value
+                yield value
+        finally:
+            future.cancel()
+
+    def stop(self, timeout=5):
+        """Stop the loop thread (at interpreter exit)."""
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
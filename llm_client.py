@@ -0,0 +1,652 @@
+import asyncio
+import json
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Statuses worth retrying on another provider: rate limits, server errors,
+# and auth errors (a bad key only affects that provider)
+FAILOVER_STATUSES = {401, 403, 408, 429, 500, 502, 503, 504, 529}
+
+DEFAULT_BASE_URL = 'https://api.siliconflow.cn/v1'
+DEFAULT_MODEL = 'deepseek-ai/DeepSeek-V3.2'
+
+# Model setting per task type, in fallback order. Background tasks fall back
+# to background_model, then to the interactive model.
+TASK_MODELS = {
+    'interactive': ['model'],
+    'reflection': ['reflection_model', 'background_model'],
+    'evolution': ['evolution_model', 'background_model'],
+    'summarization': ['summary_model', 'background_model'],
+}
+
+
+def is_token_line(line):
+    """True for an SSE line whose delta carries content or tool calls (not a role, keep-alive or usage chunk)."""
+    line = line.strip()
+    if not line.startswith(b'data:'):
+        return False
+    try:
+        chunk = json.loads(line[5:])
+    except ValueError:
+        return False
+    if not isinstance(chunk, dict):
+        return False
+    for choice in chunk.get('choices') or []:
+        delta = choice.get('delta') or {}
+        if delta.get('content') or delta.get('tool_calls'):
+            return True
+    return False
+
+
+class ProviderError(Exception):
+    """Every configured provider failed (the last error is chained)."""
+
+
+class ProviderHealth:
+    """Rolling health of one endpoint (base_url + model). Thread-safe via the client lock."""
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.ttft = None # EWMA seconds to first token, streamed calls only
+        self.duration = None # EWMA seconds per non-streamed call (not used for ranking)
+        self.error_rate = 0.0 # EWMA of failures (1) / successes (0)
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.last_error = None
+
+    def success(self):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.error_rate = (1 - self.alpha) * self.error_rate
+
+    def failure(self, error, retry_after=None):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha
+        self.last_error = error
+        # Back off 5s, 10s, 20s ... up to 5 minutes, or what the server asked for
+        delay = retry_after if retry_after else min(5 * 2 ** (self.consecutive_failures - 1), 300)
+        self.cooldown_until = time.time() + delay
+
+    def record_ttft(self, seconds):
+        self.ttft = seconds if self.ttft is None else (1 - self.alpha) * self.ttft + self.alpha * seconds
+
+    def record_duration(self, seconds):
+        self.duration = seconds if self.duration is None else (1 - self.alpha) * self.duration + self.alpha * seconds
+
+    @property
+    def available(self):
+        return time.time() >= self.cooldown_until
+
+    def snapshot(self):
+        return {
+            'ttft': round(self.ttft, 3) if self.ttft is not None else None,
+            'duration': round(self.duration, 3) if self.duration is not None else None,
+            'error_rate': round(self.error_rate, 3),
+            'requests': self.requests,
+            'failures': self.failures,
+            'cooldown_until': self.cooldown_until if not self.available else None,
+            'last_error': self.last_error,
+        }
+
+
+class RoutedResponse:
+    """
+    A provider's response (requests or aiohttp) with the provider that
+    answered and its timings; attribute access falls through to the response.
+    """
+    def __init__(self, client, provider, response, started, ttfb=None):
+        self._client = client
+        self.provider = provider
+        self._response = response
+        self._started = started
+        self.ttfb = ttfb # seconds until the response headers arrived
+        self.ttft = None # seconds until the first content or tool-call delta
+        self.cancelled = False
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _first_token(self):
+        self.ttft = time.perf_counter() - self._started
+        self._client.record_ttft(self.provider, self.ttft)
+
+    def timings(self):
+        """ttfb/ttft/duration in seconds so far; a non-streamed body counts as its first token."""
+        duration = time.perf_counter() - self._started
+        return {'ttfb': self.ttfb, 'ttft': self.ttft if self.ttft is not None else duration, 'duration': duration}
+
+
+class RoutedAsyncResponse(RoutedResponse):
+    """
+    A streamed aiohttp response: `content` yields the body lines and records
+    time to first token (the first content or tool-call delta) and mid-stream failures
+    against the provider. Use as an async context manager.
+    """
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._response.release()
+        else:
+            # Abandoned mid-stream (error or cancelled run): drop the connection
+            self.cancel()
+
+    @property
+    def content(self):
+        return self._iter_content()
+
+    async def _iter_content(self):
+        try:
+            async for line in self._response.content:
+                if self.ttft is None and is_token_line(line):
+                    self._first_token()
+                yield line
+        except Exception as e:
+            if not self.cancelled:
+                self._client.record_failure(self.provider, f"stream: {e}")
+            raise
+
+    def cancel(self):
+        """Abandon this stream (it lost a hedge race or its run was cancelled)."""
+        self.cancelled = True
+        if self.ttft is None:
+            # Still waiting: count the wait so far as its TTFT so a stuck
+            # endpoint drops down the ranking
+            self._client.record_ttft(self.provider, time.perf_counter() - self._started)
+        self._response.close()
+
+
+class HedgedAsyncResponse(RoutedAsyncResponse):
+    """
+    The winner of a hedged request; replays the first line its attempt already
+    read. Timings count from when the hedged request started.
+    """
+    def __init__(self, routed, first_line, lines, started):
+        super().__init__(routed._client, routed.provider, routed._response, started,
+                         routed.ttfb + (routed._started - started))
+        self._first_line = first_line
+        self._lines = lines
+
+    @property
+    def content(self):
+        return self._replay()
+
+    async def _replay(self):
+        # The attempt's own stream already records TTFT against the provider;
+        # this only keeps the hedged request's timing
+        if is_token_line(self._first_line):
+            self.ttft = time.perf_counter() - self._started
+        yield self._first_line
+        async for line in self._lines:
+            if self.ttft is None and is_token_line(line):
+                self.ttft = time.perf_counter() - self._started
+            yield line
+
+
+class LLMClient:
+    """
+    Shared HTTP client for OpenAI-compatible chat completion calls.
+
+    Keeps one pooled requests.Session per provider base URL (for blocking,
+    non-streamed calls from background threads) and one pooled aiohttp
+    session per event loop (for streamed agent turns), so calls reuse warm
+    keep-alive connections instead of paying DNS/TCP/TLS setup each time.
+    """
+    def __init__(self, pool_size=10, connect_timeout=10, read_timeout=300, stream_usage=True,
+                 hedge_delay=0, hedge_budget=0.1):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stream_usage = stream_usage # ask for a usage chunk at the end of streams
+        self.hedge_delay = hedge_delay # seconds without a first chunk before hedging; 0 disables
+        self.hedge_budget = hedge_budget # share of a conversation's requests that may be hedged
+        self.hedges = OrderedDict() # conversation -> {'requests': n, 'hedges': n}
+        self.hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'over_budget': 0}
+        self.usage = {'responses': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'cache_hits': 0}
+        self._sessions = {} # base_url -> requests.Session
+        self._async_sessions = weakref.WeakKeyDictionary() # event loop -> aiohttp.ClientSession
+        self._responses = weakref.WeakKeyDictionary() # aiohttp.ClientSession -> WeakSet of its responses
+        self.health = {} # (base_url, model) -> ProviderHealth
+        self._lock = threading.Lock()
+
+    def configure(self, pool_size=None, connect_timeout=None, read_timeout=None, stream_usage=None,
+                  hedge_delay=None, hedge_budget=None):
+        """Change pool size/timeouts. Sessions are rebuilt on their next use."""
+        old_sessions, old_async_sessions = {}, {}
+        with self._lock:
+            if stream_usage is not None:
+                self.stream_usage = stream_usage
+            if hedge_delay is not None:
+                self.hedge_delay = hedge_delay
+            if hedge_budget is not None:
+                self.hedge_budget = hedge_budget
+            changed = pool_size is not None and pool_size != self.pool_size
+            if pool_size is not None:
+                self.pool_size = pool_size
+            if connect_timeout is not None:
+                self.connect_timeout = connect_timeout
+            if read_timeout is not None:
+                self.read_timeout = read_timeout
+            if changed:
+                old_sessions, old_async_sessions = self._sessions, dict(self._async_sessions)
+                self._sessions = {}
+                self._async_sessions = weakref.WeakKeyDictionary()
+        # Blocking calls read their whole response, so closing only drops idle
+        # connections (busy ones are closed when they are returned)
+        for session in old_sessions.values():
+            session.close()
+        # In-flight streams keep their connection; each old aiohttp session is
+        # closed on its own loop once they finish
+        for loop, session in old_async_sessions.items():
+            if not session.closed and not loop.is_closed():
+                asyncio.run_coroutine_threadsafe(self._close_when_idle(session), loop)
+
+    async def _close_when_idle(self, session):
+        while any(not response.closed for response in self._responses.get(session, ())):
+            await asyncio.sleep(1)
+        await session.close()
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def session(self, base_url):
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[base_url] = session
+            return session
+
+    def _with_stream_usage(self, payload):
+        if payload.get('stream') and self.stream_usage and 'stream_options' not in payload:
+            payload = dict(payload, stream_options={'include_usage': True})
+        return payload
+
+    def post_chat(self, base_url, headers, payload, timeout=None):
+        """POST {base_url}/chat/completions on the pooled session and return the (read) response."""
+        return self.session(base_url).post(f"{base_url}/chat/completions", headers=headers, json=payload,
+                                           timeout=timeout or self.timeout)
+
+    def async_session(self):
+        """Pooled aiohttp session for the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.get(loop)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(limit_per_host=self.pool_size, keepalive_timeout=60)
+                session = aiohttp.ClientSession(connector=connector)
+                self._async_sessions[loop] = session
+                self._responses[session] = weakref.WeakSet()
+            return session
+
+    async def apost_chat(self, base_url, headers, payload, timeout=None):
+        """
+        Async POST {base_url}/chat/completions on the loop's pooled session. The
+        caller must release() or close() the returned response.
+        """
+        timeout = timeout or aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        payload = self._with_stream_usage(payload)
+        session = self.async_session()
+        response = await session.post(f"{base_url}/chat/completions", headers=headers, json=payload, timeout=timeout)
+        with self._lock:
+            self._responses[session].add(response)
+        return response
+
+    # --- Provider routing ---
+    def providers(self, settings, task='interactive'):
+        """
+        Endpoints to route between: the llm_providers setting (JSON list of
+        {name, base_url, api_key, model, weight, enabled, task_models}), else
+        the single base_url/api_key/model settings. Entries missing a field
+        inherit it from the single settings.
+
+        For a background task with its own model (see TASK_MODELS, or an
+        entry's task_models mapping) the task-model endpoints come first and
+        the interactive ones stay behind them as fallbacks.
+        """
+        api_key = settings.get('api_key') or ('ollama' if settings.get('model_provider') == 'local' else None)
+        default = {
+            'name': 'default',
+            'base_url': settings.get('base_url') or DEFAULT_BASE_URL,
+            'api_key': api_key,
+            'model': settings.get('model') or DEFAULT_MODEL,
+            'weight': 1.0,
+        }
+        try:
+            configured = json.loads(settings.get('llm_providers') or '[]')
+        except ValueError:
+            print("Invalid llm_providers setting, using the default provider.")
+            configured = []
+
+        providers = []
+        for index, entry in enumerate(configured):
+            if not isinstance(entry, dict) or entry.get('enabled') is False:
+                continue
+            provider = dict(default, name=f"provider-{index + 1}")
+            provider.update({key: value for key, value in entry.items() if value not in (None, '')})
+            try:
+                provider['weight'] = max(float(provider.get('weight') or 1), 0.01)
+            except (TypeError, ValueError):
+                provider['weight'] = 1.0
+            providers.append(provider)
+        if not providers and default['api_key']:
+            providers.append(default)
+        providers = [p for p in providers if p.get('api_key')]
+
+        task_model = self.task_model(settings, task)
+        tiered = []
+        for provider in providers:
+            model = (provider.get('task_models') or {}).get(task) or task_model
+            if model and model != provider['model']:
+                tiered.append(dict(provider, model=model, tier=0))
+        seen = {(p['base_url'], p['model']) for p in tiered}
+        tiered += [dict(p, tier=1 if tiered else 0) for p in providers if (p['base_url'], p['model']) not in seen]
+        for provider in tiered:
+            provider.pop('task_models', None)
+        return tiered
+
+    @staticmethod
+    def task_model(settings, task):
+        """Model configured for a non-interactive task, or None to use the interactive model."""
+        if task == 'interactive':
+            return None
+        for key in TASK_MODELS.get(task, []):
+            if settings.get(key):
+                return settings[key]
+        return None
+
+    def _health(self, provider):
+        key = (provider['base_url'], provider['model'])
+        health = self.health.get(key)
+        if health is None:
+            health = self.health[key] = ProviderHealth()
+        return health
+
+    def rank(self, providers):
+        """
+        Order providers for a request: the task's own model tier first, then
+        available ones, fastest rolling TTFT (scaled by weight and error rate)
+        first; unmeasured endpoints are tried early so they get a measurement.
+        Cooling-down ones go last as a fallback.
+        """
+        with self._lock:
+            def score(provider):
+                health = self._health(provider)
+                ttft = health.ttft if health.ttft is not None else 0.0
+                return (provider.get('tier', 0), not health.available,
+                        ttft * (1 + 4 * health.error_rate) / provider['weight'])
+            return sorted(providers, key=score)
+
+    def record_ttft(self, provider, seconds):
+        with self._lock:
+            self._health(provider).record_ttft(seconds)
+
+    def record_duration(self, provider, seconds):
+        with self._lock:
+            self._health(provider).record_duration(seconds)
+
+    def record_success(self, provider):
+        with self._lock:
+            self._health(provider).success()
+
+    def record_failure(self, provider, error, retry_after=None):
+        with self._lock:
+            self._health(provider).failure(str(error)[:200], retry_after)
+        print(f"LLM provider '{provider['name']}' ({provider['base_url']}) failed: {error}")
+
+    def provider_status(self, settings, task='interactive'):
+        status = []
+        for provider in self.providers(settings, task):
+            with self._lock:
+                health = self._health(provider).snapshot()
+            status.append(dict(health, name=provider['name'], base_url=provider['base_url'],
+                               model=provider['model'], weight=provider['weight']))
+        return status
+
+    @staticmethod
+    def _retry_after(headers):
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+    def _prepare(self, provider, payload):
+        headers = {'Authorization': f"Bearer {provider['api_key']}", 'Content-Type': 'application/json'}
+        return headers, dict(payload, model=provider['model'])
+
+    def _open(self, providers, payload, timeout):
+        """Failover loop behind chat(): the first provider that accepts the request wins."""
+        last_error = None
+        for provider in providers:
+            headers, body = self._prepare(provider, payload)
+            started = time.perf_counter()
+            try:
+                response = self.post_chat(provider['base_url'], headers, body, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.record_failure(provider, e)
+                last_error = e
+                continue
+            if response.status_code in FAILOVER_STATUSES:
+                self.record_failure(provider, f"HTTP {response.status_code}", self._retry_after(response.headers))
+                last_error = requests.HTTPError(f"{response.status_code} from {provider['base_url']}", response=response)
+                response.close()
+                continue
+            self.record_success(provider)
+            # requests has read the whole body by now, so this is the full
+            # generation time, not a TTFT; keep it out of the ranking EWMA
+            ttfb = time.perf_counter() - started
+            self.record_duration(provider, ttfb)
+            return RoutedResponse(self, provider, response, started, ttfb)
+        raise ProviderError(f"All LLM providers failed: {last_error}") from last_error
+
+    def chat(self, settings, payload, timeout=None, task='interactive'):
+        """
+        POST a (non-streamed) chat completion to the best available provider,
+        failing over to the next one on connection errors, timeouts and
+        FAILOVER_STATUSES. Returns a RoutedResponse (`.provider` tells which
+        endpoint answered). Other error statuses are returned as-is for the
+        caller to report. Streamed calls go through achat().
+
+        `task` picks the model tier (TASK_MODELS).
+        """
+        providers = self.rank(self.providers(settings, task))
+        if not providers:
+            raise ProviderError("No LLM provider configured (API Key missing).")
+        return self._open(providers, payload, timeout)
+
+    # --- Hedged requests ---
+    def _start_hedging(self, conversation):
+        with self._lock:
+            self.hedge_stats['requests'] += 1
+            budget = self.hedges.pop(conversation, None) or {'requests': 0, 'hedges': 0}
+            budget['requests'] += 1
+            self.hedges[conversation] = budget
+            while len(self.hedges) > 1000:
+                self.hedges.popitem(last=False)
+
+    def _take_hedge(self, conversation):
+        """
+        Spend one hedge from the conversation's budget: at most one duplicate
+        plus hedge_budget of its requests, so hedging can't double the bill.
+        """
+        with self._lock:
+            budget = self.hedges.get(conversation)
+            if budget is None or budget['hedges'] >= 1 + self.hedge_budget * budget['requests']:
+                self.hedge_stats['over_budget'] += 1
+                return False
+            budget['hedges'] += 1
+            self.hedge_stats['hedged'] += 1
+            return True
+
+    def _hedge_order(self, providers):
+        """The hedge goes to the next-best provider (or the same one if it is the only one)."""
+        return providers[1:] + providers[:1]
+
+    def _hedge_won(self, index):
+        if index:
+            with self._lock:
+                self.hedge_stats['hedge_wins'] += 1
+
+    async def _aopen(self, providers, payload, timeout):
+        last_error = None
+        for provider in providers:
+            headers, body = self._prepare(provider, payload)
+            started = time.perf_counter()
+            try:
+                response = await self.apost_chat(provider['base_url'], headers, body, timeout=timeout)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                self.record_failure(provider, e)
+                last_error = e
+                continue
+            if response.status in FAILOVER_STATUSES:
+                self.record_failure(provider, f"HTTP {response.status}", self._retry_after(response.headers))
+                last_error = aiohttp.ClientResponseError(response.request_info, (), status=response.status,
+                                                         message=f"from {provider['base_url']}")
+                response.release()
+                continue
+            self.record_success(provider)
+            return RoutedAsyncResponse(self, provider, response, started, time.perf_counter() - started)
+        raise ProviderError(f"All LLM providers failed: {last_error}") from last_error
+
+    async def achat(self, settings, payload, timeout=None, conversation=None, task='interactive'):
+        """
+        Async version of chat() for streaming requests; returns a
+        RoutedAsyncResponse. Use as `async with await client.achat(...) as response`.
+        Requests are hedged when hedge_delay is set: see _ahedged_chat. The
+        hedge budget is kept per `conversation` key; calls without one are
+        not hedged rather than sharing a budget.
+        """
+        providers = self.rank(self.providers(settings, task))
+        if not providers:
+            raise ProviderError("No LLM provider configured (API Key missing).")
+        if self.hedge_delay > 0 and conversation is not None:
+            return await self._ahedged_chat(providers, payload, timeout, conversation)
+        return await self._aopen(providers, payload, timeout)
+
+    async def _ahedged_chat(self, providers, payload, timeout, conversation):
+        """
+        Streaming request with a backup: if the first attempt has not produced
+        a non-empty SSE line within hedge_delay seconds, a duplicate goes to the
+        next provider. The first attempt to produce a line wins; the other is
+        cancelled and its connection closed.
+        """
+        self._start_hedging(conversation)
+        started = time.perf_counter()
+
+        async def attempt(order):
+            response = await self._aopen(order, payload, timeout)
+            try:
+                if response.status != 200:
+                    return response, None, None
+                lines = response.content
+                async for line in lines:
+                    if line.strip():
+                        return response, line, lines
+                return response, None, lines
+            except asyncio.CancelledError:
+                response.cancel()
+                raise
+
+        tasks = {asyncio.ensure_future(attempt(providers)): 0}
+        attempts = list(tasks)
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done and self._take_hedge(conversation):
+                print(f"LLM request has no first token after {self.hedge_delay}s, sending a hedged request.")
+                hedge = asyncio.ensure_future(attempt(self._hedge_order(providers)))
+                tasks[hedge] = 1
+                attempts.append(hedge)
+
+            error = None
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index = tasks.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if winner is None:
+                        winner = task
+                        self._hedge_won(index)
+                if winner is not None:
+                    response, first_line, lines = winner.result()
+                    if first_line is None:
+                        return response
+                    return HedgedAsyncResponse(response, first_line, lines, started)
+            if isinstance(error, ProviderError):
+                raise error
+            raise ProviderError(f"All LLM providers failed: {error}") from error
+        finally:
+            # Whether we return, fail or are cancelled ourselves, no other
+            # attempt may keep streaming from its provider
+            for task in attempts:
+                task.cancel()
+            await asyncio.wait(attempts)
+            for task in attempts:
+                if task is not winner and not task.cancelled() and task.exception() is None:
+                    task.result()[0].cancel()
+
+    def hedging_status(self):
+        with self._lock:
+            return dict(self.hedge_stats, hedge_delay=self.hedge_delay, hedge_budget=self.hedge_budget)
+
+    # --- Prompt cache accounting ---
+    def record_usage(self, usage):
+        """
+        Count prompt-cache hits from a response's `usage` object. DeepSeek reports
+        prompt_cache_hit_tokens; OpenAI-compatible APIs report
+        prompt_tokens_details.cached_tokens.
+        """
+        if not usage:
+            return
+        cached = self.cached_tokens(usage)
+        with self._lock:
+            self.usage['responses'] += 1
+            self.usage['prompt_tokens'] += usage.get('prompt_tokens') or 0
+            self.usage['cached_tokens'] += cached
+            if cached:
+                self.usage['cache_hits'] += 1
+
+    @staticmethod
+    def cached_tokens(usage):
+        cached = usage.get('prompt_cache_hit_tokens')
+        if cached is None:
+            cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+        return cached or 0
+
+    def cache_stats(self):
+        with self._lock:
+            stats = dict(self.usage)
+        stats['hit_rate'] = stats['cached_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0.0
+        return stats
+
+    async def aclose(self):
+        """Close the running loop's aiohttp session (call before closing a short-lived loop)."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._async_sessions.pop(loop, None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            session.close()
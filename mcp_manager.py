@@ -0,0 +1,1074 @@
+import os
+import sys
+import json
+import asyncio
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+from pydantic import AnyUrl
+
+import mcp.types as types
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+from mcp.client.sse import sse_client
+from mcp.types import CallToolResult, TextContent
+
+from event_loop import BackgroundLoop
+
+# Transports understood by the pool. 'sse' rows reach a remote (shared) server
+# over HTTP; their env column holds extra HTTP headers (e.g. Authorization).
+SUPPORTED_TYPES = ('stdio', 'sse')
+
+
+def config_hash(server_config):
+    """
+    Hash of the mcp_servers fields that decide how a server is launched.
+    A pooled session is only reused while its row still hashes the same.
+    """
+    launch_fields = {k: server_config.get(k) for k in ('type', 'command', 'args', 'env', 'url')}
+    return hashlib.sha1(json.dumps(launch_fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Applies resource limits to itself, then execs the real server command:
+# RLIMIT_DATA caps the heap, RLIMIT_CPU the total CPU seconds (past it the
+# kernel kills the server and the supervisor starts a fresh one) and nice only
+# lowers the scheduling priority, it doesn't cap CPU use.
+# POSIX only (`resource` does not exist on Windows); elsewhere servers start
+# without these limits.
+_LIMITS_LAUNCHER = (
+    "import os, sys, resource\n"
+    "memory_bytes, cpu_seconds, nice = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])\n"
+    "if memory_bytes > 0:\n"
+    "    resource.setrlimit(resource.RLIMIT_DATA, (memory_bytes, memory_bytes))\n"
+    "if cpu_seconds > 0:\n"
+    "    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 5))\n"
+    "if nice > 0:\n"
+    "    os.nice(nice)\n"
+    "os.execvp(sys.argv[4], sys.argv[4:])\n"
+)
+
+
+def can_limit_resources():
+    # A frozen build has no python interpreter to run the launcher with
+    return os.name == 'posix' and not getattr(sys, 'frozen', False)
+
+
+def build_stdio_params(server_config, limits=None):
+    """
+    Build StdioServerParameters from an mcp_servers row (args/env stored as JSON).
+    `limits` ({'memory_mb', 'cpu_seconds', 'nice'}) caps the server process
+    where supported (see _LIMITS_LAUNCHER). Node servers (e.g. via npx) also
+    get memory_mb as their V8 heap limit, since RLIMIT_DATA doesn't reliably
+    bind V8; that part works on every platform.
+    """
+    args = json.loads(server_config.get('args') or '[]')
+    if not isinstance(args, list):
+        raise ValueError("Args must be a list of strings (JSON Array).")
+
+    env = json.loads(server_config.get('env') or '{}')
+    # Merge current env with provided env
+    full_env = os.environ.copy()
+    full_env.update(env)
+
+    command = server_config['command']
+    memory_mb = int((limits or {}).get('memory_mb') or 0)
+    cpu_seconds = int((limits or {}).get('cpu_seconds') or 0)
+    nice = int((limits or {}).get('nice') or 0)
+    if memory_mb > 0:
+        node_options = full_env.get('NODE_OPTIONS', '')
+        if '--max-old-space-size' not in node_options:
+            full_env['NODE_OPTIONS'] = f"{node_options} --max-old-space-size={memory_mb}".strip()
+    if (memory_mb > 0 or cpu_seconds > 0 or nice > 0) and can_limit_resources():
+        args = ['-c', _LIMITS_LAUNCHER, str(memory_mb * 1024 * 1024), str(cpu_seconds), str(nice),
+                command] + args
+        command = sys.executable
+
+    return StdioServerParameters(
+        command=command,
+        args=args,
+        env=full_env
+    )
+
+
+def open_transport(server_config, sse_read_timeout=60 * 60, limits=None):
+    """
+    Return the (read, write) stream context manager for an mcp_servers row.
+    """
+    if server_config.get('type') == 'sse':
+        if not server_config.get('url'):
+            raise ValueError("SSE MCP servers require a url.")
+        headers = json.loads(server_config.get('env') or '{}')
+        return sse_client(server_config['url'], headers=headers or None, sse_read_timeout=sse_read_timeout)
+    if server_config.get('type') == 'stdio':
+        return stdio_client(build_stdio_params(server_config, limits))
+    raise ValueError(f"Unsupported MCP server type: {server_config.get('type')}")
+
+
+def to_openai_tool(tool):
+    # Convert MCP tool schema to OpenAI tool schema
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.name,
+            "description": tool.description,
+            "parameters": tool.inputSchema
+        }
+    }
+
+
+# Resources and prompts are offered to the model as one extra tool per server
+def resource_tool_name(server_id):
+    return f"read_resource_{server_id}"
+
+
+def prompt_tool_name(server_id):
+    return f"get_prompt_{server_id}"
+
+
+def is_resource_or_prompt_tool(server_config, tool_name):
+    """Whether tool_name is the read-only resource/prompt tool generated for this server."""
+    return tool_name in (resource_tool_name(server_config['id']), prompt_tool_name(server_config['id']))
+
+
+def build_resource_tool(server_config, resources, limit=50):
+    lines = []
+    for resource in resources[:limit]:
+        line = f"- {resource.uri}"
+        if resource.name and resource.name != str(resource.uri):
+            line += f" ({resource.name})"
+        if resource.description:
+            line += f": {resource.description}"
+        lines.append(line)
+    if len(resources) > limit:
+        lines.append(f"- ... and {len(resources) - limit} more")
+    return {
+        "type": "function",
+        "function": {
+            "name": resource_tool_name(server_config['id']),
+            "description": f"Read a resource (document, schema, file) from MCP server '{server_config.get('name')}'. Available resources:\n" + "\n".join(lines),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "uri": {"type": "string", "description": "URI of the resource to read"}
+                },
+                "required": ["uri"]
+            }
+        }
+    }
+
+
+def build_prompt_tool(server_config, prompts):
+    lines = []
+    for prompt in prompts:
+        line = f"- {prompt.name}"
+        if prompt.arguments:
+            line += "(" + ", ".join(arg.name + ("" if arg.required else "?") for arg in prompt.arguments) + ")"
+        if prompt.description:
+            line += f": {prompt.description}"
+        lines.append(line)
+    return {
+        "type": "function",
+        "function": {
+            "name": prompt_tool_name(server_config['id']),
+            "description": f"Get a prompt template from MCP server '{server_config.get('name')}'. Available prompts:\n" + "\n".join(lines),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string", "enum": [prompt.name for prompt in prompts]},
+                    "arguments": {"type": "object", "description": "Prompt arguments (string values)"}
+                },
+                "required": ["name"]
+            }
+        }
+    }
+
+
+def format_resource_contents(result):
+    output = []
+    for content in result.contents:
+        if isinstance(content, types.TextResourceContents):
+            output.append(content.text)
+        else:
+            output.append(f"[binary resource {content.uri} ({content.mimeType or 'unknown type'}), {len(content.blob)} base64 chars]")
+    return "\n".join(output)
+
+
+def format_prompt_result(result):
+    output = []
+    for message in result.messages:
+        content = message.content
+        text = content.text if isinstance(content, TextContent) else str(content)
+        output.append(f"{message.role}: {text}")
+    return "\n\n".join(output)
+
+
+def format_tool_result(result: CallToolResult):
+    output = []
+    for content in result.content:
+        if isinstance(content, TextContent):
+            output.append(content.text)
+        else:
+            output.append(str(content)) # Fallback for image/embedded
+    return "\n".join(output)
+
+
+def latency_summary(samples):
+    """Summarize latencies (seconds) as milliseconds: nearest-rank p50/p95/p99, min, max, mean."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def percentile(p):
+        rank = max(1, int(-(-p * len(ordered) // 100))) # ceil(p% of n)
+        return round(ordered[rank - 1] * 1000, 2)
+
+    return {
+        'count': len(ordered),
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'min': round(ordered[0] * 1000, 2),
+        'max': round(ordered[-1] * 1000, 2),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 2),
+    }
+
+
+# Seconds a benchmark may spend per tool call, on top of the server's start
+BENCHMARK_CALL_BUDGET = 5
+
+
+def benchmark_timeout(iterations, start_timeout=60):
+    """How long a benchmark may run before the caller gives up on the server."""
+    return start_timeout + BENCHMARK_CALL_BUDGET * iterations
+
+
+async def benchmark_server(server_config, tool_name=None, tool_args=None, iterations=0, limits=None):
+    """
+    Time a fresh, unpooled connection to a server: transport start (process
+    spawn for stdio, stream connect for sse), initialize and list_tools, in
+    milliseconds. With `tool_name`, the tool is then called `iterations` times
+    and the call latencies are summarized. Errors in the tool calls are
+    counted rather than raised.
+
+    For stdio, `spawn` only covers creating the process; the server's own
+    startup (interpreter, imports) shows up in `initialize`.
+    """
+    timings = {}
+    started = time.perf_counter()
+    async with open_transport(server_config, limits=limits) as (read, write):
+        timings['spawn'] = round((time.perf_counter() - started) * 1000, 2)
+        async with ClientSession(read, write) as session:
+            t = time.perf_counter()
+            await session.initialize()
+            timings['initialize'] = round((time.perf_counter() - t) * 1000, 2)
+
+            t = time.perf_counter()
+            tools = (await session.list_tools()).tools
+            timings['list_tools'] = round((time.perf_counter() - t) * 1000, 2)
+
+            report = {'tools': [tool.name for tool in tools], 'timings': timings}
+            if tool_name and tool_name not in report['tools']:
+                report['call_tool'] = {'tool': tool_name, 'error': 'Tool not found'}
+            elif tool_name and iterations > 0:
+                samples = []
+                errors = 0
+                for _ in range(iterations):
+                    t = time.perf_counter()
+                    try:
+                        result = await session.call_tool(tool_name, tool_args or {})
+                        if result.isError:
+                            errors += 1
+                    except Exception:
+                        errors += 1
+                    samples.append(time.perf_counter() - t)
+                report['call_tool'] = dict(latency_summary(samples), tool=tool_name, errors=errors)
+    timings['total'] = round((time.perf_counter() - started) * 1000, 2)
+    return report
+
+
+class MCPSession:
+    """
+    A single initialized ClientSession kept open by a long-running owner task.
+    anyio requires the transport/session context managers to be entered and
+    exited by the same task, so the owner task holds them until close().
+    """
+    def __init__(self, server_config, on_notification=None, sse_read_timeout=60 * 60, limits=None):
+        self.server_config = server_config
+        self.on_notification = on_notification
+        self.sse_read_timeout = sse_read_timeout
+        self.limits = limits
+        self.started_at = None
+        self.name = server_config.get('name')
+        self.config_hash = config_hash(server_config)
+        self.session = None
+        self.capabilities = None
+        self.error = None
+        self.listeners = {} # progress token -> callback(dict), for calls in flight
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._dead = asyncio.Event()
+        self._task = None
+
+    @property
+    def alive(self):
+        return self.session is not None and not self._dead.is_set()
+
+    @property
+    def crashed(self):
+        # Went away after a successful start without being asked to stop
+        return self._dead.is_set() and self.started_at is not None and not self._stop.is_set()
+
+    async def start(self, timeout=None):
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            raise TimeoutError(f"MCP server '{self.name}' did not initialize within {timeout}s")
+        if not self.alive:
+            raise self.error or ConnectionError(f"MCP server '{self.name}' failed to start")
+
+    async def _run(self):
+        try:
+            # For SSE the httpx client inside the transport keeps the
+            # connection to the remote server alive between requests
+            async with open_transport(self.server_config, self.sse_read_timeout, self.limits) as (read, write):
+                async with ClientSession(read, write) as session:
+                    initialized = await session.initialize()
+                    self.capabilities = initialized.capabilities
+                    self.session = session
+                    self.started_at = time.time()
+                    self._ready.set()
+
+                    # Keep the session open until asked to stop or the server goes away.
+                    # Draining incoming messages is required: the SDK's notification
+                    # stream is unbuffered and would otherwise block the receive loop.
+                    drain = asyncio.create_task(self._drain(session))
+                    stop = asyncio.create_task(self._stop.wait())
+                    await asyncio.wait({drain, stop}, return_when=asyncio.FIRST_COMPLETED)
+                    drain.cancel()
+                    stop.cancel()
+        except Exception as e:
+            self.error = e
+            print(f"MCP server '{self.name}' session ended: {e}")
+        finally:
+            self.session = None
+            self._dead.set()
+            self._ready.set()
+
+    async def _drain(self, session):
+        # Ends when the server process exits (stdio) or the event stream
+        # drops (sse) and the session's streams are closed
+        async for message in session.incoming_messages:
+            if isinstance(message, Exception):
+                print(f"MCP server '{self.name}' sent an invalid message: {message}")
+            elif isinstance(message, types.ServerNotification):
+                try:
+                    self._dispatch(message.root)
+                except Exception as e:
+                    print(f"Error handling notification from MCP server '{self.name}': {e}")
+
+    def _dispatch(self, notification):
+        if isinstance(notification, types.ProgressNotification):
+            listener = self.listeners.get(notification.params.progressToken)
+            if listener:
+                listener({'progress': notification.params.progress, 'total': notification.params.total})
+        elif isinstance(notification, types.LoggingMessageNotification):
+            # Log messages are not tied to a request; show them to every call in flight
+            data = notification.params.data
+            message = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+            for listener in list(self.listeners.values()):
+                listener({'message': message, 'level': notification.params.level})
+
+        if self.on_notification:
+            self.on_notification(self, notification)
+
+    async def request(self, coro):
+        """
+        Await a session request, failing fast if the server dies mid-call
+        instead of waiting forever for a response that will never come.
+        If the caller is cancelled, the request is cancelled (and finished)
+        before this returns, so the caller's queue slot isn't freed early.
+        """
+        req = asyncio.ensure_future(coro)
+        dead = asyncio.ensure_future(self._dead.wait())
+        try:
+            done, _ = await asyncio.wait({req, dead}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            req.cancel()
+            # Don't let a second cancel cut this short and leave req running
+            while not req.done():
+                try:
+                    await asyncio.wait({req})
+                except asyncio.CancelledError:
+                    pass
+            raise
+        finally:
+            dead.cancel()
+        if req in done:
+            return req.result()
+        req.cancel()
+        await asyncio.wait({req})
+        raise ConnectionError(f"MCP server '{self.name}' exited while handling the request")
+
+    async def close(self):
+        self._stop.set()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout=10)
+            except Exception as e:
+                print(f"Error closing MCP server '{self.name}': {e}")
+
+
+class ToolCallQueue:
+    """
+    Concurrency limit for one server's tool calls, with a queue that is fair
+    between callers: waiting callers (conversations) are served round-robin,
+    so one turn firing many parallel calls can't starve the others.
+    Manager loop only.
+    """
+    def __init__(self, limit):
+        self.limit = max(1, int(limit))
+        self.active = 0
+        self._waiters = OrderedDict() # caller -> deque of futures, in round-robin order
+        self.calls = 0
+        self.queued_calls = 0 # calls that had to wait for a slot
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    @property
+    def depth(self):
+        return sum(len(waiters) for waiters in list(self._waiters.values()))
+
+    def set_limit(self, limit):
+        self.limit = max(1, int(limit))
+        self._wake()
+
+    async def acquire(self, caller=None):
+        self.calls += 1
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(caller, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed to us just as we were cancelled
+                self.release()
+            else:
+                self._discard(caller, future)
+            raise
+
+        wait = time.monotonic() - started
+        self.queued_calls += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.last_wait = wait
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        while self.active < self.limit and self._waiters:
+            caller, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            # Move this caller to the back of the line
+            del self._waiters[caller]
+            if waiters:
+                self._waiters[caller] = waiters
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    def _discard(self, caller, future):
+        waiters = self._waiters.get(caller)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiters[caller]
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'queued': self.depth,
+            'calls': self.calls,
+            'queued_calls': self.queued_calls,
+            'avg_wait': self.total_wait / self.queued_calls if self.queued_calls else 0.0,
+            'max_wait': self.max_wait,
+            'last_wait': self.last_wait,
+        }
+
+
+class MCPManager:
+    """
+    Pool of long-lived MCP sessions keyed by mcp_servers row id (+ config hash).
+
+    Sessions are bound to the event loop they were created on, so the manager
+    lives on one BackgroundLoop (its own, or the application's shared loop
+    when one is passed in); `run()` / `run_sync()` bridge calls onto it from
+    any other thread or loop.
+
+    It also keeps the tool catalog of every server (in memory and in the
+    mcp_tool_cache table), so building the per-turn tool list is a lookup
+    instead of a list_tools round-trip to each server.
+    """
+    def __init__(self, db_file=None, start_timeout=60, sse_read_timeout=60 * 60, max_concurrency=4, runtime=None):
+        self.db_file = db_file
+        self.start_timeout = start_timeout
+        self.sse_read_timeout = sse_read_timeout
+        self.max_concurrency = max_concurrency # per-server default when the row sets none
+        self.queues = {} # server_id -> ToolCallQueue (manager loop only)
+        self.resource_ttl = 300 # seconds, for resources the server can't notify us about
+        self.resources = {} # (server_id, uri) -> {'text', 'fetched_at', 'subscribed'} (manager loop only)
+        self.resource_limits = {} # {'memory_mb', 'cpu_seconds', 'nice'} for stdio servers started from now on
+        self.restarts = {} # server_id -> number of supervisor restarts
+        self._backoff = {} # server_id -> {'failures', 'next_attempt'}
+        self._supervisor = None
+        self.sessions = {} # server_id -> MCPSession
+        self.catalog = {} # server_id -> {'hash': config_hash, 'tools': [openai tool schema]}
+        self.health = {} # server_id -> {'state': 'ok'|'degraded', 'error', 'updated_at'}
+        self._catalog_lock = threading.Lock()
+        self._locks = {} # server_id -> asyncio.Lock (manager loop only)
+        self._discovering = {} # server_id -> in-flight refresh task (manager loop only)
+        self.runtime = runtime or BackgroundLoop(name="mcp-manager")
+
+    @property
+    def loop(self):
+        return self.runtime.loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the manager loop; returns a concurrent Future."""
+        return self.runtime.submit(coro)
+
+    async def run(self, coro):
+        """Await a manager coroutine from any event loop."""
+        return await self.runtime.run(coro)
+
+    def run_sync(self, coro, timeout=None):
+        """Run a manager coroutine from synchronous code and wait for the result."""
+        return self.runtime.run_sync(coro, timeout)
+
+    # --- Pool (manager loop only) ---
+    async def get_session(self, server_config):
+        """
+        Return a live, initialized session for this server row, starting one if
+        needed. A session whose config hash no longer matches is recycled.
+        """
+        server_id = server_config.get('id')
+        if server_id is None:
+            raise ValueError("Pooled MCP sessions require an mcp_servers row id.")
+
+        lock = self._locks.setdefault(server_id, asyncio.Lock())
+        async with lock:
+            pooled = self.sessions.get(server_id)
+            if pooled and pooled.alive and self._is_current(pooled, server_config):
+                return pooled
+
+            if pooled:
+                self.sessions.pop(server_id, None)
+                await pooled.close()
+
+            # Subscriptions die with the old session, so its cached reads can't be trusted
+            self._forget_resources(server_id)
+            pooled = MCPSession(server_config, on_notification=self._on_notification,
+                                sse_read_timeout=self.sse_read_timeout, limits=dict(self.resource_limits))
+            try:
+                await pooled.start(timeout=self.start_timeout)
+            except Exception as e:
+                self.set_health(server_id, 'degraded', str(e))
+                raise
+            self.sessions[server_id] = pooled
+            self.set_health(server_id, 'ok')
+            print(f"MCP server '{pooled.name}' started (pooled).")
+            return pooled
+
+    def _is_current(self, pooled, server_config):
+        # stdio processes were started under the resource limits of the time
+        if pooled.config_hash != config_hash(server_config):
+            return False
+        return server_config.get('type') != 'stdio' or pooled.limits == self.resource_limits
+
+    async def list_tools(self, server_config):
+        # Listing is idempotent, so a connection that dropped under us
+        # (remote server restarted, SSE stream timed out) is retried once
+        try:
+            pooled = await self.get_session(server_config)
+            result = await pooled.request(pooled.session.list_tools())
+        except ConnectionError as e:
+            print(f"Reconnecting to MCP server '{server_config.get('name')}': {e}")
+            pooled = await self.get_session(server_config)
+            result = await pooled.request(pooled.session.list_tools())
+        return result.tools
+
+    async def list_resources(self, server_config):
+        pooled = await self.get_session(server_config)
+        result = await pooled.request(pooled.session.list_resources())
+        return result.resources
+
+    async def list_prompts(self, server_config):
+        pooled = await self.get_session(server_config)
+        result = await pooled.request(pooled.session.list_prompts())
+        return result.prompts
+
+    async def refresh_tools(self, server_config):
+        """
+        Ask the server for its tools, resources and prompts and store them in
+        the catalog. Returns the tools as OpenAI tool schemas; resources and
+        prompts are exposed through one read_resource_<id> / get_prompt_<id>
+        tool each.
+        """
+        pooled = await self.get_session(server_config)
+        capabilities = pooled.capabilities
+        tools = []
+        if capabilities is None or capabilities.tools is not None:
+            tools = [to_openai_tool(tool) for tool in await self.list_tools(server_config)]
+
+        try:
+            if capabilities is not None and capabilities.resources is not None:
+                resources = await self.list_resources(server_config)
+                if resources:
+                    tools.append(build_resource_tool(server_config, resources))
+            if capabilities is not None and capabilities.prompts is not None:
+                prompts = await self.list_prompts(server_config)
+                if prompts:
+                    tools.append(build_prompt_tool(server_config, prompts))
+        except Exception as e:
+            # Tools still work without them
+            print(f"Error listing resources/prompts for server {server_config.get('name')}: {e}")
+
+        self._store_catalog(server_config['id'], config_hash(server_config), tools)
+        return tools
+
+    async def discover_tools(self, server_configs, timeout):
+        """
+        Refresh the catalog of several servers concurrently, waiting at most
+        `timeout` seconds. Returns {server_id: tools} for the servers that
+        answered in time. Late servers are marked degraded but keep going in
+        the background; their tools land in the catalog once they respond.
+        """
+        tasks = {}
+        for server_config in server_configs:
+            server_id = server_config['id']
+            task = self._discovering.get(server_id)
+            if task is None or task.done():
+                task = asyncio.ensure_future(self.refresh_tools(server_config))
+                task.add_done_callback(lambda t, cfg=server_config: self._discovery_done(cfg, t))
+                self._discovering[server_id] = task
+            tasks[server_id] = task
+
+        if not tasks:
+            return {}
+        await asyncio.wait(tasks.values(), timeout=timeout)
+
+        discovered = {}
+        for server_id, task in tasks.items():
+            if task.done() and not task.cancelled() and task.exception() is None:
+                discovered[server_id] = task.result()
+            elif not task.done():
+                self.set_health(server_id, 'degraded', f"No tool list within {timeout}s, skipped for this turn")
+        return discovered
+
+    def _discovery_done(self, server_config, task):
+        server_id = server_config['id']
+        if self._discovering.get(server_id) is task:
+            self._discovering.pop(server_id, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            print(f"Error listing tools for server {server_config.get('name')}: {error}")
+            self.set_health(server_id, 'degraded', str(error))
+        else:
+            self.set_health(server_id, 'ok')
+
+    def set_health(self, server_id, state, error=None):
+        self.health[server_id] = {'state': state, 'error': error, 'updated_at': time.time()}
+
+    def get_status(self, server_id):
+        """Health of a server row as reported to the settings page."""
+        status = dict(self.health.get(server_id) or {'state': 'unknown', 'error': None, 'updated_at': None})
+        pooled = self.sessions.get(server_id)
+        status['running'] = bool(pooled and pooled.alive)
+        status['started_at'] = pooled.started_at if pooled and pooled.alive else None
+        status['restarts'] = self.restarts.get(server_id, 0)
+        backoff = self._backoff.get(server_id)
+        status['next_restart_at'] = backoff['next_attempt'] if backoff else None
+        queue = self.queues.get(server_id)
+        status['queue'] = queue.stats() if queue else None
+        status['cached_resources'] = sum(1 for key in list(self.resources) if key[0] == server_id)
+        return status
+
+    # --- Supervisor (manager loop only) ---
+    def start_supervisor(self, load_servers, interval=30, ping_timeout=10):
+        """
+        Start servers right away and keep them healthy: every `interval`
+        seconds each enabled server is pinged, and crashed or wedged servers
+        are restarted with exponential backoff. `load_servers` returns the
+        enabled mcp_servers rows (called from a worker thread).
+        """
+        if self._supervisor is not None:
+            return
+        self._supervisor = self.submit(self._supervise(load_servers, interval, ping_timeout))
+
+    async def _supervise(self, load_servers, interval, ping_timeout):
+        print("MCP supervisor started.")
+        while True:
+            try:
+                servers = await asyncio.to_thread(load_servers)
+                enabled_ids = {server['id'] for server in servers}
+
+                # Servers that were disabled or deleted don't need a process
+                for server_id in list(self.sessions.keys()):
+                    if server_id not in enabled_ids:
+                        await self.close_session(server_id)
+
+                await asyncio.gather(*(self._check_server(server, ping_timeout) for server in servers))
+            except Exception as e:
+                print(f"MCP supervisor error: {e}")
+            await asyncio.sleep(interval)
+
+    async def _check_server(self, server_config, ping_timeout):
+        server_id = server_config['id']
+        backoff = self._backoff.get(server_id)
+        if backoff and time.time() < backoff['next_attempt']:
+            return
+
+        pooled = self.sessions.get(server_id)
+        if pooled and pooled.alive and self._is_current(pooled, server_config):
+            try:
+                await asyncio.wait_for(pooled.request(pooled.session.send_ping()), ping_timeout)
+                return
+            except Exception as e:
+                # Wedged: the process is up but not answering
+                print(f"MCP server '{pooled.name}' failed health check: {e!r}, restarting.")
+                self.set_health(server_id, 'degraded', f"Health check failed: {e!r}")
+                await self.close_session(server_id)
+                self.restarts[server_id] = self.restarts.get(server_id, 0) + 1
+        elif pooled and pooled.crashed:
+            print(f"MCP server '{pooled.name}' crashed, restarting.")
+            self.restarts[server_id] = self.restarts.get(server_id, 0) + 1
+
+        try:
+            await self.get_session(server_config)
+            self._backoff.pop(server_id, None)
+            # Warm the tool catalog too, so the first turn is a pure lookup
+            if self.get_cached_tools(server_config) is None:
+                await self.refresh_tools(server_config)
+        except Exception as e:
+            failures = (backoff['failures'] if backoff else 0) + 1
+            delay = min(5 * 2 ** (failures - 1), 600)
+            self._backoff[server_id] = {'failures': failures, 'next_attempt': time.time() + delay}
+            print(f"MCP server '{server_config.get('name')}' failed to start ({e}), retrying in {delay}s.")
+
+    def _on_notification(self, pooled, notification):
+        server_id = pooled.server_config['id']
+        if isinstance(notification, types.ResourceUpdatedNotification):
+            self.resources.pop((server_id, str(notification.params.uri)), None)
+        elif isinstance(notification, (types.ToolListChangedNotification,
+                                       types.ResourceListChangedNotification,
+                                       types.PromptListChangedNotification)):
+            if isinstance(notification, types.ResourceListChangedNotification):
+                self._forget_resources(server_id)
+            print(f"MCP server '{pooled.name}' changed its {notification.method.split('/')[1]} list, refreshing catalog.")
+            asyncio.ensure_future(self._refresh_quietly(pooled.server_config))
+
+    async def _refresh_quietly(self, server_config):
+        try:
+            await self.refresh_tools(server_config)
+        except Exception as e:
+            print(f"Error refreshing tools for server {server_config.get('name')}: {e}")
+
+    def _queue_for(self, server_config):
+        limit = server_config.get('max_concurrency') or self.max_concurrency
+        queue = self.queues.get(server_config['id'])
+        if queue is None:
+            queue = self.queues[server_config['id']] = ToolCallQueue(limit)
+        elif queue.limit != max(1, int(limit)):
+            queue.set_limit(limit)
+        return queue
+
+    # --- Resources and prompts (manager loop only) ---
+    def _forget_resources(self, server_id):
+        for key in [key for key in self.resources if key[0] == server_id]:
+            del self.resources[key]
+
+    async def read_resource(self, server_config, uri, caller=None):
+        """
+        Read a resource as text. Contents are cached by URI: servers that
+        support subscriptions are subscribed on first read and the entry lives
+        until they report an update; otherwise it expires after resource_ttl.
+        """
+        server_id = server_config['id']
+        uri = str(AnyUrl(uri))
+        entry = self.resources.get((server_id, uri))
+        current = self.sessions.get(server_id)
+        if entry:
+            if entry['subscribed'] and current and current.alive:
+                return entry['text']
+            if time.time() - entry['fetched_at'] < self.resource_ttl:
+                return entry['text']
+
+        pooled = await self.get_session(server_config)
+        queue = self._queue_for(server_config)
+        await queue.acquire(caller)
+        try:
+            result = await pooled.request(pooled.session.read_resource(AnyUrl(uri)))
+            subscribed = False
+            resources_capability = pooled.capabilities.resources if pooled.capabilities else None
+            if resources_capability and resources_capability.subscribe:
+                try:
+                    await pooled.request(pooled.session.subscribe_resource(AnyUrl(uri)))
+                    subscribed = True
+                except Exception as e:
+                    print(f"Could not subscribe to {uri} on MCP server '{pooled.name}': {e}")
+        finally:
+            queue.release()
+
+        text = format_resource_contents(result)
+        # A recycled session would have dropped the subscription
+        if self.sessions.get(server_id) is pooled:
+            self.resources[(server_id, uri)] = {'text': text, 'fetched_at': time.time(), 'subscribed': subscribed}
+        return text
+
+    async def get_prompt(self, server_config, name, arguments=None, caller=None):
+        pooled = await self.get_session(server_config)
+        arguments = {key: str(value) for key, value in (arguments or {}).items()}
+        queue = self._queue_for(server_config)
+        await queue.acquire(caller)
+        try:
+            result = await pooled.request(pooled.session.get_prompt(name, arguments))
+        finally:
+            queue.release()
+        return format_prompt_result(result)
+
+    async def call_tool(self, server_config, tool_name, tool_args, on_progress=None, caller=None):
+        """
+        Call a tool and return its text output. With `on_progress`, the request
+        carries a progress token and the callback receives the server's progress
+        notifications ({'progress', 'total'}) and log messages ({'message', 'level'})
+        while the call runs. The callback runs on the manager loop.
+
+        Calls beyond the server's concurrency limit wait in a queue that is
+        served round-robin by `caller` (e.g. the conversation id).
+        """
+        if tool_name == resource_tool_name(server_config['id']):
+            return await self.read_resource(server_config, tool_args.get('uri'), caller=caller)
+        if tool_name == prompt_tool_name(server_config['id']):
+            return await self.get_prompt(server_config, tool_args.get('name'), tool_args.get('arguments'), caller=caller)
+
+        pooled = await self.get_session(server_config)
+        queue = self._queue_for(server_config)
+        await queue.acquire(caller)
+        try:
+            # The session may have been recycled while we waited
+            if not pooled.alive:
+                pooled = await self.get_session(server_config)
+            if on_progress is None:
+                result = await pooled.request(pooled.session.call_tool(tool_name, tool_args))
+                return format_tool_result(result)
+
+            token = uuid.uuid4().hex
+            pooled.listeners[token] = on_progress
+            try:
+                request = types.ClientRequest(types.CallToolRequest(
+                    method="tools/call",
+                    params=types.CallToolRequestParams(
+                        name=tool_name,
+                        arguments=tool_args,
+                        _meta=types.RequestParams.Meta(progressToken=token)
+                    )
+                ))
+                result = await pooled.request(pooled.session.send_request(request, types.CallToolResult))
+            finally:
+                pooled.listeners.pop(token, None)
+            return format_tool_result(result)
+        finally:
+            queue.release()
+
+    async def close_session(self, server_id):
+        lock = self._locks.setdefault(server_id, asyncio.Lock())
+        async with lock:
+            pooled = self.sessions.pop(server_id, None)
+            if pooled:
+                await pooled.close()
+                print(f"MCP server '{pooled.name}' stopped.")
+
+    async def close_all(self):
+        for server_id in list(self.sessions.keys()):
+            await self.close_session(server_id)
+
+    # --- Tool catalog (thread-safe) ---
+    def get_cached_tools(self, server_config):
+        """
+        Return the cached OpenAI tool schemas for a server row, or None when the
+        catalog is empty or was built for a different launch config.
+        """
+        server_id = server_config.get('id')
+        expected_hash = config_hash(server_config)
+
+        with self._catalog_lock:
+            entry = self.catalog.get(server_id)
+        if entry is None:
+            entry = self._load_catalog(server_id)
+        if entry is None or entry['hash'] != expected_hash:
+            return None
+        return list(entry['tools'])
+
+    def _store_catalog(self, server_id, hash_value, tools):
+        with self._catalog_lock:
+            self.catalog[server_id] = {'hash': hash_value, 'tools': tools}
+        if not self.db_file:
+            return
+        try:
+            conn = sqlite3.connect(self.db_file)
+            conn.execute('INSERT OR REPLACE INTO mcp_tool_cache (server_id, config_hash, tools, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
+                         (server_id, hash_value, json.dumps(tools, ensure_ascii=False)))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"Error saving MCP tool cache: {e}")
+
+    def _load_catalog(self, server_id):
+        if not self.db_file:
+            return None
+        try:
+            conn = sqlite3.connect(self.db_file)
+            row = conn.execute('SELECT config_hash, tools FROM mcp_tool_cache WHERE server_id = ?', (server_id,)).fetchone()
+            conn.close()
+        except Exception as e:
+            print(f"Error loading MCP tool cache: {e}")
+            return None
+        if not row:
+            return None
+
+        entry = {'hash': row[0], 'tools': json.loads(row[1])}
+        with self._catalog_lock:
+            self.catalog[server_id] = entry
+        return entry
+
+    def forget_tools(self, server_id):
+        with self._catalog_lock:
+            self.catalog.pop(server_id, None)
+        self.health.pop(server_id, None)
+        if not self.db_file:
+            return
+        try:
+            conn = sqlite3.connect(self.db_file)
+            conn.execute('DELETE FROM mcp_tool_cache WHERE server_id = ?', (server_id,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"Error clearing MCP tool cache: {e}")
+
+    def refresh_in_background(self, server_config):
+        """Rebuild a server's catalog entry without blocking the caller."""
+        self.submit(self._refresh_quietly(server_config))
+
+    # --- Thread-safe entry points ---
+    def invalidate(self, server_id):
+        """
+        Recycle the pooled session for a server row (called after the row is
+        edited or deleted). Non-blocking; the old process is shut down in the
+        background and the next call starts a fresh one.
+        """
+        if not self.runtime.started:
+            return
+        self.submit(self.close_session(server_id))
+
+    def reconcile(self, server_rows):
+        """
+        Bring the in-memory catalog and pooled sessions in line with the
+        current mcp_servers rows (after another worker process edited them):
+        catalog entries built for another config are dropped so they are
+        re-read from the shared cache table, and sessions whose row changed,
+        was disabled or deleted are recycled.
+        """
+        current = {row['id']: config_hash(row) for row in server_rows if row.get('enabled')}
+        with self._catalog_lock:
+            for server_id, entry in list(self.catalog.items()):
+                if current.get(server_id) != entry['hash']:
+                    self.catalog.pop(server_id, None)
+        for server_id, pooled in list(self.sessions.items()):
+            if current.get(server_id) != pooled.config_hash:
+                self.invalidate(server_id)
+
+    def set_resource_limits(self, limits):
+        """
+        Change the caps for stdio servers. Running servers were started under
+        the old caps, so they are recycled; the next call (or the supervisor)
+        starts them again.
+        """
+        limits = dict(limits)
+        if limits == self.resource_limits:
+            return
+        self.resource_limits = limits
+        for server_id, pooled in list(self.sessions.items()):
+            if pooled.server_config.get('type') == 'stdio' and pooled.limits != limits:
+                self.invalidate(server_id)
+
+    def shutdown(self, timeout=15):
+        if not self.runtime.started:
+            return
+        try:
+            self.run_sync(self.close_all(), timeout=timeout)
+        except Exception as e:
+            print(f"Error shutting down MCP sessions: {e}")
+
+
+# Headless benchmark of every enabled server in a database:
+#   python mcp_manager.py chat.db [--iterations 20 --tool echo --args '{"text": "hi"}'] [--json]
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the MCP servers configured in a 1052 database.")
+    parser.add_argument('db', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat.db'))
+    parser.add_argument('--tool', help="tool to call on every server that has it")
+    parser.add_argument('--args', default='{}', help="tool arguments as JSON")
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help="print one JSON object per server")
+    options = parser.parse_args()
+
+    conn = sqlite3.connect(options.db)
+    conn.row_factory = sqlite3.Row
+    rows = [dict(row) for row in conn.execute('SELECT * FROM mcp_servers WHERE enabled = 1 ORDER BY id').fetchall()]
+    conn.close()
+
+    timeout = benchmark_timeout(options.iterations)
+    for row in rows:
+        if row['type'] not in SUPPORTED_TYPES:
+            continue
+        try:
+            report = asyncio.run(asyncio.wait_for(
+                benchmark_server(row, options.tool, json.loads(options.args), options.iterations), timeout))
+            if 'error' in report.get('call_tool', {}):
+                report.pop('call_tool') # this server doesn't have the tool
+        except asyncio.TimeoutError:
+            # A hung server is reported and skipped, the others still run
+            report = {'error': f'Server did not answer within {timeout}s'}
+        except Exception as e:
+            report = {'error': str(e)}
+        report = dict(report, server=row['name'], id=row['id'])
+        report.pop('tools', None)
+
+        if options.json:
+            print(json.dumps(report, ensure_ascii=False))
+        elif 'error' in report:
+            print(f"{row['name']}: error: {report['error']}")
+        else:
+            line = ", ".join(f"{key} {value}ms" for key, value in report['timings'].items())
+            print(f"{row['name']}: {line}")
+            calls = report.get('call_tool')
+            if calls:
+                print(f"    {calls['tool']} x{calls['count']}: p50 {calls['p50']}ms, p95 {calls['p95']}ms, "
+                      f"p99 {calls['p99']}ms, max {calls['max']}ms, errors {calls['errors']}")
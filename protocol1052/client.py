@@ -22,6 +22,12 @@ class Protocol1052:
         else:
             return Memory(user_id=self.user_id, agent_id=self.agent_id)
 
+    def reload_memory(self):
+        """
+        Re-read memory from storage (another process may have written it).
+        """
+        self.memory = self._load_or_create_memory()
+
     def save_memory(self):
         self.memory.updated_at = datetime.datetime.now().isoformat()
         self.storage.save_memory(self.memory)
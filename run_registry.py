@@ -0,0 +1,280 @@
+import contextlib
+import contextvars
+import os
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+import uuid
+
+# The run whose code is executing; tool threads inherit it (asyncio.to_thread
+# copies the context), so child processes can be tied to their run
+current_run = contextvars.ContextVar('current_run', default=None)
+
+
+def run_info(run_id, conversation_id, channel, purpose, started_at, step, step_started, cancelled, worker=None):
+    now = time.time()
+    return {
+        'id': run_id,
+        'conversation_id': conversation_id,
+        'channel': channel,
+        'purpose': purpose,
+        'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started_at)),
+        'elapsed': now - started_at,
+        'step': step,
+        'step_elapsed': now - step_started,
+        'cancelled': cancelled,
+        'worker': worker,
+    }
+
+
+class Run:
+    """
+    One in-flight agent turn. Whatever the run is blocked on (its task, an
+    HTTP stream, a child process) registers a cancel callback, so cancel()
+    stops it right away instead of at the next checkpoint.
+    """
+    def __init__(self, conversation_id, channel, purpose, registry=None):
+        self.id = uuid.uuid4().hex
+        self.conversation_id = conversation_id
+        self.channel = channel
+        self.purpose = purpose
+        self.started_at = time.time()
+        self.step = 'queued'
+        self.step_started = self.started_at
+        self.cancelled = None # reason, once cancelled
+        self.registry = registry
+        self.step_saved = True # the shared runs row has the current step
+        self.row_saved = False # the shared runs row exists
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def set_step(self, step):
+        # Called from the event loop, so no database write here; the
+        # registry's next poll saves it
+        self.step = step
+        self.step_started = time.time()
+        self.step_saved = False
+
+    def on_cancel(self, callback):
+        """Run callback() on cancel (right away if already cancelled). Returns a remover."""
+        with self._lock:
+            if self.cancelled is None:
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def cancel(self, reason='cancelled'):
+        with self._lock:
+            if self.cancelled is not None:
+                return False
+            self.cancelled = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error cancelling run {self.id}: {e}")
+        return True
+
+    def to_dict(self):
+        worker = self.registry.worker if self.registry is not None else None
+        return run_info(self.id, self.conversation_id, self.channel, self.purpose, self.started_at,
+                        self.step, self.step_started, self.cancelled, worker)
+
+
+class RunRegistry:
+    """
+    In-flight runs by id. Entries are removed as soon as their run finishes.
+
+    With a `db_file` the runs table is shared by every worker process on that
+    database: list() shows all workers' runs, cancel() and superseding work
+    across workers, and poll() (called from the SharedState watcher) picks up
+    cancellations of this worker's runs and keeps its rows alive. Rows of a
+    worker that stopped heart-beating for `stale_after` seconds are dropped.
+
+    start() and finish() are called on the event loop, so they never touch
+    the database: poll() inserts and deletes this worker's rows.
+    """
+    def __init__(self, db_file=None, worker=None, stale_after=30):
+        self.db_file = db_file
+        self.worker = worker
+        self.stale_after = stale_after
+        self.runs = {} # run id -> Run (this worker's)
+        self._new = [] # runs whose row poll() has yet to insert
+        self._finished = [] # ids of saved rows poll() has yet to delete
+        self._last_heartbeat = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def start(self, conversation_id, channel, purpose='chat'):
+        """
+        Register a new run. Earlier runs of the same conversation are
+        cancelled: a new message supersedes the turn still answering the last
+        one (in other workers once poll() has saved the run).
+        """
+        run = Run(conversation_id, channel, purpose, self)
+        with self._lock:
+            superseded = [r for r in self.runs.values()
+                          if conversation_id is not None and r.conversation_id == conversation_id]
+            self.runs[run.id] = run
+            if self.db_file:
+                self._new.append(run)
+        for older in superseded:
+            older.cancel('superseded')
+        return run
+
+    def finish(self, run):
+        with self._lock:
+            if self.runs.pop(run.id, None) is None:
+                return
+            if run.row_saved:
+                self._finished.append(run.id)
+
+    def get(self, run_id):
+        with self._lock:
+            return self.runs.get(run_id)
+
+    def list(self):
+        with self._lock:
+            local = {run.id: run.to_dict() for run in self.runs.values()}
+        if self.db_file:
+            conn = self._connect()
+            try:
+                rows = conn.execute('SELECT id, conversation_id, channel, purpose, started_at, step, step_started, '
+                                    'cancelled, worker FROM runs WHERE heartbeat >= ?',
+                                    (time.time() - self.stale_after,)).fetchall()
+            finally:
+                conn.close()
+            # This worker's runs are listed from memory (fresher, and
+            # including ones poll() hasn't saved yet)
+            for row in rows:
+                if row[8] != self.worker:
+                    local[row[0]] = run_info(*row)
+        return sorted(local.values(), key=lambda info: info['elapsed'], reverse=True)
+
+    def cancel(self, run_id, reason='cancelled'):
+        """Returns False for unknown (or already finished) runs."""
+        found = False
+        if self.db_file:
+            conn = self._connect()
+            try:
+                conn.execute('UPDATE runs SET cancelled = ? WHERE id = ? AND cancelled IS NULL', (reason, run_id))
+                conn.commit()
+                found = conn.execute('SELECT 1 FROM runs WHERE id = ?', (run_id,)).fetchone() is not None
+            finally:
+                conn.close()
+        run = self.get(run_id)
+        if run is not None:
+            # Ours: stop it now rather than on the next poll
+            run.cancel(reason)
+            found = True
+        return found
+
+    def poll(self, conn):
+        """
+        Apply cancellations made by other workers, save step changes and
+        refresh this worker's heartbeat.
+        """
+        if not self.db_file:
+            return
+        with self._lock:
+            new, self._new = self._new, []
+            finished, self._finished = self._finished, []
+            local = list(self.runs.values())
+        self._save_rows(conn, new, finished)
+        if local:
+            rows = conn.execute('SELECT id, cancelled FROM runs WHERE worker = ? AND cancelled IS NOT NULL',
+                                (self.worker,)).fetchall()
+            for run_id, reason in rows:
+                run = self.get(run_id)
+                if run is not None:
+                    run.cancel(reason)
+            changed = [run for run in local if not run.step_saved]
+            for run in changed:
+                run.step_saved = True
+                conn.execute('UPDATE runs SET step = ?, step_started = ? WHERE id = ?',
+                             (run.step, run.step_started, run.id))
+            if changed:
+                conn.commit()
+
+        now = time.time()
+        if now - self._last_heartbeat > self.stale_after / 3:
+            self._last_heartbeat = now
+            if local:
+                conn.execute('UPDATE runs SET heartbeat = ? WHERE worker = ?', (now, self.worker))
+            # Rows left behind by a worker that died mid-run
+            conn.execute('DELETE FROM runs WHERE heartbeat < ?', (now - self.stale_after,))
+            conn.commit()
+
+    def _save_rows(self, conn, new, finished):
+        """Insert rows of runs started since the last poll, delete rows of finished ones."""
+        for run in new:
+            if self.get(run.id) is None:
+                continue # finished before it was saved
+            if run.conversation_id is not None:
+                # A message that arrived later in another worker wins
+                newer = conn.execute('SELECT 1 FROM runs WHERE conversation_id = ? AND started_at > ? '
+                                     'AND cancelled IS NULL', (run.conversation_id, run.started_at)).fetchone()
+                if newer:
+                    run.cancel('superseded')
+                conn.execute("UPDATE runs SET cancelled = 'superseded' WHERE conversation_id = ? AND started_at < ? "
+                             "AND cancelled IS NULL", (run.conversation_id, run.started_at))
+            conn.execute('INSERT INTO runs (id, worker, conversation_id, channel, purpose, started_at, step, '
+                         'step_started, cancelled, heartbeat) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (run.id, self.worker, run.conversation_id, run.channel, run.purpose, run.started_at,
+                          run.step, run.step_started, run.cancelled, time.time()))
+            run.step_saved = True
+            with self._lock:
+                run.row_saved = True
+                if run.id not in self.runs:
+                    # Finished while we were saving it
+                    self._finished.append(run.id)
+        for run_id in finished:
+            conn.execute('DELETE FROM runs WHERE id = ?', (run_id,))
+        if new or finished:
+            conn.commit()
+
+
+def kill_process_tree(proc):
+    """Kill a process started by child_process() together with its children."""
+    if proc.poll() is not None:
+        return
+    try:
+        if os.name == 'nt':
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(proc.pid)], capture_output=True)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except (OSError, subprocess.SubprocessError):
+        proc.kill()
+
+
+@contextlib.contextmanager
+def child_process(*args, **kwargs):
+    """
+    subprocess.Popen in its own process group, killed with everything it
+    started when the current run is cancelled.
+    """
+    if os.name == 'nt':
+        kwargs['creationflags'] = kwargs.get('creationflags', 0) | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    proc = subprocess.Popen(*args, **kwargs)
+    run = current_run.get()
+    remove = run.on_cancel(lambda: kill_process_tree(proc)) if run is not None else (lambda: None)
+    try:
+        yield proc
+    finally:
+        remove()
+        if proc.poll() is None:
+            kill_process_tree(proc)
+            proc.wait()
@@ -0,0 +1,200 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class SharedState:
+    """
+    Coordination between worker processes that serve the same database.
+    SQLite in WAL mode is the shared backend:
+
+    - cache versions: a worker that changes shared data (settings, MCP
+      servers, protocol memory, reflections) calls bump(name); every other
+      worker's watcher sees the new version and runs the on_change()
+      callbacks for it. Skills need no version: every turn reloads them
+      from disk.
+    - leases: one worker at a time owns a named lease (e.g. the scheduler and
+      bots); it passes to another worker when the owner stops renewing it,
+      and the old owner is told to stop.
+    - lock(): a cross-process mutex (an immediate write transaction).
+    - pollers: other cross-worker checks (run cancellation) piggyback on the
+      watcher thread.
+
+    Tables (cache_versions, leases) are created by the application's init_db.
+    """
+    def __init__(self, db_file, poll_interval=0.25, lease_ttl=30):
+        self.db_file = db_file
+        self.poll_interval = poll_interval
+        self.lease_ttl = lease_ttl
+        self.worker = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.versions = {} # name -> last version this worker has seen
+        self._checked = False # versions from before this worker started are not news
+        self.callbacks = {} # name -> [callback()]
+        self.pollers = []
+        self.leases = {} # name -> callback(stop) run once this worker holds the lease
+        self.held = set() # leases this worker holds
+        self.started = set() # leases whose callback is running here
+        self.stops = {} # name -> threading.Event set when this worker loses the lease
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # --- Cache versions ---
+    def bump(self, name):
+        """Tell the other workers that `name` changed."""
+        conn = self.connect()
+        try:
+            conn.execute('INSERT INTO cache_versions (name, version) VALUES (?, 1) '
+                         'ON CONFLICT(name) DO UPDATE SET version = version + 1', (name,))
+            version = conn.execute('SELECT version FROM cache_versions WHERE name = ?', (name,)).fetchone()[0]
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            # Our own change is already applied here
+            self.versions[name] = version
+
+    def on_change(self, name, callback):
+        with self._lock:
+            self.callbacks.setdefault(name, []).append(callback)
+
+    def check_versions(self, conn):
+        rows = conn.execute('SELECT name, version FROM cache_versions').fetchall()
+        changed = []
+        with self._lock:
+            for row in rows:
+                if self._checked and self.versions.get(row['name']) != row['version']:
+                    changed.append(row['name'])
+                self.versions[row['name']] = row['version']
+            self._checked = True
+        for name in changed:
+            for callback in list(self.callbacks.get(name, [])):
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"Error reloading {name} after another worker changed it: {e}")
+
+    # --- Leases ---
+    def run_with_lease(self, name, callback):
+        """
+        Run callback(stop) on a thread in whichever worker acquires lease `name`.
+        `stop` is a threading.Event that is set if this worker loses the lease;
+        the callback runs again if the lease comes back.
+        """
+        with self._lock:
+            self.leases[name] = callback
+        self._renew_leases()
+
+    def _renew_leases(self):
+        now = time.time()
+        conn = self.connect()
+        try:
+            with self._lock:
+                names = list(self.leases)
+            for name in names:
+                conn.execute('INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) '
+                             'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                             'WHERE leases.owner = excluded.owner OR leases.expires_at < ?',
+                             (name, self.worker, now + self.lease_ttl, now))
+                conn.commit()
+                owner = conn.execute('SELECT owner FROM leases WHERE name = ?', (name,)).fetchone()['owner']
+                # Renewals run on the watcher and on run_with_lease() callers;
+                # the check and the start happen together so a callback is
+                # never started twice
+                with self._lock:
+                    callback = self.leases.get(name)
+                    if callback is None:
+                        continue # released meanwhile
+                    if owner == self.worker and name not in self.held:
+                        self.held.add(name)
+                        print(f"Worker {self.worker} took over {name}.")
+                        if name not in self.started:
+                            self.started.add(name)
+                            stop = self.stops[name] = threading.Event()
+                            threading.Thread(target=callback, args=(stop,), name=f"lease-{name}",
+                                             daemon=True).start()
+                    elif owner != self.worker and name in self.held:
+                        # Stalled past the TTL and another worker took over
+                        self.held.discard(name)
+                        self._stop(name)
+                        print(f"Worker {self.worker} lost {name} to {owner}, stopping it here.")
+        finally:
+            conn.close()
+
+    def release_leases(self):
+        """Give up every lease this worker holds (at exit); they are not renewed again."""
+        with self._lock:
+            held = list(self.held)
+            for name in held:
+                self.leases.pop(name, None)
+            if not held:
+                return
+            conn = self.connect()
+            try:
+                conn.execute(f"DELETE FROM leases WHERE owner = ? AND name IN ({','.join('?' * len(held))})",
+                             (self.worker, *held))
+                conn.commit()
+            finally:
+                conn.close()
+            for name in held:
+                self._stop(name)
+            self.held.clear()
+
+    def _stop(self, name):
+        # Caller holds self._lock
+        self.started.discard(name)
+        stop = self.stops.pop(name, None)
+        if stop is not None:
+            stop.set()
+
+    # --- Cross-process lock ---
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the database write lock (all workers) for the block; keep it short."""
+        conn = self.connect()
+        conn.isolation_level = None
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            finally:
+                conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    # --- Watcher ---
+    def add_poller(self, poller):
+        """poller(conn) is called on every watcher tick."""
+        self.pollers.append(poller)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._watch, name="shared-state", daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        last_renewal = 0
+        while True:
+            try:
+                conn = self.connect()
+                try:
+                    self.check_versions(conn)
+                    for poller in self.pollers:
+                        poller(conn)
+                finally:
+                    conn.close()
+                if self.leases and time.time() - last_renewal > self.lease_ttl / 3:
+                    last_renewal = time.time()
+                    self._renew_leases()
+            except Exception as e:
+                print(f"Shared state watcher error: {e}")
+            time.sleep(self.poll_interval)
@@ -16,10 +16,13 @@ class SkillManager:
         Scans for subdirectories and looks for Markdown (.md) files for description.
         Does NOT inspect Python code for schemas anymore.
         """
-        self.skills = {}
+        # Build into a local dict and swap at the end, so concurrent tool calls
+        # never observe a half-loaded registry
+        skills = {}
         
         if not os.path.exists(self.skills_dir):
             print(f"Skills directory '{self.skills_dir}' not found.")
+            self.skills = skills
             return
 
         # Add skills dir to sys.path to allow imports (for execution)
@@ -55,7 +58,7 @@ class SkillManager:
                 else:
                     md_content = f"Skill {item_name} (No description found)"
 
-                self.skills[item_name] = {
+                skills[item_name] = {
                     "path": item_path,
                     "description": md_content,
                     "type": "folder"
@@ -66,18 +69,21 @@ class SkillManager:
             # Or assume no description.
             elif item_name.endswith('.py') and not item_name.startswith('__'):
                 skill_name = item_name[:-3]
-                self.skills[skill_name] = {
+                skills[skill_name] = {
                     "path": item_path,
                     "description": f"Python Script: {item_name}",
                     "type": "file"
                 }
 
+        self.skills = skills
+
     def get_all_skills_description(self):
         """
         Return a combined string of all skill descriptions (MD content).
         """
         combined = "Available Local Skills:\n\n"
-        for name, info in self.skills.items():
+        # Sorted so the prompt is identical across turns (prompt caching)
+        for name, info in sorted(self.skills.items()):
             combined += f"--- Skill: {name} ---\n"
             combined += info['description'] + "\n\n"
         return combined
@@ -121,6 +121,31 @@ document.addEventListener('DOMContentLoaded', () => {
         chatMessages.scrollTop = chatMessages.scrollHeight;
     }
 
+    // Self-reflection runs in the background after the answer; long-poll
+    // until it is saved and show it under the answer it reflects on
+    async function showReflection(conversationId, after, messageDiv) {
+        for (let attempt = 0; attempt < 4; attempt++) {
+            try {
+                const reflections = await apiCall(`/api/conversations/${conversationId}/reflections?after=${after}&wait=30`);
+                if (!Array.isArray(reflections) || reflections.length === 0) continue;
+                if (conversationId !== currentConversationId) return;
+                reflections.forEach(reflection => {
+                    const div = document.createElement('div');
+                    div.className = 'reflection-block';
+                    let text = `🧠 **Self-Reflection**\n\n${reflection.content}`;
+                    if (reflection.plans) text += `\n\n[Diary] Recorded ${reflection.plans} plan(s)`;
+                    div.innerHTML = marked.parse(text);
+                    messageDiv.appendChild(div);
+                });
+                scrollToBottom();
+                return;
+            } catch (e) {
+                console.error('Reflection polling error:', e);
+                return;
+            }
+        }
+    }
+
     // Send Message
     async function sendMessage() {
         const text = messageInput.value.trim();
@@ -152,7 +177,9 @@ document.addEventListener('DOMContentLoaded', () => {
             scrollToBottom();
 
             let fullResponse = "";
+            let reflectionAfter = null;
             let currentToolCallDiv = null;
+            const toolCallDivs = {}; // tool call id -> div (calls may run concurrently)
 
             const response = await fetch('/api/chat', {
                 method: 'POST',
@@ -190,16 +217,19 @@ document.addEventListener('DOMContentLoaded', () => {
                             // Create tool call UI
                             currentToolCallDiv = document.createElement('div');
                             currentToolCallDiv.className = 'tool-call-container';
+                            if (event.id) toolCallDivs[event.id] = currentToolCallDiv;
                             currentToolCallDiv.innerHTML = `
                                 <div class="tool-call-header">
                                     <span><i class="fas fa-tools"></i> 调用工具: ${event.tool}</span>
                                     <span class="tool-status-icon"></span>
                                 </div>
+                                <div class="tool-call-progress" style="display:none;"></div>
                                 <div class="tool-call-args" style="display:none;">${JSON.stringify(event.args, null, 2)}</div>
                             `;
                             // Allow toggling args
-                            currentToolCallDiv.querySelector('.tool-call-header').onclick = () => {
-                                const args = currentToolCallDiv.querySelector('.tool-call-args');
+                            const toolDiv = currentToolCallDiv;
+                            toolDiv.querySelector('.tool-call-header').onclick = () => {
+                                const args = toolDiv.querySelector('.tool-call-args');
                                 args.style.display = args.style.display === 'none' ? 'block' : 'none';
                             };
                             
@@ -217,19 +247,36 @@ document.addEventListener('DOMContentLoaded', () => {
                                 // Move content div to bottom
                                 assistantMessageDiv.appendChild(assistantContentDiv);
                             }
+                        } else if (event.type === 'tool_progress') {
+                            const toolDiv = (event.id && toolCallDivs[event.id]) || currentToolCallDiv;
+                            if (toolDiv) {
+                                const progressDiv = toolDiv.querySelector('.tool-call-progress');
+                                if (event.message) {
+                                    progressDiv.textContent = event.message;
+                                } else if (event.total) {
+                                    progressDiv.textContent = `${Math.round(event.progress / event.total * 100)}%`;
+                                } else {
+                                    progressDiv.textContent = `${event.progress}`;
+                                }
+                                progressDiv.style.display = 'block';
+                            }
                         } else if (event.type === 'tool_end') {
-                            if (currentToolCallDiv) {
-                                const statusIcon = currentToolCallDiv.querySelector('.tool-status-icon');
+                            const toolDiv = (event.id && toolCallDivs[event.id]) || currentToolCallDiv;
+                            if (toolDiv) {
+                                const statusIcon = toolDiv.querySelector('.tool-status-icon');
                                 statusIcon.classList.add('done');
+                                toolDiv.querySelector('.tool-call-progress').style.display = 'none';
                                 statusIcon.innerHTML = '<i class="fas fa-check"></i>';
                                 
                                 // Optional: show result?
                                 // const resultDiv = document.createElement('div');
                                 // resultDiv.className = 'tool-result';
                                 // resultDiv.textContent = 'Result: ' + (event.result.length > 100 ? event.result.substring(0, 100) + '...' : event.result);
-                                // currentToolCallDiv.appendChild(resultDiv);
-                                currentToolCallDiv = null;
+                                // toolDiv.appendChild(resultDiv);
+                                if (toolDiv === currentToolCallDiv) currentToolCallDiv = null;
                             }
+                        } else if (event.type === 'reflection_queued') {
+                            reflectionAfter = event.after;
                         } else if (event.type === 'error') {
                             fullResponse += `\n\n**Error:** ${event.content}`;
                             assistantContentDiv.innerHTML = marked.parse(fullResponse);
@@ -241,6 +288,10 @@ document.addEventListener('DOMContentLoaded', () => {
                 scrollToBottom();
             }
 
+            if (reflectionAfter !== null) {
+                showReflection(currentConversationId, reflectionAfter, assistantMessageDiv);
+            }
+
         } catch (error) {
             appendMessage('assistant', 'Error: Failed to send message.');
             console.error(error);
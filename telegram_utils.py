@@ -111,10 +111,21 @@ class TelegramBot:
         self.application.add_handler(new_handler)
         self.application.add_handler(message_handler)
         
+        if not self.running:
+            # stop() was called before polling started
+            return
         print("Starting Telegram Bot...")
-        self.application.run_polling()
+        # Not the main thread, so no signal handlers; stop() ends polling
+        self.application.run_polling(stop_signals=None)
+        print("Telegram Bot stopped.")
 
     def start_in_thread(self):
         self.running = True
         thread = threading.Thread(target=self.run, daemon=True)
         thread.start()
+
+    def stop(self):
+        """Stop polling from another thread."""
+        self.running = False
+        if self.loop is not None and self.application is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.application.stop_running)
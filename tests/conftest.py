@@ -0,0 +1,164 @@
+import itertools
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The application modules live at the repository root
+sys.path.insert(0, ROOT)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until(predicate, timeout=10):
+    """Poll until predicate() is truthy and return its value."""
+    deadline = time.time() + timeout
+    while True:
+        result = predicate()
+        if result:
+            return result
+        if time.time() > deadline:
+            raise TimeoutError("Condition not met in time")
+        time.sleep(0.05)
+
+
+def delta_chunk(**delta):
+    """One streamed chat completion chunk carrying `delta`."""
+    return {'choices': [{'delta': delta, 'finish_reason': None}]}
+
+
+def tool_call_chunk(index, name, arguments):
+    return delta_chunk(tool_calls=[{'index': index, 'id': f'call_{index}', 'type': 'function',
+                                    'function': {'name': name, 'arguments': json.dumps(arguments)}}])
+
+
+class _StubLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        stub.requests.append(body)
+        answer = stub.reply(body)
+        if answer is None:
+            # Accept the request and never answer
+            stub.closing.wait()
+            self.close_connection = True
+            return
+        if not body.get('stream'):
+            data = json.dumps(answer).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        stub.streams.append(self.client_address[1])
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in itertools.chain(answer, [{'choices': [{'delta': {}, 'finish_reason': 'stop'}]}]):
+            self._send_line(f"data: {json.dumps(chunk)}\n\n".encode())
+        self._send_line(b'data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _send_line(self, line):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+        self.wfile.flush()
+
+
+class StubLLM:
+    """
+    OpenAI-style chat completions endpoint on 127.0.0.1 (`base_url`).
+    `reply(body)` decides the answer: an iterable of chunks for streamed
+    requests (a generator may pause between them), a response dict otherwise,
+    or None to accept the request and never answer. By default it streams
+    'hello' and answers 'ok'. `streams` has the client port of every
+    streamed request.
+    """
+    def __init__(self):
+        self.requests = []
+        self.streams = []
+        self.closing = threading.Event()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _StubLLMHandler)
+        self.server.stub = self
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/v1'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def reply(body):
+        if body.get('stream'):
+            return [delta_chunk(content='hello')]
+        return {'choices': [{'message': {'role': 'assistant', 'content': 'ok'}, 'finish_reason': 'stop'}]}
+
+    def close(self):
+        self.closing.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_llm():
+    llm = StubLLM()
+    yield llm
+    llm.close()
+
+
+def copy_app(tree):
+    shutil.copytree(ROOT, tree, ignore=shutil.ignore_patterns(
+        '.git', 'tests', 'tp', '__pycache__', 'chat.db*', '1052_data', '*.log'))
+    return tree
+
+
+@pytest.fixture
+def app_tree(tmp_path):
+    """A copy of the application with its own (empty) database and data."""
+    return copy_app(tmp_path / 'app')
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """
+    The app module imported in this process from its own sandbox copy (its
+    database and data stay there), for unit tests of its helpers. Shared by
+    the whole session; tests that need a fresh app use run_app_script.
+    """
+    tree = str(copy_app(tmp_path_factory.mktemp('inproc') / 'app'))
+    sys.path.insert(0, tree)
+    try:
+        import app
+    finally:
+        sys.path.remove(tree)
+    assert os.path.dirname(os.path.abspath(app.__file__)) == tree
+    return app
+
+
+@pytest.fixture
+def run_app_script(app_tree):
+    """
+    run_app_script(script, *args): run a Python script in app_tree (where it
+    can `import app`) and return the JSON it prints on its last line.
+    """
+    def run(script, *args):
+        result = subprocess.run([sys.executable, '-c', script, *map(str, args)], cwd=app_tree,
+                                capture_output=True, text=True, timeout=120)
+        assert result.returncode == 0, result.stderr
+        return json.loads(result.stdout.strip().splitlines()[-1])
+    return run
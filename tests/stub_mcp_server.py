@@ -0,0 +1,51 @@
+"""
+Stand-in MCP server for the tests.
+
+    python stub_mcp_server.py            # stdio
+    python stub_mcp_server.py sse PORT   # HTTP (SSE) on 127.0.0.1:PORT
+
+STUB_START_DELAY (seconds) delays startup, like a server that is slow to boot.
+"""
+import asyncio
+import os
+import sys
+import time
+
+from mcp.server.fastmcp import FastMCP
+
+mcp = FastMCP("stub")
+
+
+@mcp.tool()
+def pid() -> str:
+    """Return the server's process id"""
+    return str(os.getpid())
+
+
+@mcp.tool()
+def echo(text: str) -> str:
+    """Echo the text back"""
+    return text
+
+
+@mcp.tool()
+async def sleep(seconds: float) -> str:
+    """Answer after the given number of seconds"""
+    await asyncio.sleep(seconds)
+    return "slept"
+
+
+@mcp.tool()
+def crash() -> str:
+    """Exit without answering (a server that dies mid-call)"""
+    os._exit(1)
+
+
+if __name__ == '__main__':
+    time.sleep(float(os.environ.get('STUB_START_DELAY') or 0))
+    if len(sys.argv) > 2 and sys.argv[1] == 'sse':
+        mcp.settings.host = '127.0.0.1'
+        mcp.settings.port = int(sys.argv[2])
+        mcp.run('sse')
+    else:
+        mcp.run()
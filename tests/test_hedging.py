@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+from conftest import delta_chunk
+from llm_client import LLMClient
+
+
+def slow_first_token(body):
+    time.sleep(0.3)
+    yield delta_chunk(content='hello')
+
+
+def stream(client, settings, conversation):
+    async def run():
+        payload = {'messages': [{'role': 'user', 'content': 'hi'}], 'stream': True}
+        async with await client.achat(settings, payload, conversation=conversation) as response:
+            async for _ in response.content:
+                pass
+        await client.aclose()
+    asyncio.run(run())
+
+
+def test_hedge_budget_is_per_key(stub_llm):
+    stub_llm.reply = slow_first_token
+    client = LLMClient(hedge_delay=0.1, hedge_budget=0)
+    settings = {'api_key': 'test', 'base_url': stub_llm.base_url}
+
+    # Each key may hedge once; a second stall on the same key is over budget
+    stream(client, settings, 'evolution:run-1')
+    stream(client, settings, 'evolution:run-2')
+    stream(client, settings, 'evolution:run-1')
+    status = client.hedging_status()
+    assert status['requests'] == 3
+    assert status['hedged'] == 2 and status['over_budget'] == 1
+
+    # Calls without a key don't share one budget; they aren't hedged
+    stream(client, settings, None)
+    assert client.hedging_status()['requests'] == 3
+    assert len(stub_llm.streams) == 6
@@ -0,0 +1,126 @@
+"""
+Loading and trimming conversation history: load_history's bounded window,
+fit_history's step-aligned cut and elide_text for oversized messages.
+"""
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('''CREATE TABLE messages (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        conversation_id INTEGER NOT NULL,
+                        role TEXT NOT NULL,
+                        content TEXT NOT NULL
+                    )''')
+    conn.execute('''CREATE TABLE conversation_summaries (
+                        conversation_id INTEGER PRIMARY KEY,
+                        summary TEXT NOT NULL,
+                        watermark INTEGER NOT NULL DEFAULT 0
+                    )''')
+    yield conn
+    conn.close()
+
+
+def add_messages(conn, conversation_id, count):
+    return [conn.execute('INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)',
+                         (conversation_id, 'user' if i % 2 == 0 else 'assistant', str(i))).lastrowid
+            for i in range(count)]
+
+
+def turns(count, size=400):
+    """`count` alternating user/assistant messages of about size / 4 tokens each."""
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'{i:<{size}}'} for i in range(count)]
+
+
+def test_load_history_window_starts_on_a_step(app_module, conn):
+    add_messages(conn, 1, 57)
+    add_messages(conn, 2, 3)
+    settings = {'context_max_messages': '20'}
+
+    history, total, summary = app_module.load_history(conn, 1, settings)
+    # The newest 20 would start at message 37; the window starts at 30 instead
+    assert total == 57 and summary is None
+    assert [msg['content'] for msg in history] == [str(i) for i in range(30, 57)]
+    assert history[0]['role'] == 'user'
+
+    # Two more messages don't move the start; the next one does
+    add_messages(conn, 1, 2)
+    history, total, _ = app_module.load_history(conn, 1, settings)
+    assert total == 59 and history[0]['content'] == '30'
+    add_messages(conn, 1, 1)
+    history, total, _ = app_module.load_history(conn, 1, settings)
+    assert total == 60 and history[0]['content'] == '40'
+
+    assert app_module.load_history(conn, 3, settings) == ([], 0, None)
+
+
+def test_load_history_starts_after_the_summary(app_module, conn):
+    ids = add_messages(conn, 1, 12)
+    conn.execute('INSERT INTO conversation_summaries (conversation_id, summary, watermark) VALUES (1, ?, ?)',
+                 ('earlier', ids[7]))
+
+    history, total, summary = app_module.load_history(conn, 1, {})
+    assert total == 4 and summary == 'earlier'
+    assert [msg['content'] for msg in history] == ['8', '9', '10', '11']
+
+
+def test_fit_history_keeps_everything_that_fits(app_module):
+    history = turns(6)
+    assert app_module.fit_history(history, 6, budget=100000) == (history, None)
+
+
+def test_fit_history_cut_is_aligned_to_the_step(app_module):
+    history = turns(30)
+    per_message = app_module.estimate_tokens(history[0]['content'])
+
+    # Dropping 3 messages would fit; the cut rounds up to 10
+    kept, report = app_module.fit_history(history, 30, budget=per_message * 27)
+    assert kept == history[10:]
+    assert report == {'dropped': 10, 'elided': 0, 'kept': 20, 'tokens': per_message * 20,
+                      'budget': per_message * 27}
+
+    # With 5 older messages not loaded, the absolute cut is still on a step
+    kept, report = app_module.fit_history(turns(30), 35, budget=per_message * 27)
+    assert len(kept) == 25 and report['dropped'] == 10
+
+
+def test_fit_history_drops_tool_results_with_their_call(app_module):
+    call = {'role': 'assistant', 'content': 'x' * 400,
+            'tool_calls': [{'id': f'call_{i}', 'type': 'function',
+                            'function': {'name': 'read_file', 'arguments': '{}'}} for i in range(2)]}
+    results = [{'role': 'tool', 'tool_call_id': 'call_0', 'content': 'x' * 400},
+               {'role': 'tool', 'tool_call_id': 'call_1', 'content': 'x' * 400}]
+    history = turns(1) + [call] + results + turns(4)
+    per_message = app_module.estimate_tokens(history[0]['content'])
+
+    # Dropping the first two messages would fit, but that orphans the results
+    kept, report = app_module.fit_history(history, len(history), budget=per_message * 6, step=1)
+    assert kept == history[4:]
+    assert report['dropped'] == 4
+
+
+def test_fit_history_always_keeps_the_latest_turn(app_module):
+    history = turns(4) + [{'role': 'user', 'content': 'question ' * 2000},
+                          {'role': 'assistant', 'content': 'answer'}]
+
+    kept, report = app_module.fit_history(history, 6, budget=500)
+    assert [msg['role'] for msg in kept] == ['user', 'assistant']
+    assert report['dropped'] == 4 and report['elided'] == 1
+    assert '已省略' in kept[0]['content']
+    assert kept[1]['content'] == 'answer'
+
+
+def test_elide_text_keeps_head_and_tail(app_module):
+    assert app_module.elide_text('short', 10) == 'short'
+
+    text = 'a' * 3000 + 'b' * 3000
+    elided = app_module.elide_text(text, 100)
+    head, marker, tail = elided.split('\n\n')
+    assert head == 'a' * len(head) and tail == 'b' * len(tail)
+    assert abs(len(head) - 2 * len(tail)) <= 2 and len(head) + len(tail) < 400
+    assert marker == f'[... 已省略 {len(text) - len(head) - len(tail)} 字 ...]'
@@ -0,0 +1,103 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import free_port, wait_until
+from mcp_manager import MCPManager, build_stdio_params
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_mcp_server.py')
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+@pytest.fixture
+def manager():
+    manager = MCPManager(start_timeout=30)
+    yield manager
+    manager.shutdown()
+    manager.runtime.stop()
+
+
+def stdio_row(start_delay=0):
+    return {'id': 1, 'name': 'stub', 'type': 'stdio', 'command': sys.executable, 'args': json.dumps([STUB]),
+            'env': json.dumps({'STUB_START_DELAY': str(start_delay)}), 'url': None, 'enabled': 1}
+
+
+def test_stdio_cold_start_reconnect(manager):
+    row = stdio_row(start_delay=1)
+    started = time.perf_counter()
+    first_pid = manager.run_sync(manager.call_tool(row, 'pid', {}))
+    assert time.perf_counter() - started >= 1 # waited for the slow start
+
+    # Pooled: the next call reuses the same process
+    assert manager.run_sync(manager.call_tool(row, 'pid', {})) == first_pid
+
+    # The server dies mid-call: the caller fails fast instead of hanging
+    with pytest.raises(ConnectionError):
+        manager.run_sync(manager.call_tool(row, 'crash', {}), timeout=15)
+
+    second_pid = manager.run_sync(manager.call_tool(row, 'pid', {}))
+    assert second_pid != first_pid
+    assert manager.run_sync(manager.call_tool(row, 'echo', {'text': 'back'})) == 'back'
+
+
+def test_sse_reconnect_after_server_restart(manager):
+    port = free_port()
+    env = dict(os.environ, STUB_START_DELAY='1')
+    server = subprocess.Popen([sys.executable, STUB, 'sse', str(port)], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        row = {'id': 2, 'name': 'remote', 'type': 'sse', 'command': None, 'args': None, 'env': '{}',
+               'url': f'http://127.0.0.1:{port}/sse', 'enabled': 1}
+        first_pid = manager.run_sync(manager.call_tool(row, 'pid', {}))
+        assert manager.run_sync(manager.call_tool(row, 'pid', {})) == first_pid
+
+        # The remote server restarts: the dropped event stream ends the
+        # pooled session, and the next call opens a new connection
+        server.kill()
+        server.wait()
+        wait_until(lambda: not manager.sessions[2].alive)
+        server = subprocess.Popen([sys.executable, STUB, 'sse', str(port)],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(port)
+
+        second_pid = manager.run_sync(manager.call_tool(row, 'pid', {}))
+        assert second_pid != first_pid
+        assert manager.run_sync(manager.call_tool(row, 'echo', {'text': 'back'})) == 'back'
+    finally:
+        server.kill()
+        server.wait()
+
+
+@pytest.mark.skipif(os.name != 'posix', reason="resource limits are POSIX only")
+def test_stdio_launcher_applies_limits():
+    probe = ("import json, os, resource\n"
+             "print(json.dumps({'cpu': resource.getrlimit(resource.RLIMIT_CPU)[0],\n"
+             "                  'data': resource.getrlimit(resource.RLIMIT_DATA)[0],\n"
+             "                  'nice': os.nice(0), 'node': os.environ.get('NODE_OPTIONS')}))\n")
+    row = {'command': sys.executable, 'args': json.dumps(['-c', probe]), 'env': '{}'}
+    params = build_stdio_params(row, {'memory_mb': 512, 'cpu_seconds': 30, 'nice': 5})
+    output = subprocess.run([params.command, *params.args], env=params.env, capture_output=True,
+                            text=True, timeout=30)
+    limits = json.loads(output.stdout)
+
+    assert limits['cpu'] == 30
+    assert limits['data'] == 512 * 1024 * 1024
+    assert limits['nice'] >= 5
+    # Node servers get the memory cap as their V8 heap limit
+    assert '--max-old-space-size=512' in limits['node']
@@ -0,0 +1,19 @@
+"""Background turns size their history for the model their task tier routes to."""
+
+SCRIPT = (
+    "import json\n"
+    "import app\n"
+    "settings = {'api_key': 'test', 'model': 'big-model', 'background_model': 'small-model',\n"
+    "            'context_budgets': json.dumps({'big-model': 100000, 'small-model': 8000})}\n"
+    "turns = {task: app.AgentTurn(None, settings, 'system', task=task, messages=[])\n"
+    "         for task in ('interactive', 'evolution')}\n"
+    "print(json.dumps({task: [turn.model, app.get_context_budget(settings, turn.model)]\n"
+    "                  for task, turn in turns.items()}))\n"
+)
+
+
+def test_background_turn_budget_follows_tier_model(run_app_script):
+    models = run_app_script(SCRIPT)
+
+    assert models['interactive'] == ['big-model', 100000]
+    assert models['evolution'] == ['small-model', 8000]
@@ -0,0 +1,136 @@
+"""
+Two worker processes serving one database: runs cancelled or superseded in
+one worker stop in the other, and settings changed in one are applied in the
+other.
+"""
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from conftest import free_port, wait_until
+
+# Serve wsgi.py (what `gunicorn -w N wsgi:app` would load) on the given port
+WORKER = (
+    "import sys\n"
+    "from werkzeug.serving import make_server\n"
+    "import wsgi\n"
+    "make_server('127.0.0.1', int(sys.argv[1]), wsgi.app, threaded=True).serve_forever()\n"
+)
+
+
+class Worker:
+    def __init__(self, cwd):
+        self.port = free_port()
+        self.log = open(os.path.join(cwd, f'worker-{self.port}.log'), 'w')
+        self.proc = subprocess.Popen([sys.executable, '-c', WORKER, str(self.port)], cwd=cwd,
+                                     stdout=self.log, stderr=subprocess.STDOUT)
+
+    def request(self, method, path, body=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                         headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            return response.status, response.read().decode('utf-8')
+        finally:
+            conn.close()
+
+    def get(self, path):
+        status, body = self.request('GET', path)
+        assert status == 200, body
+        return json.loads(body)
+
+    def post(self, path, body):
+        status, body = self.request('POST', path, body)
+        assert status == 200, body
+        return json.loads(body)
+
+    def ready(self):
+        try:
+            return self.request('GET', '/api/settings')[0] == 200
+        except OSError:
+            return False
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait(10)
+        self.log.close()
+
+
+def start_chat(worker, conversation_id):
+    """Stream a chat turn on a thread; returns the list its NDJSON events land in."""
+    events = []
+
+    def run():
+        _, body = worker.request('POST', '/api/chat', {'conversation_id': conversation_id, 'message': 'hi'})
+        events.extend(json.loads(line) for line in body.splitlines() if line.strip())
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, events
+
+
+@pytest.fixture
+def workers(app_tree, stub_llm):
+    # The model accepts every turn and never answers, so runs stay in flight
+    stub_llm.reply = lambda body: None
+    first = Worker(app_tree)
+    wait_until(first.ready, timeout=60) # creates the database
+    second = Worker(app_tree)
+    wait_until(second.ready, timeout=60)
+    first.post('/api/settings', {'api_key': 'test', 'base_url': stub_llm.base_url})
+    yield first, second
+    first.stop()
+    second.stop()
+
+
+def test_cancel_from_other_worker(workers):
+    a, b = workers
+    conversation_id = a.post('/api/conversations', {'title': 'multi'})['id']
+    thread, events = start_chat(a, conversation_id)
+
+    # Worker B sees A's run in the shared registry and cancels it
+    runs = wait_until(lambda: [run for run in b.get('/api/runs') if run['conversation_id'] == conversation_id])
+    assert len(runs) == 1 and runs[0]['channel'] == 'web'
+    assert b.post(f"/api/runs/{runs[0]['id']}/cancel", {})['status'] == 'cancelled'
+
+    thread.join(10)
+    assert not thread.is_alive()
+    assert events[-1]['type'] == 'error' and events[-1]['content'].strip() == '[Task Cancelled]'
+    wait_until(lambda: not b.get('/api/runs'))
+
+
+def test_supersede_across_workers(workers):
+    a, b = workers
+    conversation_id = a.post('/api/conversations', {'title': 'multi'})['id']
+    first_thread, first_events = start_chat(a, conversation_id)
+    wait_until(lambda: b.get('/api/runs'))
+
+    # A new message for the conversation, handled by the other worker,
+    # interrupts the turn still running in the first
+    second_thread, second_events = start_chat(b, conversation_id)
+    first_thread.join(10)
+    assert not first_thread.is_alive()
+    assert 'Interrupted by new message' in first_events[-1]['content']
+
+    runs = wait_until(lambda: [run for run in a.get('/api/runs') if not run['cancelled']])
+    assert len(runs) == 1
+    a.post(f"/api/runs/{runs[0]['id']}/cancel", {})
+    second_thread.join(10)
+    assert second_events[-1]['content'].strip() == '[Task Cancelled]'
+
+
+def test_settings_change_reaches_other_worker(workers):
+    a, b = workers
+    assert b.get('/api/llm/hedging')['hedge_delay'] == 0
+    a.post('/api/settings', {'llm_hedge_delay': '2.5'})
+    # B picks the change up from the shared cache version, not a restart
+    wait_until(lambda: b.get('/api/llm/hedging')['hedge_delay'] == 2.5, timeout=5)
+
+    b.post('/api/settings', {'turn_workers': '7'})
+    wait_until(lambda: a.get('/api/turns/queue')['workers'] == 7, timeout=5)
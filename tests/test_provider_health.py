@@ -0,0 +1,32 @@
+import time
+
+from llm_client import LLMClient
+
+
+def slow_completion(body):
+    """A non-streamed completion that takes a while to generate."""
+    time.sleep(0.3)
+    return {'choices': [{'message': {'role': 'assistant', 'content': 'ok'}, 'finish_reason': 'stop'}]}
+
+
+def test_non_streamed_call_does_not_feed_ttft(stub_llm):
+    stub_llm.reply = slow_completion
+    client = LLMClient()
+    settings = {'api_key': 'test', 'base_url': stub_llm.base_url, 'model': 'chat-model',
+                'summary_model': 'summary-model'}
+    try:
+        response = client.chat(settings, {'messages': [{'role': 'user', 'content': 'hi'}]},
+                               task='summarization')
+        response.close()
+    finally:
+        client.close()
+
+    # The summarization tier picked its own model
+    assert response.provider['model'] == 'summary-model'
+    assert stub_llm.requests[0]['model'] == 'summary-model'
+    health = client.provider_status(settings, 'summarization')[0]
+    assert health['model'] == 'summary-model'
+    # The whole generation time is kept apart from the TTFT that ranks providers
+    assert health['ttft'] is None
+    assert health['duration'] >= 0.3
+    assert health['requests'] == 1
@@ -0,0 +1,159 @@
+"""
+The runs table shared by workers: cancelling another worker's run, dropping
+rows of dead workers, superseding earlier turns of a conversation, and
+killing a cancelled run's child processes.
+"""
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import wait_until
+from run_registry import RunRegistry, child_process, current_run
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    db_file = str(tmp_path / 'runs.db')
+    conn = sqlite3.connect(db_file)
+    conn.execute('''CREATE TABLE runs (
+                        id TEXT PRIMARY KEY,
+                        worker TEXT,
+                        conversation_id INTEGER,
+                        channel TEXT,
+                        purpose TEXT,
+                        started_at REAL,
+                        step TEXT,
+                        step_started REAL,
+                        cancelled TEXT,
+                        heartbeat REAL
+                    )''')
+    conn.close()
+    return db_file
+
+
+@pytest.fixture
+def poll(db_file):
+    """poll(registry) runs one SharedState watcher pass for that worker."""
+    conn = sqlite3.connect(db_file)
+    yield lambda registry: registry.poll(conn)
+    conn.close()
+
+
+def rows(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute('SELECT id, worker, cancelled FROM runs ORDER BY started_at').fetchall()
+    finally:
+        conn.close()
+
+
+def test_cancel_reaches_another_worker(db_file, poll):
+    first, second = RunRegistry(db_file, 'first'), RunRegistry(db_file, 'second')
+    run = first.start(1, 'web')
+    run.set_step('thinking')
+
+    # Not saved yet, so the other worker doesn't know it
+    assert second.list() == [] and not second.cancel(run.id)
+    poll(first)
+    assert [(info['id'], info['worker'], info['step']) for info in second.list()] == [(run.id, 'first', 'thinking')]
+
+    assert second.cancel(run.id, 'stopped by user')
+    assert run.cancelled is None
+    poll(first)
+    assert run.cancelled == 'stopped by user'
+    assert not second.cancel('no-such-run')
+
+
+def test_finished_rows_are_deleted(db_file, poll):
+    registry = RunRegistry(db_file, 'first')
+    saved = registry.start(1, 'web')
+    poll(registry)
+    unsaved = registry.start(2, 'web')
+    registry.finish(saved)
+    registry.finish(unsaved)
+
+    poll(registry)
+    assert rows(db_file) == [] and registry.list() == []
+
+
+def test_rows_of_a_dead_worker_are_dropped(db_file, poll):
+    registry = RunRegistry(db_file, 'first', stale_after=30)
+    conn = sqlite3.connect(db_file)
+    conn.execute("INSERT INTO runs (id, worker, conversation_id, started_at, step_started, heartbeat) "
+                 "VALUES ('dead-run', 'dead', 1, ?, ?, ?)", (time.time() - 120, time.time() - 120, time.time() - 60))
+    conn.commit()
+    conn.close()
+    other = RunRegistry(db_file, 'second')
+
+    # Hidden as soon as the heartbeat is stale, deleted by the next poll
+    assert other.list() == []
+    live = registry.start(2, 'web')
+    poll(registry)
+    assert rows(db_file) == [(live.id, 'first', None)]
+    assert [info['id'] for info in other.list()] == [live.id]
+
+
+def test_new_run_supersedes_the_conversation(db_file, poll):
+    first, second = RunRegistry(db_file, 'first'), RunRegistry(db_file, 'second')
+
+    older = first.start(1, 'web')
+    newer = first.start(1, 'web')
+    other = first.start(2, 'web')
+    first.start(None, 'system')
+    first.start(None, 'system')
+    assert older.cancelled == 'superseded'
+    assert newer.cancelled is None and other.cancelled is None
+
+    # Across workers: the newer run marks the older row once it is saved
+    poll(first)
+    latest = second.start(1, 'telegram')
+    poll(second)
+    poll(first)
+    assert newer.cancelled == 'superseded' and latest.cancelled is None
+    assert other.cancelled is None
+
+
+def test_later_message_wins_whichever_worker_saves_first(db_file, poll):
+    first, second = RunRegistry(db_file, 'first'), RunRegistry(db_file, 'second')
+    older = first.start(1, 'web')
+    newer = second.start(1, 'web')
+
+    poll(second)
+    poll(first)
+    assert older.cancelled == 'superseded' and newer.cancelled is None
+    assert rows(db_file) == [(older.id, 'first', 'superseded'), (newer.id, 'second', None)]
+
+
+def alive(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc'), reason='checks processes through /proc')
+def test_cancel_kills_the_process_group():
+    run = RunRegistry().start(1, 'web')
+    # A child that starts a grandchild of its own, like `npm run` or `make`
+    script = 'import subprocess, sys, time; print(subprocess.Popen([sys.executable, "-c", ' \
+             '"import time; time.sleep(60)"]).pid, flush=True); time.sleep(60)'
+    token = current_run.set(run)
+    try:
+        with child_process([sys.executable, '-c', script], stdout=subprocess.PIPE, text=True) as proc:
+            grandchild = int(proc.stdout.readline())
+            assert alive(grandchild)
+            run.cancel()
+            assert proc.wait(timeout=10) == -9
+            assert wait_until(lambda: not alive(grandchild))
+            proc.stdout.close()
+
+        # Started after the cancel: killed straight away
+        with child_process([sys.executable, '-c', 'import time; time.sleep(60)']) as proc:
+            assert proc.wait(timeout=10) == -9
+    finally:
+        current_run.reset(token)
@@ -0,0 +1,68 @@
+import sqlite3
+import threading
+import time
+
+from shared_state import SharedState
+
+
+def test_lost_lease_stops_its_services(tmp_path):
+    db_file = str(tmp_path / 'shared.db')
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE leases (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)')
+    conn.close()
+
+    runs = []
+    ran = threading.Semaphore(0)
+
+    def services(stop):
+        runs.append(stop)
+        ran.release()
+
+    first = SharedState(db_file, lease_ttl=0.2)
+    second = SharedState(db_file, lease_ttl=0.2)
+    first.run_with_lease('services', services)
+    assert ran.acquire(timeout=5)
+
+    # The first worker stalls past the TTL and the second takes over
+    time.sleep(0.3)
+    second.run_with_lease('services', services)
+    assert ran.acquire(timeout=5)
+    first._renew_leases()
+    assert runs[0].is_set() and not runs[1].is_set()
+    assert 'services' not in first.held and 'services' not in first.started
+
+    # Once the lease comes back the services start again
+    time.sleep(0.3)
+    first._renew_leases()
+    assert ran.acquire(timeout=5)
+    assert len(runs) == 3 and not runs[2].is_set()
+
+
+def test_concurrent_renewals_start_a_lease_once(tmp_path):
+    db_file = str(tmp_path / 'shared.db')
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE leases (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)')
+    conn.close()
+
+    runs = []
+    state = SharedState(db_file, lease_ttl=30)
+    with state._lock:
+        state.leases['services'] = runs.append
+
+    # The watcher and run_with_lease() callers renew at the same time
+    start = threading.Barrier(8)
+
+    def renew():
+        start.wait()
+        state._renew_leases()
+
+    threads = [threading.Thread(target=renew) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    time.sleep(0.1)
+    assert len(runs) == 1
+
+    state.release_leases()
+    assert runs[0].is_set() and not state.held and not state.leases
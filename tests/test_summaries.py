@@ -0,0 +1,121 @@
+"""
+Rolling conversation summaries: a long backlog is folded in bounded batches
+that each move the watermark, and the update is queued at the end of a turn
+rather than while its history loads.
+"""
+import pytest
+
+from conftest import delta_chunk, wait_until
+
+
+def add_conversation(app, count, content='message {}'):
+    """A conversation with `count` alternating user/assistant messages; returns (id, message ids)."""
+    conn = app.get_db_connection()
+    conversation_id = conn.execute('INSERT INTO conversations (title) VALUES (?)', ('summary test',)).lastrowid
+    ids = []
+    for i in range(count):
+        cursor = conn.execute('INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)',
+                              (conversation_id, 'user' if i % 2 == 0 else 'assistant', content.format(i)))
+        ids.append(cursor.lastrowid)
+    conn.commit()
+    conn.close()
+    return conversation_id, ids
+
+
+def summarizer(body):
+    """Non-streamed summary calls answer with how many they have seen; turns answer 'hello'."""
+    if body.get('stream'):
+        return [delta_chunk(content='hello')]
+    summarizer.calls += 1
+    return {'choices': [{'message': {'role': 'assistant', 'content': f'summary {summarizer.calls}'},
+                         'finish_reason': 'stop'}]}
+
+
+@pytest.fixture
+def settings(stub_llm):
+    summarizer.calls = 0
+    stub_llm.reply = summarizer
+    return {'api_key': 'test', 'base_url': stub_llm.base_url}
+
+
+def transcript_lines(request):
+    prompt = request['messages'][0]['content']
+    return [line for line in prompt.split('## New messages\n')[1].splitlines() if line.startswith('[')]
+
+
+def test_backlog_is_folded_in_batches(app_module, stub_llm, settings):
+    conversation_id, ids = add_conversation(app_module, 30)
+    settings.update(summary_keep_recent='5', summary_batch_messages='10')
+
+    app_module.update_summary(conversation_id, settings)
+
+    # 25 older messages in batches of 10, 10 and 5; each prompt carries the
+    # summary so far, and the newest 5 stay verbatim
+    assert [len(transcript_lines(request)) for request in stub_llm.requests] == [10, 10, 5]
+    assert 'summary 2' in stub_llm.requests[2]['messages'][0]['content']
+    conn = app_module.get_db_connection()
+    assert app_module.load_summary(conn, conversation_id) == ('summary 3', ids[24])
+    history, total, summary = app_module.load_history(conn, conversation_id, settings)
+    conn.close()
+    assert total == 5 and summary == 'summary 3'
+    assert [msg['content'] for msg in history] == [f'message {i}' for i in range(25, 30)]
+    assert conversation_id not in app_module.SUMMARY_JOBS
+
+
+def test_batch_is_cut_at_the_token_budget(app_module, stub_llm, settings):
+    conversation_id, ids = add_conversation(app_module, 8, content='{} ' + 'word ' * 150)
+    settings.update(summary_keep_recent='2', summary_batch_tokens='400')
+
+    app_module.update_summary(conversation_id, settings)
+
+    # Each batch holds as many messages as fit the budget, but at least one
+    sizes = [len(transcript_lines(request)) for request in stub_llm.requests]
+    assert sum(sizes) == 6 and max(sizes) < 6
+    conn = app_module.get_db_connection()
+    assert app_module.load_summary(conn, conversation_id)[1] == ids[5]
+    conn.close()
+
+
+def test_watermark_only_moves_forward(app_module, stub_llm, settings):
+    conversation_id, ids = add_conversation(app_module, 10)
+    conn = app_module.get_db_connection()
+    conn.execute('INSERT INTO conversation_summaries (conversation_id, summary, watermark) VALUES (?, ?, ?)',
+                 (conversation_id, 'newer summary', ids[9]))
+    conn.commit()
+    conn.close()
+    settings.update(summary_keep_recent='0')
+
+    app_module.update_summary(conversation_id, settings)
+
+    assert stub_llm.requests == []
+    conn = app_module.get_db_connection()
+    assert app_module.load_summary(conn, conversation_id) == ('newer summary', ids[9])
+    conn.close()
+
+
+def test_summary_is_queued_after_the_turn_not_on_load(app_module, stub_llm, settings, monkeypatch):
+    conversation_id, ids = add_conversation(app_module, 41)
+    settings.update(summary_trigger_messages='40')
+    triggers = []
+    update = app_module.maybe_update_summary
+
+    def record(conversation_id, settings, total):
+        triggers.append(total)
+        return update(conversation_id, settings, total)
+    monkeypatch.setattr(app_module, 'maybe_update_summary', record)
+
+    # Loading history has no side effects
+    conn = app_module.get_db_connection()
+    assert app_module.load_history(conn, conversation_id, settings)[1] == 41
+    conn.close()
+    assert triggers == []
+
+    turn = app_module.AgentTurn(conversation_id, settings, 'web')
+    events = list(app_module.iter_turn_events(turn))
+    assert events[-1] == {'type': 'done', 'content': 'hello', 'finished': True}
+
+    # Queued once, counting the stored answer
+    assert triggers == [42]
+    conn = app_module.get_db_connection()
+    wait_until(lambda: app_module.load_summary(conn, conversation_id)[0])
+    conn.close()
@@ -0,0 +1,34 @@
+"""
+Telegram turns are handed from the bot's event loop to the shared async_loop,
+so they use the same pooled LLM session as web turns; replies still go out on
+the bot's loop.
+"""
+
+# Two Telegram turns, each on its own bot loop (python-telegram-bot runs
+# handlers on the loop of its polling thread)
+SCRIPT = (
+    "import asyncio, json, sys\n"
+    "import app\n"
+    "app.app.test_client().post('/api/settings', json={'api_key': 'test', 'base_url': sys.argv[1]})\n"
+    "replies = []\n"
+    "async def bot():\n"
+    "    bot_loop = asyncio.get_running_loop()\n"
+    "    async def reply(text):\n"
+    "        replies.append({'text': text, 'bot_loop': asyncio.get_running_loop() is bot_loop})\n"
+    "    await app.telegram_chat_turn('42', 'hi', reply)\n"
+    "asyncio.run(bot())\n"
+    "asyncio.run(bot())\n"
+    "loops = [loop is app.async_loop.loop for loop in app.llm_client._async_sessions.keys()]\n"
+    "print(json.dumps({'replies': replies, 'loops': loops}))\n"
+)
+
+
+def test_telegram_turn_runs_on_shared_loop(stub_llm, run_app_script):
+    output = run_app_script(SCRIPT, stub_llm.base_url)
+
+    assert [reply['text'] for reply in output['replies']] == ['hello', 'hello']
+    assert all(reply['bot_loop'] for reply in output['replies'])
+    # One pooled aiohttp session, on async_loop, and both turns streamed over
+    # the same kept-alive connection
+    assert output['loops'] == [True]
+    assert len(stub_llm.streams) == 2 and len(set(stub_llm.streams)) == 1
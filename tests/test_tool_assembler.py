@@ -0,0 +1,80 @@
+"""
+Streamed tool calls: when ToolCallAssembler considers a call complete, and
+which calls may start while the model is still streaming.
+"""
+
+
+def delta(index, call_id=None, name=None, arguments=None):
+    function = {}
+    if name is not None:
+        function['name'] = name
+    if arguments is not None:
+        function['arguments'] = arguments
+    fragment = {'index': index, 'function': function}
+    if call_id is not None:
+        fragment['id'] = call_id
+    return fragment
+
+
+def test_call_completes_when_its_arguments_close(app_module):
+    assembler = app_module.ToolCallAssembler()
+    assert assembler.feed([delta(0, 'call_0', 'read_file', '{"file_')]) == []
+    assert assembler.feed([delta(0, arguments='path": "a.txt"')]) == []
+    assert assembler.feed([delta(0, arguments='}')]) == [0]
+    assert assembler.tool_calls()[0]['function'] == {'name': 'read_file', 'arguments': '{"file_path": "a.txt"}'}
+    assert assembler.finish() == []
+
+
+def test_brace_inside_a_string_is_not_the_end(app_module):
+    assembler = app_module.ToolCallAssembler()
+    assert assembler.feed([delta(0, 'call_0', 'write_file', '{"content": "}')]) == []
+    assert assembler.feed([delta(0, arguments='"}')]) == [0]
+
+
+def test_only_a_json_object_completes_a_call(app_module):
+    assembler = app_module.ToolCallAssembler()
+    assert assembler.feed([delta(0, 'call_0', 'read_file', '"}"')]) == []
+    assert assembler.finish() == [0]
+
+
+def test_call_needs_id_and_name(app_module):
+    assembler = app_module.ToolCallAssembler()
+    assert assembler.feed([delta(0, name='read_file', arguments='{}')]) == []
+    assert assembler.feed([delta(0, call_id='call_0')]) == [0]
+
+
+def test_next_index_closes_earlier_calls(app_module):
+    assembler = app_module.ToolCallAssembler()
+    assert assembler.feed([delta(0, 'call_0', 'execute_command', '{"command": "ls"')]) == []
+    # The model moved on; call 0 is as complete as it will get
+    assert assembler.feed([delta(1, 'call_1', 'read_file', '')]) == [0]
+    assert assembler.feed([delta(1, arguments='{"file_path": "a"}')]) == [1]
+    assert [call['id'] for call in assembler.tool_calls()] == ['call_0', 'call_1']
+
+
+def test_finish_completes_the_rest_in_order(app_module):
+    assembler = app_module.ToolCallAssembler()
+    assembler.feed([delta(0, 'call_0', 'read_file', '{"file_path": "a"}'),
+                    delta(1, 'call_1', 'read_file', '{"file_pa')])
+    assert assembler.complete == {0}
+    assert assembler.finish() == [1]
+    assert assembler.finish() == []
+
+
+def test_only_generated_resource_and_prompt_tools_start_early(app_module):
+    server = {'id': 3, 'name': 'docs'}
+    third_party = {'id': 4, 'name': 'other'}
+    server_map = {'read_resource_3': server, 'get_prompt_3': server,
+                  'read_resource_notes': third_party, 'get_prompt_4_draft': third_party}
+
+    assert app_module.is_early_start_tool('read_file', {}, server_map)
+    assert app_module.is_early_start_tool('read_resource_3', {}, server_map)
+    assert app_module.is_early_start_tool('get_prompt_3', {}, server_map)
+    # Third-party tools that only look like the generated ones
+    assert not app_module.is_early_start_tool('read_resource_notes', {}, server_map)
+    assert not app_module.is_early_start_tool('get_prompt_4_draft', {}, server_map)
+    assert not app_module.is_early_start_tool('read_resource_3', {}, {})
+    # ... unless the early_start_tools setting allows them
+    assert app_module.is_early_start_tool('read_resource_notes', {'early_start_tools': 'read_resource_notes'},
+                                          server_map)
+    assert not app_module.is_early_start_tool('write_file', {}, server_map)
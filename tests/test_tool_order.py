@@ -0,0 +1,81 @@
+"""
+Tool calls from one assistant message run concurrently only when they are
+read-only; a call that changes state runs alone, in message order, so a read
+issued after a write sees what was written.
+"""
+import time
+
+from conftest import delta_chunk, tool_call_chunk
+
+# write_file then read_file of the same path, the write held up long enough
+# that a read running alongside it would see the old contents
+RUNNER_SCRIPT = (
+    "import asyncio, json, sys, time\n"
+    "import app\n"
+    "path = sys.argv[1]\n"
+    "def run_call(call, report, cancel_event):\n"
+    "    if call[0] == 'write_file':\n"
+    "        time.sleep(0.5)\n"
+    "    return app.execute_tool_call(call[0], dict(call[1]), {})\n"
+    "async def main():\n"
+    "    runner = app.ToolCallRunner(run_call, 4)\n"
+    "    calls = [('write_file', {'file_path': path, 'content': 'new contents'}),\n"
+    "             ('read_file', {'file_path': path})]\n"
+    "    for index, call in enumerate(calls):\n"
+    "        runner.submit(index, call, exclusive=not app.is_early_start_tool(call[0], {}))\n"
+    "    results = {}\n"
+    "    async for event in runner.drain():\n"
+    "        if event[0] == 'end':\n"
+    "            results[event[1]] = event[2]\n"
+    "    return results\n"
+    "print(json.dumps(asyncio.run(main())))\n"
+)
+
+# One streamed turn against the stub model; prints the tool results
+TURN_SCRIPT = (
+    "import json, sys\n"
+    "import app\n"
+    "settings = {'api_key': 'test', 'base_url': sys.argv[1]}\n"
+    "turn = app.AgentTurn(None, settings, 'web', messages=[{'role': 'user', 'content': 'go'}])\n"
+    "results = {event['tool']: event['result'] for event in app.iter_turn_events(turn)\n"
+    "           if event['type'] == 'tool_end'}\n"
+    "print(json.dumps(results))\n"
+)
+
+
+def write_then_read(target):
+    """
+    First step: streams write_file then read_file of `target`, and keeps the
+    stream open a while after read_file is complete. Next step: answers 'done'.
+    """
+    def reply(body):
+        if any(message['role'] == 'tool' for message in body['messages']):
+            yield delta_chunk(content='done')
+            return
+        yield tool_call_chunk(0, 'write_file', {'file_path': target, 'content': 'new contents'})
+        yield tool_call_chunk(1, 'read_file', {'file_path': target})
+        time.sleep(0.5)
+    return reply
+
+
+def test_read_after_write_sees_written_content(tmp_path, run_app_script):
+    target = tmp_path / 'notes.txt'
+    target.write_text('old contents')
+
+    results = run_app_script(RUNNER_SCRIPT, target)
+
+    assert 'new contents' in results['1']
+    assert 'old contents' not in results['1']
+
+
+def test_streamed_read_waits_for_earlier_write(tmp_path, stub_llm, run_app_script):
+    target = tmp_path / 'notes.txt'
+    target.write_text('old contents')
+    stub_llm.reply = write_then_read(str(target))
+
+    results = run_app_script(TURN_SCRIPT, stub_llm.base_url)
+
+    # read_file was complete while the stream was still open, but it comes
+    # after write_file, so it must not start early
+    assert 'new contents' in results['read_file']
+    assert 'old contents' not in results['read_file']
@@ -0,0 +1,69 @@
+import asyncio
+import json
+import os
+import sys
+
+from mcp_manager import MCPManager, ToolCallQueue
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_mcp_server.py')
+
+
+def test_queue_serves_callers_round_robin():
+    async def scenario():
+        queue = ToolCallQueue(1)
+        await queue.acquire('a') # holds the only slot
+        order = []
+
+        async def call(caller, name):
+            await queue.acquire(caller)
+            order.append(name)
+            queue.release()
+
+        tasks = [asyncio.ensure_future(call('a', 'a2')), asyncio.ensure_future(call('a', 'a3')),
+                 asyncio.ensure_future(call('b', 'b1'))]
+        await asyncio.sleep(0)
+        assert queue.depth == 3
+        queue.release()
+        await asyncio.gather(*tasks)
+        return order, queue.stats()
+
+    order, stats = asyncio.run(scenario())
+    assert order == ['a2', 'b1', 'a3']
+    assert stats['active'] == 0 and stats['queued'] == 0 and stats['queued_calls'] == 3
+
+
+def test_cancelled_call_keeps_the_limit():
+    """A call abandoned by its caller must not leave its request running past its slot."""
+    manager = MCPManager(start_timeout=30, max_concurrency=1)
+    row = {'id': 1, 'name': 'stub', 'type': 'stdio', 'command': sys.executable, 'args': json.dumps([STUB]),
+           'env': '{}', 'url': None, 'enabled': 1}
+
+    async def scenario():
+        pooled = await manager.get_session(row)
+        in_flight, peak = [0], [0]
+        call_tool = pooled.session.call_tool
+
+        async def counted(*args, **kwargs):
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+            try:
+                return await call_tool(*args, **kwargs)
+            finally:
+                in_flight[0] -= 1
+
+        pooled.session.call_tool = counted
+        try:
+            await asyncio.wait_for(manager.call_tool(row, 'sleep', {'seconds': 1}), 0.3)
+        except asyncio.TimeoutError:
+            pass
+        assert await manager.call_tool(row, 'echo', {'text': 'next'}) == 'next'
+        await asyncio.sleep(1) # past the abandoned call's answer
+        return peak[0], manager.queues[1].stats()
+
+    try:
+        peak, stats = manager.run_sync(scenario())
+    finally:
+        manager.shutdown()
+        manager.runtime.stop()
+    assert peak == 1
+    assert stats['active'] == 0
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+
+import pytest
+
+from conftest import wait_until
+from turn_scheduler import QueueFull, TurnScheduler
+
+
+@pytest.fixture
+def release():
+    """Set at teardown so blocked jobs always finish."""
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def running(scheduler, priority):
+    return scheduler.stats()['classes'][priority]['running']
+
+
+def queued(scheduler, priority):
+    return scheduler.stats()['classes'][priority]['queued']
+
+
+def test_higher_classes_are_admitted_first(release):
+    scheduler = TurnScheduler(workers=1)
+    order = []
+    done = threading.Semaphore(0)
+
+    def job(name):
+        order.append(name)
+        done.release()
+
+    scheduler.submit('interactive', release.wait)
+    wait_until(lambda: running(scheduler, 'interactive') == 1)
+
+    # Queued lowest class first; admitted highest class first
+    for name in ('background', 'group', 'direct', 'interactive'):
+        scheduler.submit(name, job, name)
+    release.set()
+    for _ in range(4):
+        assert done.acquire(timeout=5)
+    assert order == ['interactive', 'direct', 'group', 'background']
+
+
+def test_group_may_use_half_the_workers(release):
+    scheduler = TurnScheduler(workers=4)
+    for _ in range(3):
+        scheduler.submit('group', release.wait)
+    wait_until(lambda: running(scheduler, 'group') == 2)
+    assert queued(scheduler, 'group') == 1
+
+    # The owner's session still gets in
+    with scheduler.slot('interactive', timeout=1):
+        assert running(scheduler, 'interactive') == 1
+
+
+def test_background_runs_one_job_at_a_time(release):
+    scheduler = TurnScheduler(workers=4)
+    scheduler.submit('background', release.wait)
+    scheduler.submit('background', release.wait)
+    wait_until(lambda: running(scheduler, 'background') == 1)
+    assert queued(scheduler, 'background') == 1
+
+    release.set()
+    wait_until(lambda: scheduler.stats()['running'] == 0)
+    assert scheduler.stats()['classes']['background']['admitted'] == 2
+
+
+def test_queue_limit_rejects_waiting_work(release):
+    scheduler = TurnScheduler(workers=4, queue_limits={'background': 1})
+    scheduler.submit('background', release.wait) # runs
+    scheduler.submit('background', release.wait) # waits
+    with pytest.raises(QueueFull):
+        scheduler.submit('background', release.wait)
+
+    stats = scheduler.stats()['classes']['background']
+    assert stats['rejected'] == 1 and stats['queued'] == 1
+    # Work that is admitted right away doesn't count against the limit
+    scheduler.configure(queue_limits={'interactive': 0})
+    with scheduler.slot('interactive', timeout=1):
+        pass
+
+
+def test_slot_timeout_gives_up_and_releases(release):
+    scheduler = TurnScheduler(workers=1)
+    scheduler.submit('interactive', release.wait)
+    wait_until(lambda: running(scheduler, 'interactive') == 1)
+
+    with pytest.raises(QueueFull):
+        with scheduler.slot('direct', timeout=0.1):
+            pass
+    # The abandoned ticket left the queue instead of holding a worker later
+    assert queued(scheduler, 'direct') == 0
+
+    release.set()
+    wait_until(lambda: scheduler.stats()['running'] == 0)
+    with scheduler.slot('direct', timeout=1):
+        assert running(scheduler, 'direct') == 1
+    assert scheduler.stats()['running'] == 0
+
+
+def test_cancelled_aslot_waiter_leaves_the_queue(release):
+    scheduler = TurnScheduler(workers=1)
+    scheduler.submit('interactive', release.wait)
+    wait_until(lambda: running(scheduler, 'interactive') == 1)
+
+    async def waiter():
+        async with scheduler.aslot('direct'):
+            pass
+
+    async def main():
+        task = asyncio.ensure_future(waiter())
+        await asyncio.sleep(0.1)
+        assert queued(scheduler, 'direct') == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert queued(scheduler, 'direct') == 0
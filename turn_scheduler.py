@@ -0,0 +1,193 @@
+import asyncio
+import contextlib
+import threading
+import time
+from collections import deque
+
+# Priority classes, highest first
+CLASSES = ('interactive', 'direct', 'group', 'background')
+
+DEFAULT_QUEUE_LIMITS = {'interactive': 20, 'direct': 20, 'group': 10, 'background': 5}
+
+
+class QueueFull(Exception):
+    """A priority class already has as many turns waiting as it may queue."""
+
+
+class _Ticket:
+    def __init__(self, priority, job=None):
+        self.priority = priority
+        self.job = job # (fn, args, kwargs) for submitted jobs, None for slot() waiters
+        self.queued_at = time.monotonic()
+        self.granted = False
+        self.notify = None # called (under the scheduler lock) when the slot is granted
+
+
+class TurnScheduler:
+    """
+    Priority admission for agent turns. At most `workers` turns run at once;
+    waiting turns are admitted by class (interactive web > direct IM > group
+    IM > background reflection/evolution), first come first served within a
+    class. Each class can also be capped below `workers` (so a burst of group
+    traffic leaves room for the owner's session) and has a queue limit beyond
+    which new turns are rejected with QueueFull.
+
+    Thread-safe. Inline callers hold a slot with `slot()` (threads) or
+    `aslot()` (any event loop); webhooks and background work hand over a
+    function with `submit()`, which gets a thread once it is admitted.
+    """
+    def __init__(self, workers=4, class_workers=None, queue_limits=None):
+        self.workers = workers
+        self.class_workers = {} # class -> cap, overriding default_cap()
+        self.queue_limits = dict(DEFAULT_QUEUE_LIMITS)
+        self.waiting = {priority: deque() for priority in CLASSES}
+        self.running = {priority: 0 for priority in CLASSES}
+        self.counters = {priority: {'admitted': 0, 'rejected': 0, 'total_wait': 0.0, 'max_wait': 0.0,
+                                    'last_wait': 0.0} for priority in CLASSES}
+        self._lock = threading.Lock()
+        self.configure(class_workers=class_workers, queue_limits=queue_limits)
+
+    def configure(self, workers=None, class_workers=None, queue_limits=None):
+        """Change limits; waiting turns are admitted right away if there is room."""
+        with self._lock:
+            if workers is not None:
+                self.workers = max(1, int(workers))
+            for priority, cap in (class_workers or {}).items():
+                self._check(priority)
+                if cap is None:
+                    self.class_workers.pop(priority, None)
+                else:
+                    self.class_workers[priority] = max(1, int(cap))
+            for priority, limit in (queue_limits or {}).items():
+                self._check(priority)
+                self.queue_limits[priority] = max(0, int(limit))
+            self._dispatch()
+
+    @staticmethod
+    def _check(priority):
+        if priority not in CLASSES:
+            raise ValueError(f"Unknown priority class: {priority}")
+
+    def default_cap(self, priority):
+        # Group chats may use half the workers, background jobs one
+        if priority == 'group':
+            return max(1, self.workers // 2)
+        if priority == 'background':
+            return 1
+        return self.workers
+
+    def _cap(self, priority):
+        return min(self.workers, self.class_workers.get(priority) or self.default_cap(priority))
+
+    def _enqueue(self, priority, job=None, notify=None):
+        self._check(priority)
+        ticket = _Ticket(priority, job)
+        ticket.notify = notify
+        with self._lock:
+            self.waiting[priority].append(ticket)
+            self._dispatch()
+            # The queue limit only matters for turns that have to wait
+            if not ticket.granted and len(self.waiting[priority]) > self.queue_limits[priority]:
+                self.waiting[priority].remove(ticket)
+                self.counters[priority]['rejected'] += 1
+                raise QueueFull(f"Too many {priority} turns waiting ({len(self.waiting[priority])})")
+        return ticket
+
+    def _dispatch(self):
+        """Admit waiting turns in priority order while workers are free. Lock held."""
+        for priority in CLASSES:
+            waiting = self.waiting[priority]
+            while waiting and sum(self.running.values()) < self.workers and self.running[priority] < self._cap(priority):
+                ticket = waiting.popleft()
+                ticket.granted = True
+                self.running[priority] += 1
+
+                wait = time.monotonic() - ticket.queued_at
+                counters = self.counters[priority]
+                counters['admitted'] += 1
+                counters['total_wait'] += wait
+                counters['max_wait'] = max(counters['max_wait'], wait)
+                counters['last_wait'] = wait
+
+                if ticket.job is not None:
+                    threading.Thread(target=self._run_job, args=(ticket,), name=f"turn-{priority}",
+                                     daemon=True).start()
+                elif ticket.notify is not None:
+                    ticket.notify()
+
+    def _release(self, ticket):
+        with self._lock:
+            if ticket.granted:
+                ticket.granted = False
+                self.running[ticket.priority] -= 1
+            elif ticket in self.waiting[ticket.priority]:
+                # Gave up while still waiting
+                self.waiting[ticket.priority].remove(ticket)
+            self._dispatch()
+
+    def _run_job(self, ticket):
+        fn, args, kwargs = ticket.job
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            print(f"Error in {ticket.priority} job {getattr(fn, '__name__', fn)}: {e}")
+        finally:
+            self._release(ticket)
+
+    def submit(self, priority, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) to run on its own thread once admitted. Raises QueueFull."""
+        self._enqueue(priority, job=(fn, args, kwargs))
+
+    @contextlib.contextmanager
+    def slot(self, priority, timeout=None):
+        """Block the calling thread until admitted and hold the slot for the block."""
+        admitted = threading.Event()
+        ticket = self._enqueue(priority, notify=admitted.set)
+        try:
+            if not admitted.wait(timeout):
+                raise QueueFull(f"Timed out waiting for a {priority} slot")
+            yield
+        finally:
+            self._release(ticket)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, priority):
+        """slot() for coroutines; waiting doesn't block the event loop and can be cancelled."""
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: admitted.done() or admitted.set_result(None))
+
+        ticket = self._enqueue(priority, notify=notify)
+        try:
+            await admitted
+            yield
+        finally:
+            self._release(ticket)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            classes = {}
+            for priority in CLASSES:
+                counters = self.counters[priority]
+                waiting = self.waiting[priority]
+                classes[priority] = {
+                    'workers': self._cap(priority),
+                    'queue_limit': self.queue_limits[priority],
+                    'running': self.running[priority],
+                    'queued': len(waiting),
+                    'oldest_wait': now - waiting[0].queued_at if waiting else 0.0,
+                    'admitted': counters['admitted'],
+                    'rejected': counters['rejected'],
+                    'avg_wait': counters['total_wait'] / counters['admitted'] if counters['admitted'] else 0.0,
+                    'max_wait': counters['max_wait'],
+                    'last_wait': counters['last_wait'],
+                }
+            return {
+                'workers': self.workers,
+                'running': sum(self.running.values()),
+                'queued': sum(len(waiting) for waiting in self.waiting.values()),
+                'classes': classes,
+            }
@@ -0,0 +1,7 @@
+# Entry point for running several worker processes on one database, e.g.
+#   gunicorn -w 4 -b 127.0.0.1:10052 --timeout 0 wsgi:app
+# Workers share run/cancel state and cache invalidation through the database
+# (see shared_state.py); one of them runs the scheduler and bots.
+from app import app, start_worker
+
+start_worker()